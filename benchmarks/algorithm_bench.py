@@ -0,0 +1,105 @@
+"""
+Throughput of the hash algorithms on the same tree
+
+Generates a tree of small and large files, then hashes it once per
+algorithm through HashEngine, the same way generating a hashtable does.
+Every algorithm runs once to warm the page cache, so the numbers measure
+the hash function, not the disk. xxh3 is skipped without the xxhash package.
+
+Note, that on CPUs with SHA extensions sha256 is usually faster than blake2b.
+
+    python benchmarks/algorithm_bench.py --files 2000 --large 4
+    python benchmarks/algorithm_bench.py --tree /path/to/game
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from core.hashing import ALGORITHMS, HashEngine, new_hash  # noqa: E402
+from core.progress import ProgressReporter  # noqa: E402
+from core.walker import walk  # noqa: E402
+
+
+def create_tree(root: str, files: int, size: int, large: int, large_size: int):
+    for i in range(files):
+        directory = os.path.join(root, f"dir{i % 50}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"file{i}.bin"), "wb") as f:
+            f.write(os.urandom(size))
+
+    for i in range(large):
+        with open(os.path.join(root, f"large{i}.bin"), "wb") as f:
+            for _ in range(large_size):
+                f.write(os.urandom(1024 * 1024))
+
+
+def measure(algorithm: str, engine: HashEngine, files: list[str], sizes: list[int], rounds: int) -> float:
+    expected = engine.hash_files(files, sizes, algorithm)
+
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        if engine.hash_files(files, sizes, algorithm) != expected:
+            raise RuntimeError(f"{algorithm} is not deterministic")
+        best = min(best, time.perf_counter() - start)
+
+    throughput = sum(sizes) / best / 1000 / 1000
+    print(f"{algorithm:<10} {best:8.2f} s {throughput:8.0f} MB/s")
+    return throughput
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=2000,
+                        help="Number of generated small files")
+    parser.add_argument("--size", type=int, default=64 * 1024,
+                        help="Size of small files in bytes")
+    parser.add_argument("--large", type=int, default=4,
+                        help="Number of generated large files")
+    parser.add_argument("--large-size", type=int, default=256,
+                        help="Size of large files in MiB")
+    parser.add_argument("--tree", type=str,
+                        help="Hash existing directory instead of generating one")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of hashing workers")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="Number of measured rounds, the best one is reported")
+    args = parser.parse_args()
+
+    algorithms = []
+    for algorithm in ALGORITHMS:
+        try:
+            new_hash(algorithm)
+            algorithms.append(algorithm)
+        except ValueError as e:
+            print(f"Skipping {algorithm}: {e}")
+
+    with tempfile.TemporaryDirectory() as root:
+        tree = args.tree
+        if tree is None:
+            print(f"Creating {args.files} files of {args.size} B and "
+                  f"{args.large} files of {args.large_size} MiB...")
+            tree = root
+            create_tree(root, args.files, args.size, args.large, args.large_size)
+
+        entries = list(walk(tree))
+        files = [os.path.join(tree, path) for path, _ in entries]
+        sizes = [stat.st_size for _, stat in entries]
+        print(f"Hashing {len(files)} files, {sum(sizes) / 1000 / 1000:.0f} MB")
+
+        engine = HashEngine(args.jobs, progress=ProgressReporter(quiet=True))
+        results = {algorithm: measure(algorithm, engine, files, sizes, args.rounds)
+                   for algorithm in algorithms}
+
+        for algorithm, throughput in results.items():
+            print(f"{algorithm}: {throughput / results['sha256']:.2f}x of sha256")
+
+
+if __name__ == "__main__":
+    main()
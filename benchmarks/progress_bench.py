@@ -0,0 +1,118 @@
+"""
+Wall-clock cost of progress reporting while hashing a tree of small files
+
+Compares the old per-file rich Progress display with the shared
+ProgressReporter (rendering and quiet). Rendering goes to os.devnull
+through a forced terminal console, so the numbers measure the work
+done by rich and not the speed of the terminal emulator.
+
+    python benchmarks/progress_bench.py --files 50000
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+from rich.console import Console
+from rich.progress import (BarColumn, DownloadColumn, Progress, TextColumn,
+                           TimeRemainingColumn, TransferSpeedColumn)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from core.progress import ProgressReporter  # noqa: E402
+
+
+def create_tree(root: str, files: int, size: int) -> list[str]:
+    paths = []
+    for i in range(files):
+        directory = os.path.join(root, str(i // 1000))
+        os.makedirs(directory, exist_ok=True)
+
+        path = os.path.join(directory, f"{i}.bin")
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        paths.append(path)
+
+    return paths
+
+
+def hash_per_file_progress(paths: list[str], console: Console) -> None:
+    "Previous implementation, one live display for every file"
+
+    for path in paths:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            with Progress(TextColumn("[bold purple]H: [bold blue]{task.fields[filename]}", justify="right"),
+                          BarColumn(bar_width=None),
+                          "[progress.percentage]{task.percentage:>3.1f}%",
+                          "•",
+                          DownloadColumn(),
+                          "•",
+                          TransferSpeedColumn(),
+                          "•",
+                          TimeRemainingColumn(),
+                          console=console) as progress:
+                task = progress.add_task(path, filename=os.path.basename(
+                    path), total=os.stat(path).st_size)
+                while True:
+                    chunk = f.read(1000 * 1000)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    progress.update(task, advance=len(chunk))
+
+
+def hash_shared_progress(paths: list[str], reporter: ProgressReporter) -> None:
+    sizes = [os.stat(path).st_size for path in paths]
+
+    with reporter.phase("[bold purple]H", sum(sizes), len(paths)) as phase:
+        for path, size in zip(paths, sizes):
+            sha = hashlib.sha256()
+            with open(path, "rb") as f:
+                while True:
+                    chunk = f.read(1000 * 1000)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    phase.advance(len(chunk), os.path.basename(path))
+            phase.complete_file()
+
+
+def measure(name: str, function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} {elapsed:8.2f} s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=50000,
+                        help="Number of files in the tree")
+    parser.add_argument("--size", type=int, default=1024,
+                        help="Size of each file in bytes")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root, open(os.devnull, "w") as devnull:
+        print(f"Creating {args.files} files of {args.size} bytes...")
+        paths = create_tree(root, args.files, args.size)
+
+        console = Console(file=devnull, force_terminal=True)
+
+        legacy = measure("per-file Progress", hash_per_file_progress,
+                         paths, console)
+        shared = measure("shared reporter", hash_shared_progress,
+                         paths, ProgressReporter(console=console))
+        quiet = measure("shared reporter, quiet", hash_shared_progress,
+                        paths, ProgressReporter(quiet=True, console=console))
+
+        print(f"Speedup: {legacy / shared:.1f}x rendering, {legacy / quiet:.1f}x quiet")
+
+
+if __name__ == "__main__":
+    main()
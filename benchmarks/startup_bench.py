@@ -0,0 +1,186 @@
+"""
+Startup cost of main.py in every mode
+
+Launchers run the updater on every start of their application, mostly to
+verify an unchanged tree, so the time until main.py does any work matters
+as much as the work itself. Every mode runs on a tree of a few files in a
+new process, the same way users run it:
+
+    help            --help
+    generate        -g of the tree
+    convert         --convert of the hashtable to binary
+    verify          --verify of an unchanged copy against the local hashtable
+    verify-remote   --verify against the hashtable served over HTTP
+    update          update of an unchanged copy, once per downloader
+
+Every mode is run once more with -X importtime, the report shows the total
+import time and which of the heavy optional modules were loaded.
+
+    python benchmarks/startup_bench.py --rounds 10
+    python benchmarks/startup_bench.py --output startup.json --baseline previous.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from core.server import MirrorHandler, MirrorServer  # noqa: E402
+
+MAIN = os.path.join(os.path.dirname(__file__), "..", "main.py")
+DOWNLOADERS = ["requests", "urllib", "asyncio"]
+
+# Top-level modules, that a lean startup path avoids
+HEAVY_MODULES = ["requests", "urllib3", "rich", "coloredlogs", "asyncio", "http.server"]
+
+
+class QuietHandler(MirrorHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def log_error(self, format, *args):
+        # Clients probe for optional files like hashtable deltas
+        pass
+
+
+def updater(*args: str, importtime: bool = False) -> str:
+    "Run main.py, returns its stderr, raises if it fails"
+
+    command = [sys.executable, *(["-X", "importtime"] if importtime else []), MAIN, *args]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"main.py {' '.join(args)} failed:\n{result.stderr}")
+    return result.stderr
+
+
+def imports(*args: str) -> tuple[float, int, list[str]]:
+    "Total import time in seconds, number of imported modules and heavy modules, that were imported"
+
+    total, count, loaded = 0, 0, set()
+    for line in updater(*args, importtime=True).splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        _, self_time, _, name = (part.strip() for part in line.replace("import time:", "|", 1).split("|"))
+        total += int(self_time)
+        count += 1
+        loaded.update(module for module in HEAVY_MODULES if name == module or name.startswith(module + "."))
+
+    return total / 1e6, count, sorted(loaded)
+
+
+def measure(rounds: int, args: list[str]) -> list[float]:
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        updater(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench(args: argparse.Namespace, work: str) -> list[dict]:
+    source = os.path.join(work, "source")
+    destination = os.path.join(work, "destination")
+    os.makedirs(source)
+
+    for i in range(args.files):
+        with open(os.path.join(source, f"file{i}.txt"), "w", encoding="utf-8") as f:
+            f.write(f"content of file {i}\n" * 100)
+
+    hashtable = os.path.join(source, "hashtable.json")
+    updater(hashtable, "-d", source, "-g", "-q")
+    shutil.copytree(source, destination, ignore=shutil.ignore_patterns("hashtable.json", ".updater"))
+
+    # The hash cache of the destination is warm, as it is on the machines of users
+    updater(hashtable, "-d", destination, "--verify", "-q")
+
+    server = MirrorServer(("127.0.0.1", 0), source, hashtable)
+    server.RequestHandlerClass = QuietHandler
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/hashtable.json"
+
+    modes = {
+        "help": ["--help"],
+        "generate": [hashtable, "-d", source, "-g", "-q"],
+        "convert": [hashtable, "--convert", os.path.join(work, "hashtable.bin"), "--format", "binary", "-q"],
+        "verify": [hashtable, "-d", destination, "--verify", "-q"],
+        "verify-remote": [url, "-d", destination, "--verify", "-q"],
+    }
+    for downloader in args.downloaders:
+        modes[f"update ({downloader})"] = [url, "-d", destination, "-y", "-q", "--downloader", downloader]
+
+    results = []
+    try:
+        for mode, mode_args in modes.items():
+            times = measure(args.rounds, mode_args)
+            import_time, modules, loaded = imports(*mode_args)
+
+            results.append({"mode": mode, "median": statistics.median(times), "min": min(times), "rounds": times,
+                            "import_time": import_time, "modules": modules, "heavy_modules": loaded})
+            print(f"  {mode:<20} {statistics.median(times):7.3f} s median {min(times):7.3f} s min "
+                  f"{import_time:7.3f} s imports ({modules} modules) {', '.join(loaded) or '-'}")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return results
+
+
+def compare(results: list[dict], baseline: str) -> None:
+    with open(baseline, "r", encoding="utf-8") as f:
+        previous = {result["mode"]: result for result in json.load(f)["results"]}
+
+    print(f"Compared to {baseline}:")
+    for result in results:
+        if result["mode"] in previous:
+            change = result["median"] / previous[result["mode"]]["median"] - 1
+            print(f"  {result['mode']:<20} {change:+8.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=10,
+                        help="Number of files in the tree")
+    parser.add_argument("--downloaders", type=str, default=",".join(DOWNLOADERS),
+                        help="Comma separated downloaders of the update mode")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="Number of measured rounds of every mode, the median is compared")
+    parser.add_argument("--output", type=str,
+                        help="Write results to this JSON file")
+    parser.add_argument("--baseline", type=str,
+                        help="Print change against results of a previous run")
+    args = parser.parse_args()
+
+    args.downloaders = [name.strip() for name in args.downloaders.split(",") if name.strip()]
+
+    print(f"main.py startup, {args.files} files, Python {platform.python_version()}")
+    with tempfile.TemporaryDirectory() as work:
+        results = bench(args, work)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "version": 1,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "config": {"files": args.files, "rounds": args.rounds},
+                "results": results,
+            }, f, indent=2)
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""
+End-to-end timings of generating, verifying and updating synthetic trees
+
+Every shape of tree is generated from a fixed seed, so runs on the same
+machine are comparable. The tree is served by the mirror server of the
+updater with optional latency added to every request and a bandwidth limit
+shared by all connections. Every scenario runs main.py in a new process,
+the same way users run it:
+
+    generate    -g of the source tree, hash cache ignored
+    verify      --verify of a complete copy, hash cache ignored
+    noop        --verify of a complete copy with a warm hash cache
+    full        update of an empty destination, once per downloader
+    resumed     update after an interrupted one, that staged half of the
+                files and left partial downloads of the rest, once per downloader
+
+Results are written as JSON, a previous result file can be passed as
+--baseline to print the relative change of every timing.
+
+    python benchmarks/update_bench.py --shapes tiny,huge --output results.json
+    python benchmarks/update_bench.py --latency 20 --bandwidth 50 --baseline results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from core import manifest  # noqa: E402
+from core.server import MirrorHandler, MirrorServer  # noqa: E402
+from core.staging import Stage  # noqa: E402
+
+MAIN = os.path.join(os.path.dirname(__file__), "..", "main.py")
+SEED = 20220601
+DOWNLOADERS = ["requests", "urllib", "asyncio"]
+
+# Shapes of trees at scale 1, (number of files, size of a file in bytes, nesting depth, distinct contents)
+SHAPES = {
+    "tiny": (5000, 2 * 1024, 2, None),
+    "huge": (4, 64 * 1024 * 1024, 1, None),
+    "deep": (2000, 16 * 1024, 12, None),
+    "duplicates": (2000, 64 * 1024, 3, 50),
+}
+
+# Mtime of generated files, old enough to be trusted by the hash cache
+MTIME = time.time_ns() - 3600 * 1000 * 1000 * 1000
+
+
+def create_tree(root: str, shape: str, scale: float) -> tuple[int, int]:
+    "Generate tree of the given shape, returns number of files and their total size"
+
+    count, size, depth, distinct = SHAPES[shape]
+    count = max(1, int(count * scale)) if shape != "huge" else count
+    size = max(1, int(size * scale)) if shape == "huge" else size
+
+    rng = random.Random(SEED)
+    contents = [rng.randbytes(size) for _ in range(distinct)] if distinct else None
+
+    for i in range(count):
+        directory = os.path.join(root, *[f"d{(i >> level) % 4}" for level in range(depth - 1)])
+        os.makedirs(directory, exist_ok=True)
+
+        path = os.path.join(directory, f"file{i}.bin")
+        with open(path, "wb") as f:
+            if contents is not None:
+                f.write(contents[i % distinct])
+            else:
+                # Large files are written in chunks, so they do not have to fit in memory
+                for offset in range(0, size, 1024 * 1024):
+                    f.write(rng.randbytes(min(1024 * 1024, size - offset)))
+        os.utime(path, ns=(MTIME, MTIME))
+
+    return count, count * size
+
+
+class Link():
+    """
+    Bandwidth shared by all connections of the server
+
+    Args:
+        rate (float): Bytes per second
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.free_at = 0.0
+
+    def transmit(self, size: int) -> None:
+        "Wait until size bytes went through the link"
+
+        with self.lock:
+            start = max(time.monotonic(), self.free_at)
+            self.free_at = start + size / self.rate
+            done = self.free_at
+
+        delay = done - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ThrottledSocket():
+    "Socket, whose sendfile goes through a Link"
+
+    def __init__(self, sock, link: Link):
+        self.sock = sock
+        self.link = link
+
+    def sendfile(self, file, offset: int = 0, count: int | None = None) -> int:
+        file.seek(offset)
+        sent = 0
+        while count is None or sent < count:
+            chunk = file.read(64 * 1024 if count is None else min(64 * 1024, count - sent))
+            if not chunk:
+                break
+            self.link.transmit(len(chunk))
+            self.sock.sendall(chunk)
+            sent += len(chunk)
+        return sent
+
+    def __getattr__(self, name: str):
+        return getattr(self.sock, name)
+
+
+class BenchHandler(MirrorHandler):
+    "Mirror handler with latency before every response and limited bandwidth"
+
+    server: "BenchServer"
+
+    def setup(self):
+        super().setup()
+        if self.server.link is not None:
+            self.connection = ThrottledSocket(self.connection, self.server.link)
+
+    def serve(self, body: bool) -> None:
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        super().serve(body)
+
+    def log_message(self, format, *args):
+        pass
+
+    def log_error(self, format, *args):
+        # Clients probe for optional files like hashtable deltas
+        pass
+
+
+class BenchServer(MirrorServer):
+    def __init__(self, root: str, hashtable: str, latency: float, bandwidth: float | None):
+        self.latency = latency
+        self.link = Link(bandwidth) if bandwidth else None
+        super().__init__(("127.0.0.1", 0), root, hashtable)
+        self.RequestHandlerClass = BenchHandler
+
+
+def updater(*args: str) -> None:
+    "Run main.py, raises if it fails"
+
+    result = subprocess.run([sys.executable, MAIN, *args, "-q"], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"main.py {' '.join(args)} failed:\n{result.stderr}")
+
+
+def measure(rounds: int, prepare, run) -> list[float]:
+    "Times of rounds of run, prepare restores the starting state before each of them"
+
+    times = []
+    for _ in range(rounds):
+        prepare()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def stage_interrupted(destination: str, source: str, hashtable: dict[str, dict]) -> None:
+    "Leave the staging area of destination, as if an update was interrupted halfway"
+
+    stage = Stage(destination)
+    algorithm = manifest.algorithm_of(hashtable)
+
+    for i, (path, entry) in enumerate(sorted(hashtable.items())):
+        staged = stage.path(path)
+        os.makedirs(os.path.dirname(staged), exist_ok=True)
+
+        if i % 2 == 0:
+            shutil.copyfile(os.path.join(source, path), staged)
+            stage.record(path, entry["hash"], algorithm, entry["size"])
+        else:
+            # Partial download
+            with open(os.path.join(source, path), "rb") as src, open(staged, "wb") as dst:
+                dst.write(src.read(entry["size"] // 2))
+
+    stage.close()
+
+
+def bench_shape(shape: str, args: argparse.Namespace, work: str) -> list[dict]:
+    source = os.path.join(work, shape, "source")
+    destination = os.path.join(work, shape, "destination")
+    os.makedirs(source)
+
+    files, size = create_tree(source, shape, args.scale)
+    hashtable_path = os.path.join(source, "hashtable.json")
+    print(f"{shape}: {files} files, {size / 1024 / 1024:.1f} MiB")
+
+    results = []
+
+    def record(scenario: str, times: list[float], downloader: str | None = None):
+        result = {"shape": shape, "scenario": scenario, "downloader": downloader, "files": files, "bytes": size,
+                  "median": statistics.median(times), "min": min(times), "rounds": times}
+        results.append(result)
+        name = f"{scenario} ({downloader})" if downloader else scenario
+        print(f"  {name:<20} {result['median']:8.3f} s median {result['min']:8.3f} s min")
+
+    def clear():
+        shutil.rmtree(destination, ignore_errors=True)
+
+    def copy():
+        clear()
+        shutil.copytree(source, destination, ignore=shutil.ignore_patterns("hashtable.json", ".updater"))
+
+    record("generate", measure(args.rounds, lambda: None,
+                               lambda: updater(hashtable_path, "-d", source, "-g", "--rehash", "-j", str(args.jobs))))
+
+    with open(hashtable_path, "rb") as f:
+        hashtable = manifest.load(f)
+
+    record("verify", measure(args.rounds, copy,
+                             lambda: updater(hashtable_path, "-d", destination, "--verify", "--rehash", "-j", str(args.jobs))))
+
+    # The hash cache of the first verification is kept for the following ones
+    copy()
+    updater(hashtable_path, "-d", destination, "--verify", "-j", str(args.jobs))
+    record("noop", measure(args.rounds, lambda: None,
+                           lambda: updater(hashtable_path, "-d", destination, "--verify", "-j", str(args.jobs))))
+
+    server = BenchServer(source, hashtable_path, args.latency / 1000, args.bandwidth * 1024 * 1024)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/hashtable.json"
+
+    try:
+        for downloader in args.downloaders:
+            def update():
+                updater(url, "-d", destination, "-y", "--downloader", downloader,
+                        "--connections", str(args.connections), "-j", str(args.jobs))
+
+            record("full", measure(args.rounds, clear, update), downloader)
+
+            def interrupted():
+                clear()
+                stage_interrupted(destination, source, hashtable)
+
+            record("resumed", measure(args.rounds, interrupted, update), downloader)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return results
+
+
+def compare(results: list[dict], baseline: str) -> None:
+    with open(baseline, "r", encoding="utf-8") as f:
+        previous = {(result["shape"], result["scenario"], result["downloader"]): result
+                    for result in json.load(f)["results"]}
+
+    print(f"Compared to {baseline}:")
+    for result in results:
+        key = (result["shape"], result["scenario"], result["downloader"])
+        if key in previous:
+            change = result["median"] / previous[key]["median"] - 1
+            name = f"{result['shape']} {result['scenario']}" + (f" ({result['downloader']})" if result["downloader"] else "")
+            print(f"  {name:<32} {change:+8.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shapes", type=str, default=",".join(SHAPES),
+                        help="Comma separated shapes of generated trees")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiplier of the number of files (size of files for huge)")
+    parser.add_argument("--downloaders", type=str, default=",".join(DOWNLOADERS),
+                        help="Comma separated downloaders of the update scenarios")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Milliseconds added to every request")
+    parser.add_argument("--bandwidth", type=float, default=0,
+                        help="Bandwidth of the server in MiB/s shared by all connections, 0 for unlimited")
+    parser.add_argument("--connections", type=int, default=4,
+                        help="Number of files downloaded in parallel")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of hashing workers")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="Number of measured rounds of every scenario, the median is compared")
+    parser.add_argument("--output", type=str,
+                        help="Write results to this JSON file")
+    parser.add_argument("--baseline", type=str,
+                        help="Print change against results of a previous run")
+    args = parser.parse_args()
+
+    shapes = [shape.strip() for shape in args.shapes.split(",") if shape.strip()]
+    for shape in shapes:
+        if shape not in SHAPES:
+            parser.error(f"Unknown shape {shape}, choose from {', '.join(SHAPES)}")
+    args.downloaders = [name.strip() for name in args.downloaders.split(",") if name.strip()]
+
+    results = []
+    with tempfile.TemporaryDirectory() as work:
+        for shape in shapes:
+            results.extend(bench_shape(shape, args, work))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "version": 1,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "config": {"scale": args.scale, "latency": args.latency, "bandwidth": args.bandwidth,
+                           "connections": args.connections, "jobs": args.jobs, "rounds": args.rounds},
+                "results": results,
+            }, f, indent=2)
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
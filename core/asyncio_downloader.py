@@ -0,0 +1,538 @@
+import asyncio
+import json
+import logging as console
+import os
+import ssl
+from functools import partial
+from os import PathLike
+from pathlib import Path
+from typing import Callable, Collection, Iterable, Iterator
+from urllib.parse import quote, urljoin, urlsplit
+
+from core import blocks, compression
+from core.downloader_template import TIMEOUT, DownloaderBase, VerificationError
+from core.hashing import DEFAULT_ALGORITHM, hash_stream, new_hash
+from core.mirrors import MirrorPool, Retry
+from core.progress import ProgressPhase, ProgressReporter
+from core.staging import Stage
+
+CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 10
+
+
+class HTTPError(Exception):
+    "Server responded with error status"
+
+
+class ByteBudget():
+    """
+    Limits number of bytes, that were received but not yet written to disk
+
+    Args:
+        limit (int): Maximal number of bytes in flight
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.available = limit
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, size: int) -> int:
+        "Wait until size bytes (at most limit) are available, returns granted number of bytes"
+
+        size = min(size, self.limit)
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.available >= size)
+            self.available -= size
+        return size
+
+    async def release(self, size: int) -> None:
+        async with self.condition:
+            self.available += size
+            self.condition.notify_all()
+
+
+class Response():
+    "Response with streamed body, the connection returns to the pool once the body is read"
+
+    def __init__(self, pool: "ConnectionPool", key: tuple, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter, status: int, headers: dict[str, str]):
+        self.pool = pool
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.headers = headers
+        self.chunked = headers.get("transfer-encoding", "").lower() == "chunked"
+        self.remaining = int(headers["content-length"]) \
+            if "content-length" in headers and not self.chunked else None
+        self.keep_alive = headers.get("connection", "").lower() != "close" and \
+            (self.chunked or self.remaining is not None)
+        self.done = False
+        if self.remaining == 0:
+            # Empty body is read already, the connection is free for the next request
+            self.finish()
+
+    async def read(self, size: int = CHUNK_SIZE) -> bytes:
+        "Read at most size bytes of body, empty bytes mean end of body"
+
+        try:
+            return await asyncio.wait_for(self.receive(size), self.pool.timeout)
+        except asyncio.TimeoutError:
+            # Position in the body is unknown, the connection can not be reused
+            self.close()
+            raise
+
+    async def receive(self, size: int) -> bytes:
+        if self.done:
+            return b""
+
+        if self.chunked:
+            if not self.remaining:
+                line = await self.reader.readline()
+                self.remaining = int(line.split(b";")[0], 16)
+                if self.remaining == 0:
+                    # Skip trailers
+                    while (await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    self.finish()
+                    return b""
+
+            data = await self.reader.read(min(size, self.remaining))
+            if not data:
+                raise asyncio.IncompleteReadError(data, self.remaining)
+            self.remaining -= len(data)
+            if self.remaining == 0:
+                await self.reader.readexactly(2)
+            return data
+
+        if self.remaining is None:
+            # Body ends with the connection
+            data = await self.reader.read(size)
+            if not data:
+                self.finish()
+            return data
+
+        data = await self.reader.read(min(size, self.remaining))
+        if not data:
+            raise asyncio.IncompleteReadError(data, self.remaining)
+        self.remaining -= len(data)
+        if self.remaining == 0:
+            self.finish()
+        return data
+
+    def finish(self) -> None:
+        self.done = True
+        if self.keep_alive:
+            self.pool.put(self.key, self.reader, self.writer)
+        else:
+            self.pool.discard(self.key, self.writer)
+
+    def close(self) -> None:
+        "Drop response, unread body makes the connection unusable"
+
+        if not self.done:
+            self.done = True
+            self.pool.discard(self.key, self.writer)
+
+
+class ConnectionPool():
+    """
+    Keep-alive HTTP/1.1 connections with a limit of connections per host
+
+    Args:
+        per_host (int): Maximal number of open connections to one host
+        timeout (float, optional): Seconds to wait for a connection or for data. Defaults to TIMEOUT.
+    """
+
+    def __init__(self, per_host: int, timeout: float = TIMEOUT):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.idle: dict[tuple, list[tuple[asyncio.StreamReader, asyncio.StreamWriter]]] = {}
+        self.limits: dict[tuple, asyncio.Semaphore] = {}
+        self.ssl_context = ssl.create_default_context()
+
+    def put(self, key: tuple, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.idle.setdefault(key, []).append((reader, writer))
+        self.limits[key].release()
+
+    def discard(self, key: tuple, writer: asyncio.StreamWriter) -> None:
+        writer.close()
+        self.limits[key].release()
+
+    async def connect(self, key: tuple) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        "Get idle or new connection, returns True as the last item if it was reused"
+
+        await self.limits.setdefault(key, asyncio.Semaphore(self.per_host)).acquire()
+
+        idle = self.idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+
+        scheme, host, port = key
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                host, port, ssl=self.ssl_context if scheme == "https" else None), self.timeout)
+        except BaseException:
+            self.limits[key].release()
+            raise
+
+        return reader, writer, False
+
+    async def request(self, url: str, headers: dict[str, str] | None = None) -> Response:
+        """Send GET request and read status and headers of the response
+
+        Args:
+            url (str): Requested URL, redirects are followed
+            headers (dict, optional): Additional headers. Defaults to None.
+
+        Raises:
+            HTTPError: Server responded with error status
+
+        Returns:
+            Response: Response with unread body
+        """
+
+        for _ in range(MAX_REDIRECTS):
+            response = await self.send(url, headers or {})
+
+            if response.status in (301, 302, 303, 307, 308) and "location" in response.headers:
+                response.close()
+                url = urljoin(url, response.headers["location"])
+                continue
+
+            if response.status >= 400:
+                response.close()
+                raise HTTPError(f"{url}: {response.status}")
+
+            return response
+
+        raise HTTPError(f"{url}: too many redirects")
+
+    async def send(self, url: str, headers: dict[str, str]) -> Response:
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname,
+               parts.port or (443 if parts.scheme == "https" else 80))
+        target = quote(parts.path or "/", safe="/%:@!$&'()*+,;=~") + \
+            ("?" + parts.query if parts.query else "")
+
+        request = f"GET {target} HTTP/1.1\r\nHost: {parts.netloc}\r\nAccept-Encoding: identity\r\n"
+        request += "".join(f"{name}: {value}\r\n" for name,
+                           value in headers.items()) + "\r\n"
+
+        while True:
+            reader, writer, reused = await self.connect(key)
+            try:
+                writer.write(request.encode("latin-1"))
+                await asyncio.wait_for(writer.drain(), self.timeout)
+
+                status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+                if not status_line:
+                    raise ConnectionResetError("Connection closed by server")
+
+                response_headers = {}
+                while True:
+                    line = (await asyncio.wait_for(reader.readline(), self.timeout)).decode("latin-1")
+                    if line in ("\r\n", "\n", ""):
+                        break
+                    name, _, value = line.partition(":")
+                    response_headers[name.strip().lower()] = value.strip()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.discard(key, writer)
+                if reused:
+                    # Server closed idle keep-alive connection, try a new one
+                    continue
+                raise
+            except BaseException:
+                self.discard(key, writer)
+                raise
+
+            status = int(status_line.split()[1])
+            return Response(self, key, reader, writer, status, response_headers)
+
+    def close(self) -> None:
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle.clear()
+
+
+class AsyncioDownloader(DownloaderBase):
+    """
+    Downloader running all transfers in a single asyncio event loop
+
+    Args:
+        progress (ProgressReporter, optional): Shared progress display of the run. Defaults to a new one.
+        connections (int, optional): Number of files downloaded in parallel. Defaults to 4.
+        block_maps_url (str, optional): URL of directory with block maps of large files. Defaults to None.
+        per_host (int, optional): Maximal number of connections to one host. Defaults to connections.
+        max_in_flight (int, optional): Maximal number of received bytes, that are not written to disk yet. Defaults to 16 MiB.
+        algorithm (str, optional): Hash algorithm of the hashtable, used to verify downloaded files. Defaults to DEFAULT_ALGORITHM.
+        companions_path (str, optional): Path of compressed companions relative to the mirror root, they are downloaded instead of files, that have them. Defaults to None.
+        stage (Stage, optional): Staging area, that the files are downloaded into, verified files are recorded in its journal. Defaults to None.
+    """
+
+    def __init__(self, progress: ProgressReporter | None = None, connections: int = 4,
+                 block_maps_url: str | None = None, per_host: int | None = None,
+                 max_in_flight: int = 16 * 1024 * 1024, algorithm: str = DEFAULT_ALGORITHM,
+                 companions_path: str | None = None, stage: Stage | None = None) -> None:
+        super().__init__(progress, block_maps_url, algorithm, companions_path, stage)
+        self.connections = max(1, connections)
+        self.per_host = per_host if per_host is not None else self.connections
+        self.max_in_flight = max_in_flight
+
+    transient_errors = DownloaderBase.transient_errors + (HTTPError, asyncio.IncompleteReadError, asyncio.TimeoutError)
+
+    @property
+    def name(self) -> str:
+        return "asyncio_downloader"
+
+    def download_stream(self, items: Iterable[tuple[str, dict]], mirror: str | list[str] | MirrorPool,
+                        dest_dir: str | PathLike, phase: ProgressPhase) -> None:
+        "Download files from remote repository as they are produced by items."
+
+        mirrors = MirrorPool.of(mirror)
+        asyncio.run(self.download_all(items, mirrors, dest_dir, phase))
+        mirrors.report()
+
+        # Interrupted downloads must not be committed
+        if self.done_event.is_set():
+            raise KeyboardInterrupt
+
+    async def download_all(self, items: Iterable[tuple[str, dict]], mirrors: MirrorPool,
+                           dest_dir: str | PathLike, phase: ProgressPhase) -> None:
+        loop = asyncio.get_running_loop()
+        pool = ConnectionPool(self.per_host, self.timeout)
+        budget = ByteBudget(self.max_in_flight)
+        source = iter(items)
+        lock = asyncio.Lock()
+
+        # Iterating a producer may block, so it has to leave the event loop
+        blocking = not isinstance(items, Collection)
+
+        async def next_item() -> tuple[str, dict] | None:
+            if not blocking:
+                return next(source, None)
+            async with lock:
+                return await loop.run_in_executor(None, next, source, None)
+
+        async def worker() -> None:
+            # Workers pull files one by one, so the memory does not grow with the hashtable
+            while not self.done_event.is_set() and (item := await next_item()) is not None:
+                path, entry = item
+                try:
+                    await self.fetch_file(pool, budget, mirrors, path, Path(os.path.join(dest_dir, path)), entry, phase)
+                except BaseException as e:
+                    self.report_failure(path, entry, e)
+                    raise
+
+        workers = [asyncio.create_task(worker())
+                   for _ in range(self.connections)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            # Stop other transfers after the first failure or cancellation
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            pool.close()
+
+    async def fetch_file(self, pool: ConnectionPool, budget: ByteBudget, mirrors: MirrorPool, path: str,
+                         file: Path, entry: dict, phase: ProgressPhase) -> None:
+        "Download file from the best mirror, failed or corrupted downloads are retried on other mirrors"
+
+        loop = asyncio.get_running_loop()
+
+        segments = self.segments(mirrors, file, entry)
+        if segments is not None:
+            try:
+                await loop.run_in_executor(None, self.download_split, mirrors, path, file, entry, phase,
+                                           segments, self.range_fetcher(pool, loop))
+                return self.staged(path, entry)
+            except self.transient_errors as e:
+                console.warning(f"{path} could not be split across mirrors ({e}), downloading from one mirror")
+
+        retry = Retry(mirrors, path, entry["size"])
+        while True:
+            mirror, transfer = retry.start(phase)
+
+            try:
+                await self.download_file(pool, budget, mirror.url + path, file, entry["hash"], entry["size"],
+                                         transfer, self.companion(entry, mirror.url))  # type: ignore
+            except self.transient_errors as e:
+                await asyncio.sleep(retry.failed(e))
+                continue
+
+            retry.succeeded()
+            return self.staged(path, entry)
+
+    def range_fetcher(self, pool: ConnectionPool, loop: asyncio.AbstractEventLoop) -> Callable[[str, int, int], Iterator[bytes]]:
+        "Blocking fetch of byte ranges for worker threads, the transfers themselves stay in the event loop"
+
+        def fetch_range(url: str, start: int, end: int) -> Iterator[bytes]:
+            def run(coroutine):
+                return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+            response = run(pool.request(
+                url, {'Range': f'bytes={start}-{end}'}))
+            try:
+                if response.status != 206:
+                    raise blocks.PatchError(f'{url} does not support ranges')
+                while data := run(response.read()):
+                    yield data
+            finally:
+                loop.call_soon_threadsafe(response.close)
+
+        return fetch_range
+
+    async def patch_file(self, pool: ConnectionPool, url: str, file: Path,
+                         verification_hash: str, phase: ProgressPhase) -> bool:
+        "Download only changed blocks of file, returns False if it has to be downloaded whole"
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            response = await pool.request(blocks.block_map_url(
+                self.block_maps_url, verification_hash))  # type: ignore
+            try:
+                content = b""
+                while data := await response.read():
+                    content += data
+            finally:
+                response.close()
+            block_map = json.loads(content)
+        except (OSError, HTTPError, asyncio.IncompleteReadError, ValueError):
+            return False
+
+        fetch_range = partial(self.range_fetcher(pool, loop), url)
+
+        try:
+            return await loop.run_in_executor(
+                None, blocks.patch_file, self.patch_source(file), block_map, verification_hash, fetch_range, phase,
+                self.algorithm, file)
+        except (OSError, HTTPError, asyncio.IncompleteReadError, blocks.PatchError) as e:
+            console.info(f'{file} can not be patched ({e}), downloading whole file.')
+            return False
+
+    async def download_companion(self, pool: ConnectionPool, budget: ByteBudget, companion: tuple[str, str],
+                                 file: Path, verification_hash: str, file_size: int, phase: ProgressPhase) -> bool:
+        "Download compressed companion of file, returns False if the file has to be downloaded as it is"
+
+        loop = asyncio.get_running_loop()
+        url, encoding = companion
+
+        try:
+            response = await pool.request(url)
+        except (OSError, HTTPError, asyncio.IncompleteReadError) as e:
+            console.debug(f'{file} has no companion ({e})')
+            return False
+
+        decoder = compression.Decoder(encoding, file_size)
+        sha = new_hash(self.algorithm)
+
+        def write(f, data: bytes) -> None:
+            data = decoder.decode(data)
+            f.write(data)
+            sha.update(data)
+
+        try:
+            with open(file, 'wb') as f:
+                while True:
+                    granted = await budget.acquire(CHUNK_SIZE)
+                    try:
+                        data = await response.read(granted)
+                        if not data:
+                            break
+                        # Decompression and disk writes must not block the event loop
+                        await loop.run_in_executor(None, write, f, data)
+                    finally:
+                        await budget.release(granted)
+                    phase.advance(len(data), file.name)
+        except ValueError as e:
+            console.warning(f'{file} can not be decompressed ({e}), downloading whole file.')
+            return False
+        except (OSError, asyncio.IncompleteReadError) as e:
+            console.info(f'{file} companion could not be downloaded ({e}), downloading whole file.')
+            return False
+        finally:
+            response.close()
+
+        if sha.hexdigest() != verification_hash:
+            console.warning(f'{file} companion failed verification, downloading whole file.')
+            return False
+
+        phase.complete_file(file.name)
+        return True
+
+    async def download_file(self, pool: ConnectionPool, budget: ByteBudget, url: str, file: Path,
+                            verification_hash: str, file_size: int, phase: ProgressPhase,
+                            companion: tuple[str, str] | None = None) -> None:
+        "Download file from remote repository, hashing it while it is being written, compressed companion is preferred."
+
+        loop = asyncio.get_running_loop()
+        file.parent.mkdir(parents=True, exist_ok=True)
+
+        if self.block_maps_url is not None and file_size >= blocks.MIN_SIZE and self.patch_source(file) is not None:
+            if await self.patch_file(pool, url, file, verification_hash, phase):
+                return
+
+        resume_byte_position = 0
+        if file.exists():
+            file_size_offline = file.stat().st_size
+            if file_size > file_size_offline:
+                console.info(f'{file} is incomplete. Resuming download.')
+                resume_byte_position = file_size_offline
+
+        if companion is not None and not resume_byte_position:
+            if await self.download_companion(pool, budget, companion, file, verification_hash, file_size, phase):
+                return
+
+        headers = {'Range': f'bytes={resume_byte_position}-'} \
+            if resume_byte_position else {}
+        response = await pool.request(url, headers)
+
+        try:
+            if resume_byte_position and response.status != 206:
+                console.info(f'{url} does not support resuming, downloading whole file.')
+                resume_byte_position = 0
+
+            sha = new_hash(self.algorithm)
+            mode = 'ab' if resume_byte_position else 'wb'
+
+            if resume_byte_position:
+                # Only the part, that is already on disk, has to be read
+                def hash_prefix():
+                    with open(file, 'rb') as f:
+                        hash_stream(f, sha, resume_byte_position)
+                await loop.run_in_executor(None, hash_prefix)
+
+            phase.advance(resume_byte_position, file.name)
+
+            def write(f, data: bytes) -> None:
+                f.write(data)
+                sha.update(data)
+
+            with open(file, mode) as f:
+                while True:
+                    granted = await budget.acquire(CHUNK_SIZE)
+                    try:
+                        data = await response.read(granted)
+                        if not data:
+                            break
+                        # Disk writes must not block the event loop
+                        await loop.run_in_executor(None, write, f, data)
+                    finally:
+                        await budget.release(granted)
+                    phase.advance(len(data))
+        finally:
+            response.close()
+
+        phase.complete_file(file.name)
+
+        if not sha.hexdigest() == verification_hash:
+            console.error(f'{file} failed verification. Deleting.')
+            file.unlink()
+            raise VerificationError('File failed verification.')
@@ -0,0 +1,217 @@
+"""
+Block maps for transferring only changed parts of large files
+
+For every large file the generator can publish
+"<hashtable>.blocks/<file hash>.json" with SHA-256 digests of fixed-size
+blocks of its content:
+
+    {"block_size": 1048576, "size": size, "blocks": ["hex digest", ...]}
+
+When the file has to be updated, the client hashes the local copy block by
+block, downloads only the blocks, that differ, via HTTP Range requests and
+assembles the new file next to the old one.
+"""
+
+import hashlib
+import json
+import logging as console
+import os
+from os import PathLike
+from pathlib import Path
+from typing import Callable, Iterable
+
+from core.hashing import CHUNK_SIZE, DEFAULT_ALGORITHM, new_hash
+from core.progress import ProgressPhase
+
+BLOCKS_SUFFIX = ".blocks"
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+# Smaller files are always downloaded whole
+MIN_SIZE = 4 * DEFAULT_BLOCK_SIZE
+
+PART_SUFFIX = ".part"
+
+
+class PatchError(Exception):
+    "File can not be patched, it has to be downloaded whole"
+
+
+def block_map_url(base: str, hash: str) -> str:
+    return base + hash + ".json"
+
+
+def iter_blocks(f, block_size: int) -> Iterable[bytes]:
+    while True:
+        block = f.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+def create_block_map(path: str | PathLike, block_size: int = DEFAULT_BLOCK_SIZE) -> dict:
+    """Hash file block by block
+
+    Args:
+        path (os.PathLike): File, that will be hashed
+        block_size (int, optional): Size of one block. Defaults to DEFAULT_BLOCK_SIZE.
+
+    Returns:
+        dict: Block map of the file
+    """
+
+    with open(path, "rb") as f:
+        blocks = [hashlib.sha256(block).hexdigest()
+                  for block in iter_blocks(f, block_size)]
+
+    return {"block_size": block_size, "size": os.path.getsize(path), "blocks": blocks}
+
+
+def publish(hashtable: str | PathLike, root: str | PathLike, generated: dict[str, dict],
+            block_size: int = DEFAULT_BLOCK_SIZE) -> int:
+    """Write block maps for large files of hashtable, maps of removed content are deleted
+
+    Args:
+        hashtable (os.PathLike): Path of the hashtable
+        root (os.PathLike): Directory, that the hashtable was generated from
+        generated (dict): Content of the hashtable
+        block_size (int, optional): Size of one block. Defaults to DEFAULT_BLOCK_SIZE.
+
+    Returns:
+        int: Number of newly created block maps
+    """
+
+    directory = str(hashtable) + BLOCKS_SUFFIX
+    os.makedirs(directory, exist_ok=True)
+
+    wanted = {entry["hash"]: path for path, entry in generated.items()
+              if entry["size"] >= MIN_SIZE}
+
+    for name in os.listdir(directory):
+        if name.removesuffix(".json") not in wanted:
+            os.remove(os.path.join(directory, name))
+
+    created = 0
+    for hash, path in wanted.items():
+        # Maps are addressed by content, so existing ones are always valid
+        map_path = os.path.join(directory, hash + ".json")
+        if os.path.isfile(map_path):
+            continue
+
+        console.debug(f"Creating block map of {path}")
+        with open(map_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(create_block_map(os.path.join(root, path), block_size),
+                      f, separators=(",", ":"))
+        os.replace(map_path + ".tmp", map_path)
+        created += 1
+
+    return created
+
+
+def plan(file: Path, block_map: dict) -> list[tuple[int, int]]:
+    """Find blocks of local file, that differ from the block map
+
+    Returns:
+        list[tuple[int, int]]: Inclusive byte ranges, that have to be downloaded
+    """
+
+    block_size = block_map["block_size"]
+    blocks = block_map["blocks"]
+
+    with open(file, "rb") as f:
+        local = [hashlib.sha256(block).hexdigest()
+                 for block in iter_blocks(f, block_size)]
+
+    missing = [i for i, hash in enumerate(blocks)
+               if i >= len(local) or local[i] != hash]
+
+    # Merge neighbouring blocks, so that they are fetched in one request
+    ranges: list[tuple[int, int]] = []
+    for i in missing:
+        start = i * block_size
+        end = min(block_map["size"], start + block_size) - 1
+        if ranges and ranges[-1][1] + 1 == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+
+    return ranges
+
+
+def patch_file(file: Path, block_map: dict, verification_hash: str,
+               fetch_range: Callable[[int, int], Iterable[bytes]],
+               phase: ProgressPhase | None = None, algorithm: str = DEFAULT_ALGORITHM,
+               destination: Path | None = None) -> bool:
+    """Update local file by downloading only its changed blocks
+
+    Args:
+        file (Path): Outdated local file
+        block_map (dict): Block map of the new content
+        verification_hash (str): Hash of the new content
+        fetch_range (Callable): Returns content of inclusive byte range of the remote file
+        phase (ProgressPhase, optional): Progress of the download. Defaults to None.
+        algorithm (str, optional): Algorithm of verification_hash. Defaults to DEFAULT_ALGORITHM.
+        destination (Path, optional): File, that receives the new content, instead of file. Defaults to None.
+
+    Raises:
+        PatchError: Assembled file does not match or patching is not worth it
+
+    Returns:
+        bool: True if the file was patched
+    """
+
+    size = block_map["size"]
+    ranges = plan(file, block_map)
+    fetched = sum(end - start + 1 for start, end in ranges)
+
+    if fetched >= size:
+        raise PatchError("All blocks differ")
+
+    destination = destination if destination is not None else file
+    part = Path(str(destination) + PART_SUFFIX)
+    sha = new_hash(algorithm)
+
+    try:
+        with open(file, "rb") as old, open(part, "wb") as new:
+            position = 0
+
+            def copy(end: int) -> None:
+                "Copy unchanged data from the old file up to end (exclusive)"
+                nonlocal position
+                old.seek(position)
+                while position < end:
+                    chunk = old.read(min(CHUNK_SIZE, end - position))
+                    if not chunk:
+                        raise PatchError("Local file changed while patching")
+                    new.write(chunk)
+                    sha.update(chunk)
+                    position += len(chunk)
+
+            for start, end in ranges:
+                copy(start)
+
+                for chunk in fetch_range(start, end):
+                    new.write(chunk)
+                    sha.update(chunk)
+                    position += len(chunk)
+
+                if position != end + 1:
+                    raise PatchError("Unexpected length of range")
+
+            copy(size)
+
+        if sha.hexdigest() != verification_hash:
+            raise PatchError("Patched file failed verification")
+
+        os.replace(part, destination)
+    finally:
+        if part.exists():
+            part.unlink()
+
+    console.info(
+        f"{destination} patched, downloaded {fetched} of {size} bytes")
+
+    if phase is not None:
+        phase.advance(size, destination.name)
+        phase.complete_file(destination.name)
+
+    return True
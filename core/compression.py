@@ -0,0 +1,252 @@
+"""
+Compressed companions of files for smaller transfers
+
+The generator can publish "<hashtable>.z/<file hash>.gz" (or ".zst") with
+the compressed content of every file. Companions are addressed by content
+like block maps, so unchanged files are never compressed again. Files, whose
+companion is not noticeably smaller, are left out and downloaded as they are.
+
+The hashtable records the encoding and compressed size of every file with
+a companion:
+
+    {"path": {"hash": "hex digest", "size": size, "encoding": "zstd", "compressed": size}}
+
+Clients download the companion, decompress it while it is being written and
+verify the result against the hash of the uncompressed file.
+"""
+
+import json
+import logging as console
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from os import PathLike
+
+from core.progress import ProgressReporter
+
+COMPANIONS_SUFFIX = ".z"
+INDEX_FILE = "index.json"
+
+# Order is part of the binary hashtable format, new encodings go to the end
+ENCODINGS = ["gzip", "zstd"]
+EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+LEVELS = {"gzip": 9, "zstd": 10}
+
+# Companions have to save at least this fraction of the file to be recorded
+MIN_SAVING = 0.1
+
+READ_SIZE = 1024 * 1024
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError(
+            "Encoding zstd requires the zstandard package (pip install zstandard)") from None
+    return zstandard
+
+
+@lru_cache
+def available(encoding: str) -> bool:
+    "Check if companions of this encoding can be decompressed"
+
+    try:
+        decompressor(encoding)
+    except ValueError:
+        return False
+    return True
+
+
+def compressor(encoding: str):
+    """Create streaming compressor
+
+    Raises:
+        ValueError: Unknown or unavailable encoding
+
+    Returns:
+        Object with compress() and flush()
+    """
+
+    match encoding:
+        case "gzip":
+            return zlib.compressobj(LEVELS["gzip"], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        case "zstd":
+            return _zstandard().ZstdCompressor(level=LEVELS["zstd"]).compressobj()
+        case _:
+            raise ValueError(f"Unknown encoding: {encoding}")
+
+
+def decompressor(encoding: str):
+    """Create streaming decompressor
+
+    Raises:
+        ValueError: Unknown or unavailable encoding
+
+    Returns:
+        Object with decompress()
+    """
+
+    match encoding:
+        case "gzip":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        case "zstd":
+            return _zstandard().ZstdDecompressor().decompressobj()
+        case _:
+            raise ValueError(f"Unknown encoding: {encoding}")
+
+
+def companion_url(base: str, hash: str, encoding: str) -> str:
+    return base + hash + EXTENSIONS[encoding]
+
+
+def wire_size(entry: dict) -> int:
+    "Number of bytes transferred for entry, if its companion is used whenever possible"
+
+    if "compressed" in entry and available(entry["encoding"]):
+        return entry["compressed"]
+    return entry["size"]
+
+
+class Decoder():
+    """
+    Decompresses companion while it is being downloaded
+
+    Args:
+        encoding (str): Encoding of the companion
+        size (int): Size of the uncompressed file, more output is an error
+    """
+
+    def __init__(self, encoding: str, size: int):
+        self.decompressor = decompressor(encoding)
+        self.error = _zstandard().ZstdError if encoding == "zstd" else zlib.error
+        self.size = size
+        self.written = 0
+
+    def decode(self, data: bytes) -> bytes:
+        """Decompress next chunk of the companion
+
+        Raises:
+            ValueError: Companion is corrupted
+        """
+
+        try:
+            out = self.decompressor.decompress(data)
+        except self.error as e:
+            raise ValueError(f"Corrupted companion: {e}") from None
+
+        self.written += len(out)
+        if self.written > self.size:
+            raise ValueError("Companion is larger than the file")
+        return out
+
+
+def compress_file(source: str | PathLike, destination: str | PathLike, encoding: str) -> int:
+    """Write compressed copy of file
+
+    Returns:
+        int: Size of the compressed copy
+    """
+
+    packer = compressor(encoding)
+    size = 0
+
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        while data := src.read(READ_SIZE):
+            size += dst.write(packer.compress(data))
+        size += dst.write(packer.flush())
+
+    return size
+
+
+def publish(hashtable: str | PathLike, root: str | PathLike, generated: dict[str, dict], encoding: str,
+            jobs: int = 1, progress: ProgressReporter | None = None) -> int:
+    """Write companions of files and record them in the generated hashtable
+
+    Companions of content, that is no longer in the hashtable, are deleted.
+
+    Args:
+        hashtable (os.PathLike): Path of the hashtable
+        root (os.PathLike): Directory, that the hashtable was generated from
+        generated (dict): Content of the hashtable, entries are updated in place
+        encoding (str): One of ENCODINGS
+        jobs (int, optional): Number of files compressed in parallel. Defaults to 1.
+        progress (ProgressReporter, optional): Shared progress display of the run. Defaults to a new one.
+
+    Returns:
+        int: Number of newly compressed files
+    """
+
+    compressor(encoding)  # Fail early if the encoding is not available
+
+    directory = str(hashtable) + COMPANIONS_SUFFIX
+    os.makedirs(directory, exist_ok=True)
+    extension = EXTENSIONS[encoding]
+    progress = progress if progress is not None else ProgressReporter()
+
+    # Compressed sizes by hash, 0 for content, that does not compress well
+    index_path = os.path.join(directory, INDEX_FILE)
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get("encoding") != encoding:
+            index = {}
+    except (FileNotFoundError, ValueError):
+        index = {}
+    sizes: dict[str, int] = index.get("sizes", {})
+
+    wanted = {entry["hash"]: path for path, entry in generated.items()}
+
+    for name in os.listdir(directory):
+        if name != INDEX_FILE and (not name.endswith(extension) or name.removesuffix(extension) not in wanted):
+            os.remove(os.path.join(directory, name))
+
+    def is_valid(hash: str) -> bool:
+        if hash not in sizes:
+            return False
+        if sizes[hash] == 0:
+            return True
+        return os.path.isfile(os.path.join(directory, hash + extension))
+
+    sizes = {hash: size for hash, size in sizes.items() if hash in wanted}
+    pending = [hash for hash in wanted if not is_valid(hash)]
+
+    def compress(hash: str) -> None:
+        path = wanted[hash]
+        companion = os.path.join(directory, hash + extension)
+        console.debug(f"Compressing {path}")
+
+        size = compress_file(os.path.join(root, path), companion + ".tmp", encoding)
+        original = generated[path]["size"]
+
+        if size <= original * (1 - MIN_SAVING):
+            os.replace(companion + ".tmp", companion)
+            sizes[hash] = size
+        else:
+            os.remove(companion + ".tmp")
+            sizes[hash] = 0
+
+        phase.advance(original, os.path.basename(path))
+        phase.complete_file(os.path.basename(path))
+
+    total = sum(generated[wanted[hash]]["size"] for hash in pending)
+    with progress.phase("[bold yellow]C", total, len(pending)) as phase, \
+            ThreadPoolExecutor(max(1, jobs)) as pool:
+        # zlib and zstandard release the GIL, so threads compress in parallel
+        for future in [pool.submit(compress, hash) for hash in pending]:
+            future.result()
+
+    for path, entry in generated.items():
+        entry.pop("encoding", None)
+        entry.pop("compressed", None)
+        if sizes.get(entry["hash"]):
+            entry["encoding"] = encoding
+            entry["compressed"] = sizes[entry["hash"]]
+
+    tmp = index_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"encoding": encoding, "sizes": sizes}, f, separators=(",", ":"))
+    os.replace(tmp, index_path)
+
+    return len(pending)
@@ -0,0 +1,194 @@
+"""
+Versioned hashtables with delta patches
+
+Next to a versioned hashtable "<hashtable>" lives a directory
+"<hashtable>.d" with:
+
+index.json - {"version": N, "oldest": M, "digest": "manifest digest"}
+<n>.json   - delta from version n - 1 to n for every n in M..N
+             {"from": n - 1, "to": n, "changed": {path: entry}, "removed": [path]}
+
+Clients remember the last hashtable they have seen under the destination
+and only download the deltas, that they are missing.
+"""
+
+import hashlib
+import json
+import logging as console
+import os
+import shutil
+from os import PathLike
+
+from core import manifest
+from core.hash_cache import STATE_DIRECTORY
+from core.hashing import DEFAULT_ALGORITHM
+
+DELTA_SUFFIX = ".d"
+INDEX_FILE = "index.json"
+
+STATE_MANIFEST = "manifest.bin"
+STATE_INFO = "manifest.json"
+
+
+def index_url(url: str) -> str:
+    return url + DELTA_SUFFIX + "/" + INDEX_FILE
+
+
+def delta_url(url: str, version: int) -> str:
+    return url + DELTA_SUFFIX + "/" + f"{version}.json"
+
+
+def digest(hashtable: dict[str, dict]) -> str:
+    "Digest of hashtable content, independent of the format and order of entries"
+
+    sha = hashlib.sha256()
+
+    algorithm = manifest.algorithm_of(hashtable)
+    if algorithm != DEFAULT_ALGORITHM:
+        sha.update(f"\0algorithm\0{algorithm}\n".encode("utf-8"))
+
+    for path in sorted(hashtable):
+        entry = hashtable[path]
+        line = f"{path}\0{entry['hash']}\0{entry['size']}"
+        if "compressed" in entry:
+            line += f"\0{entry['encoding']}\0{entry['compressed']}"
+        sha.update(f"{line}\n".encode("utf-8"))
+
+    return sha.hexdigest()
+
+
+def diff(old: dict[str, dict], new: dict[str, dict]) -> dict:
+    """Compute changes between two hashtables
+
+    Returns:
+        >>> {
+        >>>     "changed": {"filename": {'hash': 'hash', 'size': 'size'}},
+        >>>     "removed": ["filename"]
+        >>> }
+    """
+
+    return {
+        "changed": {path: entry for path, entry in new.items() if old.get(path) != entry},
+        "removed": sorted(path for path in old if path not in new),
+    }
+
+
+def apply(hashtable: dict[str, dict], delta: dict) -> None:
+    "Apply delta to hashtable in place"
+
+    for path in delta["removed"]:
+        hashtable.pop(path, None)
+
+    hashtable.update(delta["changed"])
+
+
+def publish(hashtable: str | PathLike, previous: dict[str, dict] | None, generated: dict[str, dict], keep: int = 100) -> int:
+    """Write delta against the previous version of hashtable and update the index
+
+    Args:
+        hashtable (os.PathLike): Path of the (already written) hashtable
+        previous (dict | None): Previous content of the hashtable, None starts new history
+        generated (dict): New content of the hashtable
+        keep (int, optional): Number of deltas, that are kept. Defaults to 100.
+
+    Returns:
+        int: New version of the hashtable
+    """
+
+    directory = str(hashtable) + DELTA_SUFFIX
+    index_path = os.path.join(directory, INDEX_FILE)
+
+    index = None
+    if previous is not None:
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    if index is None or index.get("digest") != digest(previous) or \
+            manifest.algorithm_of(previous) != manifest.algorithm_of(generated):  # type: ignore
+        # History is unknown, the hashtable was modified by something else or
+        # all hashes changed with the algorithm
+        console.info("Starting new history of hashtable versions")
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        index = {"version": 1, "oldest": 2}
+    else:
+        version = index["version"] + 1
+        with open(os.path.join(directory, f"{version}.json"), "w", encoding="utf-8") as f:
+            json.dump({"from": index["version"], "to": version, **diff(previous, generated)},  # type: ignore
+                      f, ensure_ascii=False, separators=(",", ":"))
+
+        index["version"] = version
+
+        # Drop the oldest deltas, clients that need them download whole hashtable
+        while index["version"] - index["oldest"] + 1 > keep:
+            try:
+                os.remove(os.path.join(directory, f"{index['oldest']}.json"))
+            except FileNotFoundError:
+                pass
+            index["oldest"] += 1
+
+    index["digest"] = digest(generated)
+
+    tmp = index_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(tmp, index_path)
+
+    console.info(f"Hashtable version: {index['version']}")
+
+    return index["version"]
+
+
+class ManifestState():
+    """
+    Copy of the last known remote hashtable kept under the destination
+
+    Args:
+        root (os.PathLike): Destination directory
+    """
+
+    def __init__(self, root: str | PathLike = "."):
+        self.directory = os.path.join(root, STATE_DIRECTORY)
+        self.manifest = os.path.join(self.directory, STATE_MANIFEST)
+        self.info = os.path.join(self.directory, STATE_INFO)
+
+    def load(self, url: str) -> tuple[int, str, dict[str, dict]] | None:
+        """Load stored hashtable if it was downloaded from the same URL
+
+        Returns:
+            tuple[int, str, dict] | None: Version, digest and content of the hashtable
+        """
+
+        try:
+            with open(self.info, "r", encoding="utf-8") as f:
+                info = json.load(f)
+
+            if info["url"] != url:
+                return None
+
+            with open(self.manifest, "rb") as f:
+                hashtable = manifest.load(f)
+        except (OSError, ValueError, KeyError):
+            return None
+
+        if digest(hashtable) != info["digest"]:
+            console.warning("Stored hashtable is corrupted, ignoring")
+            return None
+
+        return info["version"], info["digest"], hashtable
+
+    def save(self, url: str, version: int, hashtable: dict[str, dict]) -> None:
+        "Remember hashtable and its version"
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        manifest.dump(hashtable, self.manifest + ".tmp", "binary")
+        os.replace(self.manifest + ".tmp", self.manifest)
+
+        with open(self.info + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"url": url, "version": version,
+                      "digest": digest(hashtable)}, f)
+        os.replace(self.info + ".tmp", self.info)
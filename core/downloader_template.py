@@ -1,12 +1,338 @@
 import abc
+import logging as console
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import partial
+from os import PathLike
+from pathlib import Path
+from typing import Callable, Iterable
+
+from core import blocks, compression
+from core.events import FileDownloaded, FileFailed, UpdateEvent
+from core.hashing import DEFAULT_ALGORITHM, hash_file, new_hash
+from core.mirrors import Mirror, MirrorPool, Retry, Transfer
+from core.progress import ProgressPhase, ProgressReporter
+from core.staging import Stage
+
+# Downloads submitted to a worker pool ahead of the running ones, per connection
+QUEUED_PER_CONNECTION = 1
+
+# Seconds to wait for a connection or for the next data from a mirror, silent mirror fails the attempt
+TIMEOUT = 30.0
+
+
+class VerificationError(Exception):
+    "Downloaded file does not match its hashtable entry"
+
+
+class DownloadCancelled(Exception):
+    "Download was stopped through done_event, the partial file is left to the next update"
 
 
 class DownloaderBase(metaclass=abc.ABCMeta):
-    "Base downloader class, needs to be extended"
+    """
+    Base downloader class, needs to be extended
 
-    @abc.abstractmethod
-    def download(self, compared: tuple[dict[str, dict[str, int]], int], dest_dir: str) -> None:
-        raise NotImplemented
+    Args:
+        progress (ProgressReporter, optional): Shared progress display of the run. Defaults to a new one.
+        block_maps_url (str, optional): URL of block maps, large files are patched instead of downloaded when set. Defaults to None.
+        algorithm (str, optional): Hash algorithm of the hashtable, used to verify downloaded files. Defaults to DEFAULT_ALGORITHM.
+        companions_path (str, optional): Path of compressed companions relative to the mirror root, they are downloaded instead of files, that have them. Defaults to None.
+        stage (Stage, optional): Staging area, that the files are downloaded into, verified files are recorded in its journal. Defaults to None.
+    """
+
+    # Errors, after which the file is retried on another mirror, timeouts of silent mirrors included
+    transient_errors: tuple[type[BaseException], ...] = (OSError, TimeoutError, VerificationError, blocks.PatchError)
+
+    def __init__(self, progress: ProgressReporter | None = None, block_maps_url: str | None = None,
+                 algorithm: str = DEFAULT_ALGORITHM, companions_path: str | None = None,
+                 stage: Stage | None = None) -> None:
+        self.progress = progress if progress is not None else ProgressReporter()
+        self.block_maps_url = block_maps_url
+        self.algorithm = algorithm
+        self.companions_path = companions_path
+        self.stage = stage
+        # Called with FileDownloaded or FileFailed of every file, from the thread, that downloaded it
+        self.listener: Callable[[UpdateEvent], None] | None = None
+        # Stops the downloads when set, no more files are started and download_stream raises KeyboardInterrupt
+        self.done_event = threading.Event()
+        # Seconds to wait for a connection or for data of every request
+        self.timeout = TIMEOUT
+
+    def patch_source(self, file: str | PathLike) -> Path | None:
+        "Local file, that can be patched into file, staged files are patched from the destination"
+
+        file = Path(file)
+        if file.exists():
+            return file
+
+        original = self.stage.original(file) if self.stage is not None else None
+        if original is not None and original.exists():
+            return original
+
+        return None
+
+    def staged(self, path: str, entry: dict) -> None:
+        "Record downloaded file in the journal of the staging area and report it to the listener"
+
+        if self.stage is not None:
+            self.stage.record(path, entry["hash"], self.algorithm, entry["size"])
+        if self.listener is not None:
+            self.listener(FileDownloaded(path, entry))
+
+    def report_failure(self, path: str, entry: dict, error: BaseException) -> None:
+        "Report file, that could not be downloaded, to the listener"
+
+        if self.listener is not None:
+            self.listener(FileFailed(path, entry, error))
+
+    def companion(self, entry: dict, mirror: str = "") -> tuple[str, str] | None:
+        "URL on mirror and encoding of compressed companion of entry, None if the file is downloaded as it is"
+
+        if self.companions_path is None or "compressed" not in entry or not compression.available(entry["encoding"]):
+            return None
+
+        return compression.companion_url(mirror + self.companions_path, entry["hash"], entry["encoding"]), entry["encoding"]
+
+    def wire_size(self, entry: dict) -> int:
+        "Number of bytes transferred for entry"
+
+        return entry["compressed"] if self.companion(entry) is not None else entry["size"]
+
+    def decompress_into(self, chunks: Iterable[bytes], file: Path, encoding: str, file_size: int,
+                        verification_hash: str, phase: ProgressPhase) -> bool:
+        """Write decompressed companion into file and verify it
+
+        Args:
+            chunks (Iterable[bytes]): Content of the companion as it is received
+            file (Path): Destination file
+            encoding (str): Encoding of the companion
+            file_size (int): Size of the uncompressed file
+            verification_hash (str): Hash of the uncompressed file
+            phase (ProgressPhase): Progress of the downloads, advanced by the received bytes
+
+        Returns:
+            bool: False if the companion is corrupted and the file has to be downloaded as it is
+        """
+
+        decoder = compression.Decoder(encoding, file_size)
+        sha = new_hash(self.algorithm)
+
+        try:
+            with open(file, "wb") as f:
+                for chunk in chunks:
+                    data = decoder.decode(chunk)
+                    f.write(data)
+                    sha.update(data)
+                    phase.advance(len(chunk), file.name)
+        except ValueError as e:
+            console.warning(f"{file} can not be decompressed ({e}), downloading whole file.")
+            return False
+
+        if sha.hexdigest() != verification_hash:
+            console.warning(f"{file} companion failed verification, downloading whole file.")
+            return False
+
+        phase.complete_file(file.name)
+        return True
+
+    def segments(self, mirrors: MirrorPool, file: str | PathLike, entry: dict) -> list[tuple[int, int]] | None:
+        "Segments of file, that are downloaded from all mirrors at once, None if it comes from one mirror"
+
+        if self.companion(entry) is not None or self.patch_source(file) is not None:
+            return None
+
+        return mirrors.segments(entry["size"])
+
+    def fetch(self, mirrors: MirrorPool, path: str, file: str | PathLike, entry: dict, phase: ProgressPhase) -> None:
+        """Download file from the best mirror, failed or corrupted downloads are retried on other mirrors
+
+        Args:
+            mirrors (MirrorPool): Mirrors of the update
+            path (str): Path of the file relative to the mirror root
+            file (os.PathLike): Destination file
+            entry (dict): Hashtable entry of the file
+            phase (ProgressPhase): Progress of the downloads
+        """
+
+        segments = self.segments(mirrors, file, entry)
+        if segments is not None:
+            try:
+                self.download_split(mirrors, path, Path(file), entry, phase, segments, self.fetch_range)
+                return self.staged(path, entry)
+            except self.transient_errors as e:
+                console.warning(f"{path} could not be split across mirrors ({e}), downloading from one mirror")
+
+        retry = Retry(mirrors, path, entry["size"])
+        while True:
+            mirror, transfer = retry.start(phase)
+
+            try:
+                # Companion comes from the same mirror, so the transfer is credited to the one, that served it
+                self.download_url(mirror.url + path, Path(file), entry, transfer,  # type: ignore
+                                  self.companion(entry, mirror.url))
+            except self.transient_errors as e:
+                time.sleep(retry.failed(e))
+                continue
+
+            retry.succeeded()
+            return self.staged(path, entry)
+
+    def download_url(self, url: str, file: Path, entry: dict, phase: ProgressPhase,
+                     companion: tuple[str, str] | None = None) -> None:
+        """Download file from url once, threaded downloaders implement it
+
+        Args:
+            url (str): URL of the file on the selected mirror
+            file (Path): Destination file
+            entry (dict): Hashtable entry of the file
+            phase (ProgressPhase): Progress of this attempt
+            companion (tuple[str, str], optional): URL on the same mirror and encoding of compressed companion. Defaults to None.
+
+        Raises:
+            transient_errors: The file should be retried on another mirror
+        """
+
+        raise NotImplementedError
+
+    def fetch_range(self, url: str, start: int, end: int) -> Iterable[bytes]:
+        "Stream bytes between start and end (inclusive) of url, threaded downloaders implement it"
+
+        raise NotImplementedError
+
+    def download_split(self, mirrors: MirrorPool, path: str, file: Path, entry: dict, phase: ProgressPhase,
+                       segments: list[tuple[int, int]], fetch_range: Callable[[str, int, int], Iterable[bytes]]) -> None:
+        """Download segments of large file from all available mirrors at once
+
+        Every mirror takes the next segment as soon as it finished the previous one,
+        so faster mirrors download more of the file. Segments of a failed mirror
+        are taken over by the others.
+
+        Raises:
+            VerificationError: File could not be assembled or does not match its hash
+        """
+
+        pending = deque(segments)
+        lock = threading.Lock()
+        # Progress of all segments, taken back if the file can not be assembled
+        split = Transfer(phase)
+
+        file.parent.mkdir(parents=True, exist_ok=True)
+        with open(file, "wb") as f:
+            f.truncate(entry["size"])
+
+        def worker(mirror: Mirror) -> None:
+            with open(file, "r+b") as f:
+                while True:
+                    with lock:
+                        if not pending:
+                            return
+                        start, end = pending.popleft()
+
+                    mirrors.use(mirror)
+                    transfer = Transfer(split)
+                    try:
+                        f.seek(start)
+                        position = start
+                        for chunk in fetch_range(mirror.url + path, start, end):
+                            f.write(chunk)
+                            position += len(chunk)
+                            transfer.advance(len(chunk), file.name)
+                        if position != end + 1:
+                            raise VerificationError("Unexpected length of range")
+                    except self.transient_errors as e:
+                        mirrors.fail(mirror, transfer, set())
+                        with lock:
+                            pending.append((start, end))
+                        console.warning(f"Segment {start}-{end} of {path} failed on {mirror.url} ({e})")
+                        return
+
+                    mirrors.release(mirror, transfer)
+
+        workers = [threading.Thread(target=worker, args=(mirror,), daemon=True)
+                   for mirror in mirrors.available()]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        if pending or hash_file(file, algorithm=self.algorithm) != entry["hash"]:
+            split.rollback()
+            file.unlink()
+            raise VerificationError("Segments from mirrors do not match the hash")
+
+        phase.complete_file(file.name)
+
+    def download(self, compared: dict[str, dict[str, int]], mirror: str | list[str] | MirrorPool,
+                 dest_dir: str | PathLike) -> None:
+        "Download files from remote repository."
+
+        total = sum(self.wire_size(compared[item]) for item in compared)
+
+        with self.progress.phase("[bold green]D", total, len(compared)) as phase:
+            self.download_stream(compared.items(), mirror, dest_dir, phase)
+
+    def download_stream(self, items: Iterable[tuple[str, dict]], mirror: str | list[str] | MirrorPool,
+                        dest_dir: str | PathLike, phase: ProgressPhase) -> None:
+        """Download files as they are produced by items
+
+        Files are fetched by a pool of self.connections threads. Items are taken
+        only as fast as they are downloaded, so a slow producer is not waited
+        for and a stopped one does not leave a backlog.
+
+        Args:
+            items (Iterable[tuple[str, dict]]): Relative paths and hashtable entries, iteration may block until more files are known
+            mirror (str | list[str] | MirrorPool): URLs, that will be used as root for downloading, files are spread across them
+            dest_dir (os.PathLike): Destination directory
+            phase (ProgressPhase): Progress of the downloads, the producer of items keeps its total up to date
+        """
+
+        mirrors = MirrorPool.of(mirror)
+        failed: list[Future] = []
+
+        # Finished futures are dropped, so only the downloads in flight are kept
+        slots = threading.BoundedSemaphore((1 + QUEUED_PER_CONNECTION) * self.connections)  # type: ignore
+        running: set[Future] = set()
+
+        def check(path: str, entry: dict, future: Future) -> None:
+            running.discard(future)
+            slots.release()
+            if not future.cancelled() and future.exception() is not None:
+                failed.append(future)
+                self.report_failure(path, entry, future.exception())  # type: ignore
+
+        with ThreadPoolExecutor(max_workers=self.connections) as pool:  # type: ignore
+            try:
+                for path, entry in items:
+                    slots.acquire()
+
+                    # Stop producing work as soon as any download fails or the downloads are stopped
+                    if failed or self.done_event.is_set():
+                        slots.release()
+                        break
+
+                    future = pool.submit(self.fetch, mirrors, path, os.path.join(dest_dir, path), entry, phase)
+                    running.add(future)
+                    future.add_done_callback(partial(check, path, entry))
+
+                for future in as_completed(list(running)):
+                    future.result()
+                if failed:
+                    failed[0].result()
+            except BaseException:
+                # Do not start any new downloads after the first failure
+                pool.shutdown(cancel_futures=True)
+                if not self.done_event.is_set():
+                    raise
+
+        mirrors.report()
+
+        # Interrupted downloads must not be committed
+        if self.done_event.is_set():
+            raise KeyboardInterrupt
 
     @property
     @abc.abstractmethod
@@ -0,0 +1,117 @@
+"""
+Events of an update, yielded by Updater.events() and Updater.aevents()
+
+Launchers, that embed the updater, follow the update file by file instead of
+parsing its log:
+
+    for event in updater.events(mirror, hashtable):
+        if isinstance(event, FileDownloaded):
+            window.set_status(f"Downloaded {event.path}")
+
+Every event of a single file carries its path relative to the destination,
+events of the whole update have path None.
+"""
+
+
+class UpdateEvent():
+    """
+    Base of all events of an update
+
+    Args:
+        path (str, optional): Path of the file relative to the destination. Defaults to None.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={value!r}" for name, value in vars(self).items())
+        return f"{type(self).__name__}({fields})"
+
+
+class FileChecked(UpdateEvent):
+    """
+    Local file was compared to its hashtable entry
+
+    Args:
+        path (str): Path of the file relative to the destination
+        entry (dict): Hashtable entry of the file
+        reason (str, optional): Why the file is updated, "missing", "size" or "modified", None if it is up to date
+    """
+
+    def __init__(self, path: str, entry: dict, reason: str | None = None):
+        super().__init__(path)
+        self.entry = entry
+        self.reason = reason
+
+    @property
+    def stale(self) -> bool:
+        return self.reason is not None
+
+
+class FileDownloaded(UpdateEvent):
+    """
+    File was downloaded, verified and staged
+
+    Args:
+        path (str): Path of the file relative to the destination
+        entry (dict): Hashtable entry of the file
+        resumed (bool, optional): File was staged by an interrupted update and not downloaded again. Defaults to False.
+    """
+
+    def __init__(self, path: str, entry: dict, resumed: bool = False):
+        super().__init__(path)
+        self.entry = entry
+        self.resumed = resumed
+
+
+class FileFailed(UpdateEvent):
+    """
+    File could not be downloaded, the update stops without applying anything
+
+    Args:
+        path (str): Path of the file relative to the destination
+        entry (dict): Hashtable entry of the file
+        error (BaseException): Why the download failed, DownloadCancelled if the downloads were stopped
+    """
+
+    def __init__(self, path: str, entry: dict, error: BaseException):
+        super().__init__(path)
+        self.entry = entry
+        self.error = error
+
+
+class FileCopied(UpdateEvent):
+    """
+    File was staged as a copy of another file with the same content
+
+    Args:
+        path (str): Path of the file relative to the destination
+        source (str): Path of the copied file relative to the destination
+    """
+
+    def __init__(self, path: str, source: str):
+        super().__init__(path)
+        self.source = source
+
+
+class FileRemoved(UpdateEvent):
+    "File outside of the hashtable was removed from the destination"
+
+
+class UpdateApplied(UpdateEvent):
+    """
+    Staged files were moved into the destination, the update is finished
+
+    Args:
+        files (int): Number of files moved into the destination
+        removed (int): Number of removed files
+        seconds (float): Duration of applying the update
+    """
+
+    def __init__(self, files: int, removed: int, seconds: float):
+        super().__init__()
+        self.files = files
+        self.removed = removed
+        self.seconds = seconds
+
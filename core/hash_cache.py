@@ -0,0 +1,260 @@
+import json
+import logging as console
+import os
+import time
+from os import PathLike
+from pathlib import Path
+
+from core.hashing import DEFAULT_ALGORITHM
+
+# Directory (relative to the destination) that holds updater's local state
+STATE_DIRECTORY = ".updater"
+CACHE_FILE = "hashcache.json"
+CACHE_VERSION = 2
+RECORD_FILE = "update.json"
+# Stat signatures of the files of a generated hashtable, kept next to it,
+# so that the next generation can tell, which of its entries are still valid
+SIGNATURES_SUFFIX = ".stat"
+
+# Files modified this recently are not cached, their mtime could still change
+# within the timestamp granularity of the filesystem without us noticing
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+
+class HashCache():
+    """
+    Persistent cache of file hashes keyed by their stat signature
+
+    Args:
+        root (os.PathLike): Directory, that the cached paths are relative to
+        rehash (bool, optional): Ignore stored entries and hash everything again. Defaults to False.
+    """
+
+    def __init__(self, root: str | PathLike = ".", rehash: bool = False):
+        self.root = root
+        self.file = os.path.join(root, STATE_DIRECTORY, CACHE_FILE)
+        self.entries: dict[str, list] = {}
+        self.dirty = False
+
+        if not rehash:
+            self.load()
+
+    @staticmethod
+    def signature(stat: os.stat_result) -> list[int]:
+        "Values, that must stay the same for the cached hash to be valid"
+
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def get(self, relative_path: str, stat: os.stat_result, algorithm: str = DEFAULT_ALGORITHM) -> str | None:
+        """Get cached hash of file
+
+        Args:
+            relative_path (str): Path relative to root
+            stat (os.stat_result): Current stat of the file
+            algorithm (str, optional): Algorithm of the requested hash. Defaults to DEFAULT_ALGORITHM.
+
+        Returns:
+            str | None: Hash if the file is unchanged since it was cached, None otherwise
+        """
+
+        entry = self.entries.get(relative_path)
+        if entry is None:
+            return None
+
+        if entry[:3] != self.signature(stat):
+            console.debug(f"Hash cache - invalidating: {relative_path}")
+            del self.entries[relative_path]
+            self.dirty = True
+            return None
+
+        if entry[4] != algorithm:
+            return None
+
+        return entry[3]
+
+    def set(self, relative_path: str, stat: os.stat_result, hash: str, algorithm: str = DEFAULT_ALGORITHM) -> None:
+        "Store hash of file, that was just computed from its content"
+
+        if time.time_ns() - stat.st_mtime_ns < RACY_WINDOW_NS:
+            console.debug(f"Hash cache - recently modified, not caching: {relative_path}")
+            self.entries.pop(relative_path, None)
+            return
+
+        self.entries[relative_path] = self.signature(stat) + [hash, algorithm]
+        self.dirty = True
+
+    def load(self) -> None:
+        "Load cache from disk, broken or outdated cache is ignored"
+
+        try:
+            with open(self.file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+
+            if data.get("version") == 1:
+                # Version 1 had only SHA-256 hashes
+                self.entries = {path: entry + [DEFAULT_ALGORITHM]
+                                for path, entry in data["entries"].items()}
+                self.dirty = True
+            elif data.get("version") != CACHE_VERSION:
+                console.debug("Hash cache - version mismatch, ignoring")
+                return
+            else:
+                self.entries = dict(data["entries"])
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError, AttributeError):
+            console.warning(f"Hash cache is corrupted, ignoring: {self.file}")
+
+        console.debug(f"Hash cache - loaded {len(self.entries)} entries")
+
+    def save(self) -> None:
+        "Atomically write cache to disk if it changed"
+
+        if not self.dirty:
+            return
+
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+
+        tmp = self.file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": CACHE_VERSION, "entries": self.entries},
+                      f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, self.file)
+
+        self.dirty = False
+        console.debug(f"Hash cache - saved {len(self.entries)} entries")
+
+
+def base_signature(stat: os.stat_result) -> list[int]:
+    "Values, that must stay the same for an entry of the base hashtable to be reused"
+
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns]
+
+
+def dump_signatures(hashtable: str | PathLike, stats: dict[str, os.stat_result], start: int) -> None:
+    """Write stat signatures of hashed files next to the hashtable
+
+    Args:
+        hashtable (os.PathLike): Generated hashtable
+        stats (dict): Stats of its files taken before hashing
+        start (int): Time (ns) when the generation started, files modified around it are left out
+    """
+
+    signatures = {path: base_signature(stat) for path, stat in stats.items()
+                  if max(stat.st_mtime_ns, stat.st_ctime_ns) < start - RACY_WINDOW_NS}
+
+    file = str(hashtable) + SIGNATURES_SUFFIX
+    tmp = file + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"version": CACHE_VERSION, "entries": signatures},
+                  f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, file)
+
+
+def load_signatures(hashtable: str | PathLike) -> dict[str, list[int]]:
+    "Stat signatures written next to the hashtable, missing or broken ones are empty"
+
+    file = str(hashtable) + SIGNATURES_SUFFIX
+    try:
+        with open(file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        if data.get("version") == CACHE_VERSION:
+            return dict(data["entries"])
+    except FileNotFoundError:
+        console.debug(f"No stat signatures of {hashtable}, its entries are not reused")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        console.warning(f"Stat signatures are corrupted, ignoring: {file}")
+
+    return {}
+
+
+class UpdateRecord():
+    """
+    Sizes and mtimes of files right after the last successful update
+
+    Unlike the hash cache, the record also covers freshly downloaded files,
+    that were verified while downloading, and it ignores inode numbers.
+    It is only trusted with --trust-mtime, as tools preserving mtimes can
+    change a file without anyone noticing.
+
+    Args:
+        root (os.PathLike): Directory, that the recorded paths are relative to
+    """
+
+    def __init__(self, root: str | PathLike = "."):
+        self.root = root
+        self.file = os.path.join(root, STATE_DIRECTORY, RECORD_FILE)
+        self.entries: dict[str, list] = {}
+        self.algorithm = DEFAULT_ALGORITHM
+        self.loaded = False
+
+    def get(self, relative_path: str, stat: os.stat_result, algorithm: str = DEFAULT_ALGORITHM) -> str | None:
+        """Get hash of file recorded after the last update
+
+        Args:
+            relative_path (str): Path relative to root
+            stat (os.stat_result): Current stat of the file
+            algorithm (str, optional): Algorithm of the requested hash. Defaults to DEFAULT_ALGORITHM.
+
+        Returns:
+            str | None: Hash if size and mtime did not change since the update, None otherwise
+        """
+
+        if not self.loaded:
+            self.load()
+
+        if algorithm != self.algorithm:
+            return None
+
+        entry = self.entries.get(relative_path)
+        if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+            return None
+
+        return entry[2]
+
+    def load(self) -> None:
+        "Load record from disk, broken or outdated record is ignored"
+
+        self.loaded = True
+        try:
+            with open(self.file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+
+            if data.get("version") == CACHE_VERSION:
+                self.entries = dict(data["entries"])
+                self.algorithm = data["algorithm"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError, AttributeError):
+            console.warning(f"Update record is corrupted, ignoring: {self.file}")
+
+    def save(self, hashtable: dict[str, dict], algorithm: str = DEFAULT_ALGORITHM) -> None:
+        """Record current state of files, that match hashtable after an update
+
+        Args:
+            hashtable (dict): Hashtable, that the destination was updated to
+            algorithm (str, optional): Algorithm of the hashes in hashtable. Defaults to DEFAULT_ALGORITHM.
+        """
+
+        self.entries = {}
+        self.algorithm = algorithm
+        for path, entry in hashtable.items():
+            path = Path(os.path.normpath(path)).as_posix()
+            try:
+                stat = os.stat(os.path.join(self.root, path))
+            except FileNotFoundError:
+                continue
+
+            if stat.st_size == entry["size"]:
+                self.entries[path] = [stat.st_size, stat.st_mtime_ns, entry["hash"]]
+
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+
+        tmp = self.file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": CACHE_VERSION, "algorithm": algorithm, "entries": self.entries},
+                      f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, self.file)
+
+        console.debug(f"Update record - saved {len(self.entries)} entries")
@@ -0,0 +1,255 @@
+import hashlib
+import io
+import logging as console
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator
+
+from core.progress import ProgressReporter
+
+# 1MB so that memory is not exhausted
+CHUNK_SIZE = 1000 * 1000
+
+# Trees with at least this many files, that are smaller than SMALL_FILE_SIZE
+# on average, are dominated by per-file overhead and get hashed in processes
+PROCESS_POOL_MIN_FILES = 256
+SMALL_FILE_SIZE = 256 * 1024
+
+# Files are read into one reused buffer per thread instead of allocating a
+# new bytes object for every chunk, the buffer is sized to the file within
+# these bounds
+MIN_BUFFER_SIZE = 64 * 1024
+MAX_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Hash algorithms, that a hashtable can declare. xxh3 is a fast
+# non-cryptographic checksum, it detects changes, but it does not protect
+# against deliberately crafted content. It needs the optional xxhash package.
+DEFAULT_ALGORITHM = "sha256"
+ALGORITHMS = ["sha256", "blake2b", "xxh3"]
+
+_local = threading.local()
+
+
+def new_hash(algorithm: str = DEFAULT_ALGORITHM) -> "hashlib._Hash":
+    """Create hash object of the given algorithm
+
+    Args:
+        algorithm (str, optional): One of ALGORITHMS. Defaults to DEFAULT_ALGORITHM.
+
+    Raises:
+        ValueError: Unknown or unavailable algorithm
+
+    Returns:
+        hashlib._Hash: Object with update() and hexdigest()
+    """
+
+    match algorithm:
+        case "sha256":
+            return hashlib.sha256()
+        case "blake2b":
+            # Same digest size as SHA-256, so hashtables stay the same size
+            return hashlib.blake2b(digest_size=32)
+        case "xxh3":
+            try:
+                import xxhash
+            except ImportError:
+                raise ValueError(
+                    "Hash algorithm xxh3 requires the xxhash package (pip install xxhash)") from None
+            return xxhash.xxh3_128()  # type: ignore
+        case _:
+            raise ValueError(f"Unknown hash algorithm: {algorithm}")
+
+
+def buffer_size(size: int | None) -> int:
+    "Size of read buffer for a file of the given size, small files are read by a single call"
+
+    if size is None:
+        return MAX_BUFFER_SIZE
+
+    return max(MIN_BUFFER_SIZE, min(MAX_BUFFER_SIZE, size))
+
+
+def get_buffer(size: int) -> memoryview:
+    "Read buffer of the current thread, reused by every file hashed in it"
+
+    buffer = getattr(_local, "buffer", None)
+    if buffer is None or len(buffer) < size:
+        buffer = _local.buffer = memoryview(bytearray(size))
+
+    return buffer[:size]
+
+
+def hash_stream(f: BinaryIO, sha: "hashlib._Hash", length: int | None = None,
+                progress: Callable[[int], None] | None = None) -> int:
+    """Feed content of opened file into hash object
+
+    Args:
+        f (BinaryIO): File opened in binary mode
+        sha (hashlib._Hash): Hash object, that will be updated
+        length (int, optional): Read at most this many bytes. Defaults to whole file.
+        progress (Callable, optional): Called with the number of bytes of every hashed block. Defaults to None.
+
+    Returns:
+        int: Number of bytes hashed
+    """
+
+    size = length
+    if size is None:
+        try:
+            size = os.fstat(f.fileno()).st_size - f.tell()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            pass
+
+    view = get_buffer(buffer_size(size))
+    hashed = 0
+
+    while length is None or hashed < length:
+        target = view if length is None else view[:min(len(view), length - hashed)]
+        read = f.readinto(target)  # type: ignore
+        if not read:
+            break
+        sha.update(target[:read])
+        hashed += read
+
+        if progress is not None:
+            progress(read)
+
+    return hashed
+
+
+def hash_file(filename: str | os.PathLike, progress: Callable[[int], None] | None = None,
+              algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """Create hash of file
+
+    Args:
+        filename (os.PathLike): File, that will be hashed
+        progress (Callable, optional): Called with the number of bytes of every hashed block. Defaults to None.
+        algorithm (str, optional): Hash algorithm. Defaults to DEFAULT_ALGORITHM.
+
+    Returns:
+        str: Hex digest
+    """
+
+    sha = new_hash(algorithm)
+
+    # Memory map would save a copy per block, but a file truncated while it is
+    # mapped kills the process (SIGBUS) instead of raising OSError
+    with open(filename, 'rb', buffering=0) as f:
+        hash_stream(f, sha, progress=progress)
+
+    return sha.hexdigest()
+
+
+def _hash_job(filename: str, algorithm: str = DEFAULT_ALGORITHM,
+              progress: Callable[[int], None] | None = None) -> str | None:
+    "Worker entry point, files that disappeared in the meantime are reported as None"
+
+    try:
+        return hash_file(filename, progress, algorithm)
+    except OSError as e:
+        console.error(f"Unable to hash {filename}: {e}")
+        return None
+
+
+class HashEngine():
+    """
+    Hashes batches of files, optionally in a thread or process pool
+
+    Args:
+        jobs (int, optional): Number of workers, 1 hashes serially. Defaults to 1.
+        pool (str, optional): "thread", "process" or "auto". Defaults to "auto".
+        progress (ProgressReporter, optional): Shared progress display of the run. Defaults to a new one.
+    """
+
+    def __init__(self, jobs: int = 1, pool: str = "auto", progress: ProgressReporter | None = None):
+        if pool not in ("auto", "thread", "process"):
+            raise ValueError(f"Unknown pool type: {pool}")
+
+        self.jobs = max(1, jobs)
+        self.pool = pool
+        self.progress = progress if progress is not None else ProgressReporter()
+
+    def select_pool(self, sizes: list[int]) -> str:
+        "Pick pool type based on the shape of the tree"
+
+        if self.pool != "auto":
+            return self.pool
+
+        if len(sizes) >= PROCESS_POOL_MIN_FILES and sum(sizes) / len(sizes) < SMALL_FILE_SIZE:
+            return "process"
+
+        return "thread"
+
+    def create_executor(self, sizes: list[int]) -> tuple[Executor, int]:
+        "Create executor and chunksize, that should be used with it"
+
+        if self.select_pool(sizes) == "process":
+            # Send files to processes in batches to amortize the IPC
+            chunksize = max(1, min(256, len(sizes) // (self.jobs * 16)))
+            return ProcessPoolExecutor(max_workers=self.jobs), chunksize
+
+        return ThreadPoolExecutor(max_workers=self.jobs), 1
+
+    def hash_files(self, files: list[str], sizes: list[int], algorithm: str = DEFAULT_ALGORITHM) -> list[str | None]:
+        """Hash files and report progress in one aggregated bar
+
+        Args:
+            files (list[str]): Files, that will be hashed
+            sizes (list[int]): Expected sizes of the files, used for progress
+            algorithm (str, optional): Hash algorithm. Defaults to DEFAULT_ALGORITHM.
+
+        Returns:
+            list[str | None]: Hashes in the same order as files, None for unreadable files
+        """
+
+        return list(self.iter_hashes(files, sizes, algorithm))
+
+    def iter_hashes(self, files: list[str], sizes: list[int], algorithm: str = DEFAULT_ALGORITHM) -> Iterator[str | None]:
+        """Hash files and yield every hash as soon as it is known
+
+        Args:
+            files (list[str]): Files, that will be hashed
+            sizes (list[int]): Expected sizes of the files, used for progress
+            algorithm (str, optional): Hash algorithm. Defaults to DEFAULT_ALGORITHM.
+
+        Yields:
+            str | None: Hashes in the same order as files, None for unreadable files
+        """
+
+        if not files:
+            return
+
+        # Fail early on unavailable algorithm instead of in every worker
+        new_hash(algorithm)
+
+        with self.progress.phase("[bold purple]H", sum(sizes), len(files)) as phase:
+            # Threads report every block, so large files move the bar while they are hashed,
+            # processes can not share the phase and report whole files
+            job = partial(_hash_job, algorithm=algorithm, progress=phase.advance)
+            per_block = True
+
+            if self.jobs == 1 or len(files) == 1:
+                results = map(job, files)
+                executor = None
+            else:
+                executor, chunksize = self.create_executor(sizes)
+                console.debug(
+                    f"Hashing {len(files)} files using {type(executor).__name__} with {self.jobs} workers")
+                if isinstance(executor, ProcessPoolExecutor):
+                    job = partial(_hash_job, algorithm=algorithm)
+                    per_block = False
+                results = executor.map(job, files, chunksize=chunksize)
+
+            try:
+                # map keeps the input order, so the output is deterministic
+                for file, size, hash in zip(files, sizes, results):
+                    if not per_block:
+                        phase.advance(size)
+                    phase.complete_file(Path(file).name)
+                    yield hash
+            finally:
+                if executor is not None:
+                    executor.shutdown(cancel_futures=True)
@@ -0,0 +1,334 @@
+"""
+Reading and writing of hashtables (manifests)
+
+Two formats are supported and detected automatically when loading:
+
+JSON - the original human readable format
+    {"path": {"hash": "hex digest", "size": size}, ...}
+    entries of files with compressed companions add "encoding" and
+    "compressed" (size of the companion), see core.compression
+    hashtables of other algorithm than SHA-256 start with a metadata entry
+    {".updater": {"algorithm": "blake2b"}, ...}, the state directory is
+    never part of a hashtable, so the name can not collide with a file
+
+Binary - compact format for huge trees
+    magic (4B) | version (1B) | flags (1B) | digest size (1B)
+    version 2 adds algorithm (1B), version 1 is always SHA-256
+    version 3 adds encoding of companions (1B) after the algorithm
+    followed by the body (zlib compressed if FLAG_ZLIB is set):
+    varint count, then for every entry sorted by path:
+    varint shared prefix with previous path | varint suffix length |
+    suffix (UTF-8) | raw digest | varint size
+    version 3 appends varint compressed size, 0 if the file has no companion
+"""
+
+import io
+import json
+import os
+import zlib
+from typing import BinaryIO, Iterator
+
+from core.compression import ENCODINGS
+from core.hash_cache import STATE_DIRECTORY
+from core.hashing import ALGORITHMS, DEFAULT_ALGORITHM
+
+MAGIC = b"UPHT"
+VERSION = 3
+FLAG_ZLIB = 0x01
+HEADER_SIZE = len(MAGIC) + 3
+
+META_KEY = STATE_DIRECTORY
+
+# Size of blocks read from the underlying stream
+READ_SIZE = 64 * 1024
+
+FORMATS = ["json", "binary"]
+
+
+class Hashtable(dict):
+    """
+    Entries of hashtable by path, that remember algorithm of their hashes
+
+    Args:
+        algorithm (str, optional): Hash algorithm of the entries. Defaults to DEFAULT_ALGORITHM.
+    """
+
+    def __init__(self, *args, algorithm: str = DEFAULT_ALGORITHM, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.algorithm = algorithm
+
+
+def algorithm_of(hashtable: dict) -> str:
+    "Hash algorithm of hashtable, plain dictionaries are SHA-256"
+
+    return getattr(hashtable, "algorithm", DEFAULT_ALGORITHM)
+
+
+def encode_varint(value: int) -> bytes:
+    "Encode unsigned integer as LEB128"
+
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+class _Reader():
+    "Buffered reader over a byte stream, optionally inflating zlib data"
+
+    def __init__(self, stream: BinaryIO, compressed: bool = False, initial: bytes = b""):
+        self.stream = stream
+        self.inflater = zlib.decompressobj() if compressed else None
+        self.buffer = bytearray()
+        self.position = 0
+        self.feed(initial)
+
+    def feed(self, data: bytes) -> None:
+        if self.inflater is not None:
+            data = self.inflater.decompress(data)
+        self.buffer += data
+
+    def fill(self, size: int) -> None:
+        # Drop consumed data, so that the buffer stays small
+        if self.position > READ_SIZE:
+            del self.buffer[:self.position]
+            self.position = 0
+
+        while len(self.buffer) - self.position < size:
+            data = self.stream.read(READ_SIZE)
+            if not data:
+                if self.inflater is not None and not self.inflater.eof:
+                    self.buffer += self.inflater.flush()
+                    self.inflater = None
+                    continue
+                raise ValueError("Unexpected end of hashtable")
+            self.feed(data)
+
+    def read(self, size: int) -> bytes:
+        self.fill(size)
+        data = bytes(self.buffer[self.position:self.position + size])
+        self.position += size
+        return data
+
+    def varint(self) -> int:
+        result = shift = 0
+        while True:
+            self.fill(1)
+            byte = self.buffer[self.position]
+            self.position += 1
+            result |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return result
+            shift += 7
+
+
+def is_binary(head: bytes) -> bool:
+    "Check if the first bytes of hashtable belong to the binary format"
+
+    return head[:len(MAGIC)] == MAGIC
+
+
+def iter_binary(stream: BinaryIO, head: bytes = b"", info: dict | None = None) -> Iterator[tuple[str, dict]]:
+    """Stream entries of binary hashtable without loading it whole
+
+    Args:
+        stream (BinaryIO): Stream positioned after head
+        head (bytes, optional): Bytes, that were already read from the stream. Defaults to b"".
+        info (dict, optional): Filled with "algorithm" of the hashtable before the first entry. Defaults to None.
+
+    Yields:
+        tuple[str, dict]: Path and entry of every file
+    """
+
+    header = _Reader(stream, initial=head)
+    if not is_binary(header.read(len(MAGIC))):
+        raise ValueError("Not a binary hashtable")
+
+    version, flags, digest_size = header.read(3)
+    if not 1 <= version <= VERSION:
+        raise ValueError(f"Unsupported hashtable version: {version}")
+
+    algorithm = DEFAULT_ALGORITHM
+    if version >= 2:
+        algorithm_id = header.read(1)[0]
+        if algorithm_id >= len(ALGORITHMS):
+            raise ValueError(f"Unsupported hash algorithm: {algorithm_id}")
+        algorithm = ALGORITHMS[algorithm_id]
+
+    encoding = None
+    if version >= 3:
+        encoding_id = header.read(1)[0]
+        if encoding_id >= len(ENCODINGS):
+            raise ValueError(f"Unsupported encoding: {encoding_id}")
+        encoding = ENCODINGS[encoding_id]
+
+    if info is not None:
+        info["algorithm"] = algorithm
+
+    rest = bytes(header.buffer[header.position:])
+    reader = _Reader(stream, compressed=bool(flags & FLAG_ZLIB), initial=rest)
+
+    previous = b""
+    for _ in range(reader.varint()):
+        shared = reader.varint()
+        path = previous[:shared] + reader.read(reader.varint())
+        entry = {"hash": reader.read(digest_size).hex(), "size": reader.varint()}
+        if encoding is not None:
+            compressed = reader.varint()
+            if compressed:
+                entry["encoding"] = encoding
+                entry["compressed"] = compressed
+
+        previous = path
+        yield path.decode("utf-8"), entry
+
+
+def iter_entries(stream: BinaryIO, info: dict | None = None) -> Iterator[tuple[str, dict]]:
+    """Stream entries of hashtable in any supported format
+
+    Args:
+        stream (BinaryIO): Binary stream of the hashtable
+        info (dict, optional): Filled with "algorithm" of the hashtable before the first entry. Defaults to None.
+
+    Yields:
+        tuple[str, dict]: Path and entry of every file
+    """
+
+    head = stream.read(HEADER_SIZE)
+
+    if is_binary(head):
+        yield from iter_binary(stream, head, info)
+    else:
+        table = json.loads(head + stream.read())
+        meta = table.pop(META_KEY, {})
+
+        algorithm = meta.get("algorithm", DEFAULT_ALGORITHM)
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+        if info is not None:
+            info["algorithm"] = algorithm
+
+        for path, entry in table.items():
+            if "compressed" in entry:
+                yield path, {"hash": entry["hash"], "size": entry["size"],
+                             "encoding": entry["encoding"], "compressed": entry["compressed"]}
+            else:
+                yield path, {"hash": entry["hash"], "size": entry["size"]}
+
+
+def load(stream: BinaryIO) -> Hashtable:
+    """Load hashtable in any supported format
+
+    Args:
+        stream (BinaryIO): Binary stream of the hashtable
+
+    Returns:
+        Hashtable: loaded hashtable
+    """
+
+    info: dict = {}
+    table = Hashtable(iter_entries(stream, info))
+    table.algorithm = info.get("algorithm", DEFAULT_ALGORITHM)
+
+    return table
+
+
+def dump_binary(hashtable: dict[str, dict], stream: BinaryIO, compress: bool = False) -> None:
+    """Write hashtable in the binary format
+
+    Args:
+        hashtable (dict): Hashtable, that will be written
+        stream (BinaryIO): Writable binary stream
+        compress (bool, optional): Compress body with zlib. Defaults to False.
+    """
+
+    entries = sorted((path.encode("utf-8"), entry)
+                     for path, entry in hashtable.items())
+    digest_size = len(bytes.fromhex(entries[0][1]["hash"])) if entries else 32
+
+    algorithm = algorithm_of(hashtable)
+    header = bytes([FLAG_ZLIB if compress else 0, digest_size])
+
+    encodings = {entry["encoding"] for _, entry in entries if "compressed" in entry}
+    if len(encodings) > 1:
+        raise ValueError("Binary hashtable supports only one encoding of companions")
+    encoding = encodings.pop() if encodings else None
+
+    # Hashtables are written in the oldest version, that can hold them,
+    # so they stay readable by older clients
+    if encoding is not None:
+        stream.write(MAGIC + bytes([3]) + header +
+                     bytes([ALGORITHMS.index(algorithm), ENCODINGS.index(encoding)]))
+    elif algorithm != DEFAULT_ALGORITHM:
+        stream.write(MAGIC + bytes([2]) + header +
+                     bytes([ALGORITHMS.index(algorithm)]))
+    else:
+        stream.write(MAGIC + bytes([1]) + header)
+
+    deflater = zlib.compressobj(9) if compress else None
+    body = io.BytesIO()
+
+    def flush(final: bool = False) -> None:
+        data = body.getvalue()
+        body.seek(0)
+        body.truncate()
+        if deflater is not None:
+            data = deflater.compress(data)
+            if final:
+                data += deflater.flush()
+        stream.write(data)
+
+    body.write(encode_varint(len(entries)))
+
+    previous = b""
+    for path, entry in entries:
+        shared = len(os.path.commonprefix([previous, path]))
+        body.write(encode_varint(shared))
+        body.write(encode_varint(len(path) - shared))
+        body.write(path[shared:])
+        body.write(bytes.fromhex(entry["hash"]))
+        body.write(encode_varint(entry["size"]))
+        if encoding is not None:
+            body.write(encode_varint(entry.get("compressed", 0)))
+        previous = path
+
+        if body.tell() > READ_SIZE:
+            flush()
+
+    flush(final=True)
+
+
+def dump_json(hashtable: dict[str, dict], stream: BinaryIO) -> None:
+    "Write hashtable in the JSON format"
+
+    algorithm = algorithm_of(hashtable)
+    if algorithm != DEFAULT_ALGORITHM:
+        hashtable = {META_KEY: {"algorithm": algorithm}, **hashtable}
+
+    stream.write(json.dumps(hashtable, ensure_ascii=False,
+                 indent=4).encode("utf-8"))
+
+
+def dump(hashtable: dict[str, dict], path: str | os.PathLike, format: str = "json", compress: bool = False) -> None:
+    """Write hashtable into file
+
+    Args:
+        hashtable (dict): Hashtable, that will be written
+        path (os.PathLike): Destination file
+        format (str, optional): "json" or "binary". Defaults to "json".
+        compress (bool, optional): Compress binary hashtable. Defaults to False.
+    """
+
+    with open(path, "wb") as f:
+        match format:
+            case "json":
+                dump_json(hashtable, f)
+            case "binary":
+                dump_binary(hashtable, f, compress)
+            case _:
+                raise ValueError(f"Unknown hashtable format: {format}")
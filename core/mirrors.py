@@ -0,0 +1,308 @@
+"""
+Scheduling of downloads across multiple mirrors
+
+Every mirror keeps moving averages of its latency (time to the first byte)
+and throughput, measured on the transfers, that it served. A file goes to
+the mirror, that is expected to finish it first, considering the transfers
+already running there, so faster mirrors get more of the load. Mirrors,
+that were not measured yet, are tried first.
+
+Failed or corrupted downloads are retried on another mirror, the failed
+mirror is avoided for an exponentially growing time. Large files can be
+split into segments fetched from several mirrors at once with Range
+requests.
+"""
+
+import logging as console
+import threading
+import time
+from typing import Iterable
+
+from core.stats import Stats
+
+# Weight of the newest measurement in the moving averages
+SMOOTHING = 0.3
+
+# Failed mirror is avoided for BACKOFF_BASE * 2 ** (failures - 1) seconds, at most BACKOFF_MAX
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+# Transfers shorter than this do not say anything about throughput
+MIN_SAMPLE_TIME = 0.05
+
+# Files of at least this size are split across mirrors
+SPLIT_MIN_SIZE = 64 * 1024 * 1024
+SEGMENT_SIZE = 8 * 1024 * 1024
+
+
+class Mirror():
+    """
+    Mirror and its measured performance
+
+    Args:
+        url (str): Root URL of the mirror, ending with "/"
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.latency: float | None = None
+        self.throughput: float | None = None
+        self.active = 0
+        self.failures = 0
+        self.avoid_until = 0.0
+
+        # Totals for the report
+        self.transfers = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def estimate(self, size: int) -> float:
+        "Expected number of seconds, until a new file of size would be downloaded"
+
+        if self.latency is None:
+            # Unknown mirror is explored by one transfer at a time
+            return 0.0 if self.active == 0 else float("inf")
+
+        # Throughput is not known until a transfer took long enough to measure it
+        transfer = size / self.throughput if self.throughput else 0.0
+        return (self.active + 1) * (self.latency + transfer)
+
+    def measure(self, latency: float | None, size: int, duration: float) -> None:
+        "Update moving averages with a finished transfer"
+
+        if latency is not None:
+            self.latency = latency if self.latency is None else \
+                SMOOTHING * latency + (1 - SMOOTHING) * self.latency
+
+        if duration >= MIN_SAMPLE_TIME and size:
+            throughput = size / duration
+            self.throughput = throughput if self.throughput is None else \
+                SMOOTHING * throughput + (1 - SMOOTHING) * self.throughput
+
+
+class Transfer():
+    """
+    Progress of one download attempt, measures the mirror on the way
+
+    Stands in for ProgressPhase, so the downloaders report to it as usual.
+
+    Args:
+        phase (ProgressPhase): Progress of all downloads
+    """
+
+    def __init__(self, phase):
+        self.phase = phase
+        self.start = time.monotonic()
+        self.first_byte: float | None = None
+        self.bytes = 0
+
+    def advance(self, size: int, filename: str | None = None) -> None:
+        if self.first_byte is None and size:
+            self.first_byte = time.monotonic()
+        self.bytes += size
+        self.phase.advance(size, filename)
+
+    def rollback(self) -> None:
+        "Take back the progress of a failed attempt"
+
+        if self.bytes:
+            self.phase.advance(-self.bytes)
+            self.bytes = 0
+
+    def __getattr__(self, name: str):
+        return getattr(self.phase, name)
+
+
+class MirrorPool():
+    """
+    Mirrors of one update, shared by all download workers
+
+    Args:
+        urls (Iterable[str]): Root URLs of the mirrors
+        stats (Stats, optional): Receives counts and durations of transfers. Defaults to None.
+    """
+
+    def __init__(self, urls: Iterable[str], stats: Stats | None = None):
+        self.mirrors = [Mirror(url if url.endswith("/") else url + "/") for url in urls]
+        if not self.mirrors:
+            raise ValueError("No mirror to download from")
+        self.stats = stats if stats is not None else Stats()
+
+        self.lock = threading.Lock()
+        # Every mirror gets a chance, then the file is retried on the best one twice more
+        self.attempts = len(self.mirrors) + 2
+
+    @classmethod
+    def of(cls, mirrors: "str | Iterable[str] | MirrorPool", stats: Stats | None = None) -> "MirrorPool":
+        "Create pool from URL or list of URLs, existing pool is returned as it is"
+
+        if isinstance(mirrors, MirrorPool):
+            return mirrors
+        if isinstance(mirrors, str):
+            return cls([mirrors], stats)
+        return cls(mirrors, stats)
+
+    def __len__(self) -> int:
+        return len(self.mirrors)
+
+    def acquire(self, size: int, tried: set[Mirror] | None = None) -> Mirror:
+        """Pick mirror for file, that is expected to finish it first
+
+        Args:
+            size (int): Size of the file
+            tried (set[Mirror], optional): Mirrors, that already failed on this file. Defaults to None.
+
+        Returns:
+            Mirror: Selected mirror, it has to be passed to release()
+        """
+
+        tried = tried or set()
+
+        with self.lock:
+            now = time.monotonic()
+            candidates = [mirror for mirror in self.mirrors
+                          if mirror not in tried and mirror.avoid_until <= now] or \
+                [mirror for mirror in self.mirrors if mirror not in tried] or \
+                self.mirrors
+
+            mirror = min(candidates, key=lambda mirror: (mirror.estimate(size), mirror.active, mirror.avoid_until))
+            mirror.active += 1
+
+        return mirror
+
+    def use(self, mirror: Mirror) -> None:
+        "Start transfer from the given mirror, it has to be passed to release()"
+
+        with self.lock:
+            mirror.active += 1
+
+    def available(self) -> list[Mirror]:
+        "Mirrors, that are not avoided after a failure"
+
+        now = time.monotonic()
+        with self.lock:
+            return [mirror for mirror in self.mirrors if mirror.avoid_until <= now] or list(self.mirrors)
+
+    def release(self, mirror: Mirror, transfer: Transfer) -> None:
+        "Record successful download from mirror"
+
+        end = time.monotonic()
+
+        with self.lock:
+            mirror.active -= 1
+            mirror.failures = 0
+            mirror.transfers += 1
+            mirror.bytes += transfer.bytes
+
+            latency = transfer.first_byte - transfer.start if transfer.first_byte is not None else None
+            mirror.measure(latency, transfer.bytes, end - (transfer.first_byte or transfer.start))
+
+        # Segments of split files are transfers of their own
+        self.stats.add("transfers")
+        self.stats.add("bytes_downloaded", transfer.bytes)
+        self.stats.observe("transfer_seconds", end - transfer.start)
+        if latency is not None:
+            self.stats.observe("first_byte_seconds", latency)
+
+    def fail(self, mirror: Mirror, transfer: Transfer, tried: set[Mirror]) -> float:
+        """Record failed download from mirror
+
+        Args:
+            mirror (Mirror): Mirror, that failed
+            transfer (Transfer): Failed attempt, its progress is taken back
+            tried (set[Mirror]): Mirrors, that failed on this file, mirror is added
+
+        Returns:
+            float: Seconds to wait before the next attempt
+        """
+
+        transfer.rollback()
+        tried.add(mirror)
+        self.stats.add("transfer_errors")
+
+        with self.lock:
+            mirror.active -= 1
+            mirror.failures += 1
+            mirror.errors += 1
+
+            now = time.monotonic()
+            mirror.avoid_until = now + min(BACKOFF_BASE * 2 ** (mirror.failures - 1), BACKOFF_MAX)
+
+            # Another mirror can take over immediately, otherwise wait for the first one to recover
+            if any(other not in tried and other.avoid_until <= now for other in self.mirrors):
+                return 0.0
+            return max(0.0, min(other.avoid_until for other in self.mirrors) - now)
+
+    def segments(self, size: int) -> list[tuple[int, int]] | None:
+        "Inclusive byte ranges of file, that is worth splitting across mirrors, None otherwise"
+
+        if len(self.mirrors) < 2 or size < SPLIT_MIN_SIZE or len(self.available()) < 2:
+            return None
+
+        return [(start, min(start + SEGMENT_SIZE, size) - 1) for start in range(0, size, SEGMENT_SIZE)]
+
+    def report(self) -> None:
+        "Log what every mirror contributed"
+
+        if len(self.mirrors) < 2:
+            return
+
+        for mirror in self.mirrors:
+            throughput = f"{mirror.throughput / 1024 / 1024:.1f} MiB/s" if mirror.throughput else "unknown"
+            latency = f"{mirror.latency * 1000:.0f} ms" if mirror.latency is not None else "unknown"
+            console.info(f"Mirror {mirror.url}: {mirror.transfers} transfers, {mirror.bytes / 1024 / 1024:.1f} MiB, "
+                         f"throughput {throughput}, latency {latency}, {mirror.errors} errors")
+
+
+class Retry():
+    """
+    Attempts of one file, every attempt goes to the best mirror, that did not fail on the file yet
+
+    The threaded and the asyncio downloaders share it, so they fail over
+    and back off the same way, only the waiting differs.
+
+    Args:
+        mirrors (MirrorPool): Mirrors of the update
+        path (str): Path of the file relative to the mirror root
+        size (int): Size of the file
+    """
+
+    def __init__(self, mirrors: MirrorPool, path: str, size: int):
+        self.mirrors = mirrors
+        self.path = path
+        self.size = size
+        self.tried: set[Mirror] = set()
+        self.attempt = 0
+        self.mirror: Mirror | None = None
+        self.transfer: Transfer | None = None
+
+    def start(self, phase) -> tuple[Mirror, Transfer]:
+        "Select mirror of the next attempt, that reports its progress to phase"
+
+        self.mirror = self.mirrors.acquire(self.size, self.tried)
+        self.transfer = Transfer(phase)
+        return self.mirror, self.transfer
+
+    def succeeded(self) -> None:
+        self.mirrors.release(self.mirror, self.transfer)  # type: ignore
+
+    def failed(self, error: BaseException) -> float:
+        """Record failed attempt
+
+        Args:
+            error (BaseException): Why the attempt failed
+
+        Raises:
+            BaseException: error, if it was the last attempt
+
+        Returns:
+            float: Seconds to wait before the next attempt
+        """
+
+        delay = self.mirrors.fail(self.mirror, self.transfer, self.tried)  # type: ignore
+        self.attempt += 1
+        if self.attempt == self.mirrors.attempts:
+            raise error
+
+        console.warning(f"{self.path} failed on {self.mirror.url} ({error}), retrying")  # type: ignore
+        return delay
@@ -0,0 +1,142 @@
+import logging as console
+import os
+import shutil
+from os import PathLike
+from typing import Callable
+
+from core import compression
+
+# ioctl request of Linux for cloning file content (copy-on-write)
+FICLONE = 0x40049409
+
+PART_SUFFIX = ".part"
+
+LINK_MODES = ["reflink", "copy", "hardlink"]
+
+
+class UpdatePlan():
+    """
+    Files of diff split by how they will be obtained
+
+    Attributes:
+        downloads (dict): Unique content, that has to be downloaded
+        local (list[tuple[str, str]]): (source, destination) pairs satisfied by files, that are already on disk
+        duplicates (list[tuple[str, str]]): (source, destination) pairs satisfied by files from downloads
+    """
+
+    def __init__(self):
+        self.downloads: dict[str, dict] = {}
+        self.local: list[tuple[str, str]] = []
+        self.duplicates: list[tuple[str, str]] = []
+
+    @property
+    def size(self) -> int:
+        "Number of bytes, that has to be downloaded"
+
+        return sum(entry["size"] for entry in self.downloads.values())
+
+    @property
+    def wire_size(self) -> int:
+        "Number of bytes, that has to be transferred, when compressed companions are used"
+
+        return sum(compression.wire_size(entry) for entry in self.downloads.values())
+
+
+def create_plan(diff: dict[str, dict], find_local: Callable[[str], str | None]) -> UpdatePlan:
+    """Group diff by content, so that every unique content is downloaded only once
+
+    Args:
+        diff (dict): Absent or modified files
+        find_local (Callable): Returns relative path of local file with the given hash or None
+
+    Returns:
+        UpdatePlan: Plan of the update
+    """
+
+    plan = UpdatePlan()
+    groups: dict[str, list[str]] = {}
+
+    for path, entry in diff.items():
+        groups.setdefault(entry["hash"], []).append(path)
+
+    for hash, paths in groups.items():
+        source = find_local(hash)
+
+        if source is not None:
+            plan.local.extend((source, path) for path in paths)
+        else:
+            plan.downloads[paths[0]] = diff[paths[0]]
+            plan.duplicates.extend((paths[0], path) for path in paths[1:])
+
+    console.debug(
+        f"Plan: {len(plan.downloads)} downloads, {len(plan.local)} local copies, {len(plan.duplicates)} duplicates")
+
+    return plan
+
+
+def reflink(source: str | PathLike, destination: str | PathLike) -> None:
+    "Clone file content without copying data, raises OSError if not supported"
+
+    import fcntl
+
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def link_file(source: str | PathLike, destination: str | PathLike, mode: str = "reflink") -> None:
+    """Create destination with the content of source
+
+    Args:
+        source (os.PathLike): Existing file
+        destination (os.PathLike): File, that will be created
+        mode (str, optional): "reflink", "hardlink" or "copy", falls back to copy. Defaults to "reflink".
+    """
+
+    try:
+        match mode:
+            case "reflink":
+                return reflink(source, destination)
+            case "hardlink":
+                return os.link(source, destination)
+    except (OSError, ImportError):
+        pass
+
+    shutil.copyfile(source, destination)
+
+
+def copy_files(root: str | PathLike, pairs: list[tuple[str, str]], mode: str = "reflink",
+               destination_root: str | PathLike | None = None) -> None:
+    """Copy files inside root
+
+    All copies are staged first and moved into place afterwards, so a
+    destination, that is also a source of another copy, is read before
+    it is replaced.
+
+    Args:
+        root (os.PathLike): Directory, that the paths are relative to
+        pairs (list[tuple[str, str]]): (source, destination) pairs
+        mode (str, optional): "reflink", "hardlink" or "copy". Defaults to "reflink".
+        destination_root (os.PathLike, optional): Directory, that the destinations are relative to. Defaults to root.
+    """
+
+    destination_root = destination_root if destination_root is not None else root
+    staged = []
+
+    try:
+        for source, destination in pairs:
+            destination = os.path.join(destination_root, destination)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+            part = destination + PART_SUFFIX
+            if os.path.exists(part):
+                os.remove(part)
+
+            link_file(os.path.join(root, source), part, mode)
+            staged.append((part, destination))
+
+        for part, destination in staged:
+            os.replace(part, destination)
+    finally:
+        for part, _ in staged:
+            if os.path.exists(part):
+                os.remove(part)
@@ -0,0 +1,175 @@
+import threading
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from rich.console import Console
+    from rich.progress import TaskID
+
+# Minimal delay between two updates of the live display
+REFRESH_INTERVAL = 0.1
+
+
+class ProgressPhase():
+    """
+    One step of a run (hashing, downloading, ...) shown as a single total-bytes bar
+
+    Updates are accumulated and pushed to the display at most once per
+    refresh interval, so reporting per chunk or per file stays cheap.
+    """
+
+    def __init__(self, reporter: "ProgressReporter", label: str, total: int | None, files: int):
+        self.reporter = reporter
+        self.total = total or 0
+        self.files = files
+        self.files_done = 0
+        self.pending = 0
+        self.filename = ""
+        self.last_refresh = 0.0
+        self.task: "TaskID | None" = None
+
+        if reporter.enabled:
+            self.lock = threading.Lock()
+            self.task = reporter.add_task(label, total, self.counter())
+
+    def __enter__(self) -> "ProgressPhase":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def counter(self) -> str:
+        return f"{self.files_done}/{self.files}"
+
+    def advance(self, size: int, filename: str | None = None) -> None:
+        "Add processed bytes, optionally announcing the file they belong to"
+
+        if self.task is None:
+            return
+
+        with self.lock:
+            self.pending += size
+            if filename is not None:
+                self.filename = filename
+            self.refresh()
+
+    def complete_file(self, filename: str | None = None) -> None:
+        "Mark one file of the phase as done"
+
+        if self.task is None:
+            return
+
+        with self.lock:
+            self.files_done += 1
+            if filename is not None:
+                self.filename = filename
+            self.refresh()
+
+    def add_total(self, size: int, files: int = 1) -> None:
+        "Grow expected number of bytes and files, when the work is discovered on the fly"
+
+        if self.task is None:
+            return
+
+        with self.lock:
+            self.total += size
+            self.files += files
+            self.reporter.progress.update(
+                self.task, total=self.total, files=self.counter())
+
+    def refresh(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self.last_refresh < self.reporter.interval:
+            return
+
+        self.last_refresh = now
+        self.reporter.progress.update(
+            self.task, advance=self.pending, filename=self.filename, files=self.counter())
+        self.pending = 0
+
+    def close(self) -> None:
+        if self.task is None:
+            return
+
+        with self.lock:
+            self.refresh(force=True)
+        self.reporter.remove_phase()
+        self.task = None
+
+
+class ProgressReporter():
+    """
+    Run-level progress display shared by the updater and all downloaders
+
+    Args:
+        quiet (bool, optional): Do not render anything. Defaults to False.
+        interval (float, optional): Minimal delay between display updates in seconds. Defaults to REFRESH_INTERVAL.
+        console (Console, optional): Console, that is rendered to. Defaults to stdout.
+    """
+
+    def __init__(self, quiet: bool = False, interval: float = REFRESH_INTERVAL, console: "Console | None" = None):
+        self.interval = interval
+        self.console = console
+        self.enabled = False
+        self.active = 0
+        self.lock = threading.Lock()
+        self.progress = None
+
+        # Quiet runs do not import rich at all, it takes a large part of the startup
+        if quiet:
+            return
+
+        from rich.console import Console
+        from rich.progress import (BarColumn, DownloadColumn, Progress,
+                                   TextColumn, TimeRemainingColumn,
+                                   TransferSpeedColumn)
+
+        self.console = console if console is not None else Console()
+        # Nothing is rendered when the output is redirected to a file or pipe
+        self.enabled = self.console.is_terminal
+
+        self.progress = Progress(TextColumn("{task.description}: [bold blue]{task.fields[filename]}", justify="right"),
+                                 BarColumn(bar_width=None),
+                                 "[progress.percentage]{task.percentage:>3.1f}%",
+                                 "•",
+                                 TextColumn("{task.fields[files]}"),
+                                 "•",
+                                 DownloadColumn(),
+                                 "•",
+                                 TransferSpeedColumn(),
+                                 "•",
+                                 TimeRemainingColumn(),
+                                 console=self.console,
+                                 disable=not self.enabled)
+
+    def phase(self, label: str, total: int | None, files: int = 0) -> ProgressPhase:
+        """Start new phase of the run
+
+        Args:
+            label (str): Short label shown in front of the bar, rich markup is allowed
+            total (int | None): Expected number of bytes
+            files (int, optional): Expected number of files. Defaults to 0.
+
+        Returns:
+            ProgressPhase: Handle, that is used for reporting
+        """
+
+        return ProgressPhase(self, label, total, files)
+
+    def add_task(self, label: str, total: int | None, files: str) -> "TaskID":
+        with self.lock:
+            if self.active == 0:
+                self.progress.start()
+            self.active += 1
+
+            return self.progress.add_task(label, total=total, filename="", files=files)
+
+    def remove_phase(self) -> None:
+        with self.lock:
+            self.active -= 1
+            if self.active == 0:
+                self.progress.stop()
+
+                # Finished bars were already printed, start clean next time
+                for task in list(self.progress.task_ids):
+                    self.progress.remove_task(task)
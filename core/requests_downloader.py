@@ -1,80 +1,158 @@
-import hashlib
 import logging as console
-import os
-from os import PathLike
+from functools import partial
 from pathlib import Path
+from typing import Iterator
 
 import requests
-from rich.progress import (BarColumn, DownloadColumn, Progress, TextColumn,
-                           TimeRemainingColumn, TransferSpeedColumn)
+from requests.adapters import HTTPAdapter
 
-from core.downloader_template import DownloaderBase
+from core import blocks
+from core.downloader_template import DownloaderBase, VerificationError
+from core.hashing import DEFAULT_ALGORITHM, hash_stream, new_hash
+from core.progress import ProgressPhase, ProgressReporter
+from core.staging import Stage
 
 
 class RequestsDownloader(DownloaderBase):
+    """
+    Downloader based on a pooled keep-alive requests.Session
+
+    Args:
+        progress (ProgressReporter, optional): Shared progress display of the run. Defaults to a new one.
+        connections (int, optional): Number of files downloaded in parallel. Defaults to 4.
+        block_maps_url (str, optional): URL of block maps, large files are patched instead of downloaded when set. Defaults to None.
+        algorithm (str, optional): Hash algorithm of the hashtable, used to verify downloaded files. Defaults to DEFAULT_ALGORITHM.
+        companions_path (str, optional): Path of compressed companions relative to the mirror root, they are downloaded instead of files, that have them. Defaults to None.
+        stage (Stage, optional): Staging area, that the files are downloaded into, verified files are recorded in its journal. Defaults to None.
+    """
+
+    def __init__(self, progress: ProgressReporter | None = None, connections: int = 4,
+                 block_maps_url: str | None = None, algorithm: str = DEFAULT_ALGORITHM,
+                 companions_path: str | None = None, stage: Stage | None = None) -> None:
+        super().__init__(progress, block_maps_url, algorithm, companions_path, stage)
+        self.connections = max(1, connections)
+
+        # One connection per worker is kept alive and reused for following files
+        adapter = HTTPAdapter(pool_connections=self.connections,
+                              pool_maxsize=self.connections)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
     @property
     def name(self) -> str:
         return "requests_downloader"
 
-    def download(self, compared: dict[str, dict[str, int]], mirror: str,  dest_dir: str | PathLike) -> None:
-        "Download files from remote repository."
-
-        for item in compared.keys():
-            self.download_file(mirror+item, os.path.join(dest_dir, item),  # type: ignore
-                               compared[item]["hash"])  # type: ignore
+    def download_url(self, url: str, file: Path, entry: dict, phase: ProgressPhase,
+                     companion: tuple[str, str] | None = None) -> None:
+        self.download_file(url, file, entry["hash"], phase, entry["size"], companion)
 
-    def validate_file(self, file: Path, hash: str) -> bool:
+    def validate_file(self, file: Path, hash: str, phase: ProgressPhase | None = None) -> bool:
         """
         Validate a given file with its hash.
         The downloaded file is hashed and compared to a pre-registered
         has value to validate the download procedure.
         """
 
-        sha = hashlib.sha256()
+        if phase is None:
+            with self.progress.phase("[bold purple]H", file.stat().st_size, 1) as phase:
+                return self.validate_file(file, hash, phase)
 
-        with Progress(TextColumn("[bold purple]H: [bold blue]{task.fields[filename]}", justify="right"),
-                      BarColumn(bar_width=None),
-                      "[progress.percentage]{task.percentage:>3.1f}%",
-                      "•",
-                      DownloadColumn(),
-                      "•",
-                      TransferSpeedColumn(),
-                      "•",
-                      TimeRemainingColumn(),) as progress:
-            task = progress.add_task(
-                file.name, filename=file.name, total=file.stat().st_size)
+        sha = new_hash(self.algorithm)
 
-            with open(file, 'rb') as f:
-                # with tqdm(total=file.stat().st_size, unit='B',
-                #         unit_scale=True, unit_divisor=1024,
-                #         desc=file.name, ascii=False, leave=False) as progressbar:
-                while True:
-                    # 1MB so that memory is not exhausted
-                    chunk = f.read(1000 * 1000)
-                    if not chunk:
-                        break
-                    sha.update(chunk)
-                    progress.update(task, advance=len(chunk))
+        with open(file, 'rb') as f:
+            phase.advance(hash_stream(f, sha), file.name)
+
+        phase.complete_file(file.name)
 
         if not sha.hexdigest() == hash:
             return False
         else:
             return True
 
-    def download_file(self, url: str, file: Path, verification_hash: str) -> None:
-        "Download file from remote repository."
+    def fetch_range(self, url: str, start: int, end: int) -> Iterator[bytes]:
+        "Stream bytes between start and end (inclusive) of URL"
+
+        # Response, that is not read to its end, has to be closed to give its connection back
+        with self.session.get(url, stream=True, headers={'Range': f'bytes={start}-{end}'},
+                              timeout=self.timeout) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise blocks.PatchError(f'{url} does not support ranges')
+            yield from r.iter_content(32 * 1024)
+
+    def patch_file(self, url: str, file: Path, verification_hash: str, phase: ProgressPhase) -> bool:
+        "Download only changed blocks of file, returns False if it has to be downloaded whole"
+
+        try:
+            r = self.session.get(blocks.block_map_url(
+                self.block_maps_url, verification_hash), timeout=self.timeout)  # type: ignore
+            r.raise_for_status()
+            block_map = r.json()
+        except (requests.RequestException, ValueError):
+            return False
+
+        try:
+            return blocks.patch_file(self.patch_source(file), block_map, verification_hash,  # type: ignore
+                                     partial(self.fetch_range, url), phase, self.algorithm, file)
+        except (requests.RequestException, blocks.PatchError) as e:
+            console.info(f'{file} can not be patched ({e}), downloading whole file.')
+            return False
+
+    def download_companion(self, companion: tuple[str, str], file: Path, verification_hash: str,
+                           file_size: int, phase: ProgressPhase) -> bool:
+        "Download compressed companion of file, returns False if the file has to be downloaded as it is"
+
+        url, encoding = companion
+
+        try:
+            r = self.session.get(url, stream=True, timeout=self.timeout)
+        except requests.RequestException as e:
+            console.debug(f'{file} has no companion ({e})')
+            return False
+
+        if not r.ok:
+            r.close()
+            console.debug(f'{file} has no companion ({r.status_code})')
+            return False
+
+        with r:
+            try:
+                return self.decompress_into(r.iter_content(32 * 1024), file, encoding,
+                                            file_size, verification_hash, phase)
+            except requests.RequestException as e:
+                console.info(f'{file} companion could not be downloaded ({e}), downloading whole file.')
+                return False
+
+    def download_file(self, url: str, file: Path, verification_hash: str,
+                      phase: ProgressPhase | None = None, file_size: int | None = None,
+                      companion: tuple[str, str] | None = None) -> None:
+        """
+        Download file from remote repository.
+        The content is hashed while it is being written, so the file
+        does not have to be read again for the verification.
+        Compressed companion is preferred unless the download is resumed.
+        """
+
+        if phase is None:
+            with self.progress.phase("[bold green]D", file_size, 1) as phase:
+                return self.download_file(url, file, verification_hash, phase, file_size, companion)
 
         resume_byte_position = 0
 
-        # Establish connection to header of file
-        r = requests.head(url)
+        if file_size is None:
+            # Size is not known from the hashtable, ask the server
+            r = self.session.head(url, timeout=self.timeout)
+            file_size = int(r.headers.get('content-length', 0))
 
-        # Get filesize of online and offline file
-        file_size = int(r.headers.get('content-length', 0))
         file = Path(file)
         filedir = Path(file.parents[0]).absolute()
         Path(filedir).mkdir(parents=True, exist_ok=True)
 
+        if self.block_maps_url and file_size >= blocks.MIN_SIZE and self.patch_source(file) is not None:
+            if self.patch_file(url, file, verification_hash, phase):
+                return
+
         if file.exists():
             file_size_offline = file.stat().st_size
 
@@ -82,41 +160,48 @@ class RequestsDownloader(DownloaderBase):
                 console.info(f'{file} is incomplete. Resuming download.')
                 resume_byte_position = file_size_offline
 
+        if companion is not None and not resume_byte_position:
+            if self.download_companion(companion, file, verification_hash, file_size, phase):
+                return
+
         # Append information to resume download at specific byte position
         # to header
         resume_header = ({'Range': f'bytes={resume_byte_position}-'}
                          if resume_byte_position else None)
 
         # Establish connection
-        r = requests.get(url, stream=True, headers=resume_header)
+        r = self.session.get(url, stream=True, headers=resume_header, timeout=self.timeout)
+        if not r.ok:
+            r.close()
+            r.raise_for_status()
+
+        if resume_byte_position and r.status_code != 206:
+            console.info(f'{url} does not support resuming, downloading whole file.')
+            resume_byte_position = 0
 
         # Set configuration
         block_size = 1024
         initial_pos = resume_byte_position if resume_byte_position else 0
         mode = 'ab' if resume_byte_position else 'wb'
 
-        with Progress(TextColumn("[bold green]D: [bold blue]{task.fields[filename]}", justify="right"),
-                      BarColumn(bar_width=None),
-                      "[progress.percentage]{task.percentage:>3.1f}%",
-                      "•",
-                      DownloadColumn(),
-                      "•",
-                      TransferSpeedColumn(),
-                      "•",
-                      TimeRemainingColumn(),) as progress:
-            task = progress.add_task(
-                file.name, filename=file.name, total=file_size, completed=initial_pos)
-
-            with open(file, mode) as f:
-                # with tqdm(total=file_size, unit='B',
-                #           unit_scale=True, unit_divisor=1024,
-                #           desc=file.name, initial=initial_pos,
-                #           ascii=False, leave=False) as progressbar:
-                for chunk in r.iter_content(32 * block_size):
-                    f.write(chunk)
-                    progress.update(task, advance=len(chunk))
-
-        if not self.validate_file(file, verification_hash):
+        sha = new_hash(self.algorithm)
+
+        if resume_byte_position:
+            # Only the part, that is already on disk, has to be read
+            with open(file, 'rb') as f:
+                hash_stream(f, sha, resume_byte_position)
+
+        phase.advance(initial_pos, file.name)
+
+        with open(file, mode) as f:
+            for chunk in r.iter_content(32 * block_size):
+                f.write(chunk)
+                sha.update(chunk)
+                phase.advance(len(chunk))
+
+        phase.complete_file(file.name)
+
+        if not sha.hexdigest() == verification_hash:
             console.error(f'{file} failed verification. Deleting.')
             file.unlink()
-            raise Exception('File failed verification.')
+            raise VerificationError('File failed verification.')
@@ -0,0 +1,342 @@
+"""
+HTTP mirror, that serves a generated tree together with its hashtable
+
+Clients derive the mirror from the URL of the hashtable, so the tree is served
+from its root and paths of the hashtable map directly to URLs. Responses are
+HTTP/1.1 with keep-alive, single Range requests are answered with 206 (resume
+and block patching depend on them) and bodies are sent with sendfile where the
+platform supports it.
+
+ETags are the hashes from the hashtable, as long as the file was not modified
+after the hashtable, otherwise weak ETags from size and modification time are
+used. With precompressed variants enabled, "file.zst", "file.br" or "file.gz"
+next to the file is served to clients, that accept the encoding, except for
+Range requests, that always address the original bytes.
+"""
+
+import email.utils
+import logging as console
+import mimetypes
+import ntpath
+import os
+import posixpath
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import PathLike
+from stat import S_ISREG
+from urllib.parse import unquote, urlsplit
+
+from core import manifest
+from core.hash_cache import STATE_DIRECTORY
+
+# Content encodings of precompressed variants by preference and their suffixes
+ENCODINGS = {"zstd": ".zst", "br": ".br", "gzip": ".gz"}
+
+# Seconds, that an idle keep-alive connection is kept open
+KEEP_ALIVE_TIMEOUT = 30
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """Parse Range header with a single byte range
+
+    Args:
+        header (str): Value of the Range header
+        size (int): Size of the file
+
+    Raises:
+        ValueError: Range can not be satisfied
+
+    Returns:
+        tuple[int, int] | None: First and last byte (inclusive) or None, if the whole file should be sent
+    """
+
+    unit, _, ranges = header.partition("=")
+    # Multiple ranges are not needed by the downloaders, the whole file is a valid answer
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+
+    first, _, last = ranges.strip().partition("-")
+    try:
+        start = int(first) if first else None
+        end = int(last) if last else None
+    except ValueError:
+        return None
+
+    if start is None:
+        # Suffix range, last N bytes
+        if not end or size == 0:
+            raise ValueError("Empty suffix range")
+        return max(0, size - end), size - 1
+
+    if end is not None and start > end:
+        return None
+    if start >= size:
+        raise ValueError("Range starts after the end of the file")
+
+    return start, size - 1 if end is None else min(end, size - 1)
+
+
+def accepted_encodings(header: str) -> set[str]:
+    "Content encodings from Accept-Encoding header, that are not refused by q=0"
+
+    accepted = set()
+    for item in header.split(","):
+        name, *params = [part.strip() for part in item.split(";")]
+        if any(param.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000") for param in params):
+            continue
+        if name:
+            accepted.add(name.lower())
+
+    return accepted
+
+
+class MirrorServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server of a tree and its hashtable
+
+    Args:
+        address (tuple[str, int]): Address and port to bind
+        root (os.PathLike): Directory, that is served
+        hashtable (os.PathLike): Hashtable of the directory, used for ETags
+        precompressed (bool, optional): Serve precompressed variants of files. Defaults to False.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], root: str | PathLike, hashtable: str | PathLike,
+                 precompressed: bool = False):
+        self.root = os.path.abspath(root)
+        self.real_root = os.path.realpath(root)
+        self.hashtable_path = os.path.abspath(hashtable)
+        self.precompressed = precompressed
+
+        self.lock = threading.Lock()
+        self.table: dict[str, dict] = {}
+        self.table_mtime = -1
+        self.reload()
+
+        super().__init__(address, MirrorHandler)
+
+    def reload(self) -> None:
+        "Load the hashtable again if it was regenerated since the last request"
+
+        try:
+            mtime = os.stat(self.hashtable_path).st_mtime_ns
+        except OSError:
+            return
+
+        with self.lock:
+            if mtime == self.table_mtime:
+                return
+
+            try:
+                with open(self.hashtable_path, "rb") as f:
+                    table = manifest.load(f)
+            except (OSError, ValueError) as e:
+                # Hashtable can be in the middle of being written, keep the previous one
+                console.warning(f"Could not load hashtable {self.hashtable_path}: {e}")
+                return
+
+            self.table = {path.replace(os.sep, "/"): entry for path, entry in table.items()}
+            self.table_mtime = mtime
+            console.debug(f"Loaded hashtable with {len(self.table)} files")
+
+    def etag(self, path: str, stat: os.stat_result) -> str:
+        """ETag of file, that is its hash if the hashtable is still valid for the file
+
+        Args:
+            path (str): Path relative to root with "/" as separator
+            stat (os.stat_result): Stat of the file
+
+        Returns:
+            str: Quoted ETag
+        """
+
+        self.reload()
+        entry = self.table.get(path)
+
+        if entry is not None and entry["size"] == stat.st_size and stat.st_mtime_ns <= self.table_mtime:
+            return f'"{entry["hash"]}"'
+
+        return f'W/"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    "Handler of GET and HEAD requests of MirrorServer"
+
+    server: MirrorServer
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, small responses must not wait for delayed ACKs
+    disable_nagle_algorithm = True
+    server_version = "Updater"
+    timeout = KEEP_ALIVE_TIMEOUT
+
+    def do_GET(self):
+        self.serve(body=True)
+
+    def do_HEAD(self):
+        self.serve(body=False)
+
+    def resolve(self) -> str | None:
+        "Path of the request relative to root with '/' as separator, None if it is outside"
+
+        path = unquote(urlsplit(self.path).path)
+        if "\0" in path or "\\" in path:
+            return None
+
+        path = posixpath.normpath("/" + path).lstrip("/")
+        if not path or path == ".." or path.startswith("../"):
+            return None
+
+        # Segment with a drive, like "C:", replaces the root when joined on Windows
+        if any(":" in segment or ntpath.splitdrive(segment)[0] for segment in path.split("/")):
+            return None
+
+        # Local state of the updater is never served
+        if path == STATE_DIRECTORY or path.startswith(STATE_DIRECTORY + "/"):
+            return None
+
+        return path
+
+    def select_variant(self, filename: str, stat: os.stat_result) -> tuple[str, str, os.stat_result] | None:
+        "Precompressed variant of file accepted by the client as (encoding, filename, stat)"
+
+        accepted = accepted_encodings(self.headers.get("Accept-Encoding", ""))
+
+        for encoding, suffix in ENCODINGS.items():
+            if encoding not in accepted:
+                continue
+
+            try:
+                variant = os.stat(filename + suffix)
+            except OSError:
+                continue
+            if not self.contains(filename + suffix):
+                continue
+
+            # Variant older than the file was not regenerated with it
+            if variant.st_mtime_ns >= stat.st_mtime_ns:
+                return encoding, filename + suffix, variant
+
+        return None
+
+    def contains(self, filename: str) -> bool:
+        "Whether the file is inside root after resolving links and drives"
+
+        real_root = self.server.real_root
+        try:
+            return os.path.commonpath([real_root, os.path.realpath(filename)]) == real_root
+        except ValueError:
+            # Paths on different drives
+            return False
+
+    def serve(self, body: bool) -> None:
+        path = self.resolve()
+        filename = os.path.join(self.server.root, *path.split("/")) if path is not None else ""
+
+        try:
+            stat = os.stat(filename) if filename and self.contains(filename) else None
+        except OSError:
+            stat = None
+        if stat is None or not S_ISREG(stat.st_mode):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        etag = self.server.etag(path, stat)  # type: ignore
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        byte_range = None
+        encoding = None
+
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        # If-Range needs a strong ETag, otherwise the whole file is sent
+        if range_header and (if_range is None or (if_range == etag and not etag.startswith("W/"))):
+            try:
+                byte_range = parse_range(range_header, stat.st_size)
+            except ValueError:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{stat.st_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        if self.server.precompressed and range_header is None:
+            variant = self.select_variant(filename, stat)
+            if variant is not None:
+                encoding, filename, stat = variant
+                etag = f'{etag[:-1]}-{encoding}"'
+
+        if etag in (tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        try:
+            f = open(filename, "rb")
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        with f:
+            offset, length = 0, stat.st_size
+            if byte_range is not None:
+                offset, length = byte_range[0], byte_range[1] - byte_range[0] + 1
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header("Content-Range", f"bytes {byte_range[0]}-{byte_range[1]}/{stat.st_size}")
+            else:
+                self.send_response(HTTPStatus.OK)
+
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(length))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", email.utils.formatdate(stat.st_mtime, usegmt=True))
+            if encoding is not None:
+                self.send_header("Content-Encoding", encoding)
+            if self.server.precompressed:
+                self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+
+            if body and length:
+                try:
+                    # Zero-copy where os.sendfile is available, plain send otherwise
+                    self.connection.sendfile(f, offset, length)
+                except (ConnectionError, TimeoutError):
+                    self.close_connection = True
+
+    def log_message(self, format, *args):
+        console.debug(f"{self.address_string()} {format % args}")
+
+    def log_error(self, format, *args):
+        console.warning(f"{self.address_string()} {format % args}")
+
+
+def serve(root: str | PathLike, hashtable: str | PathLike, bind: str = "0.0.0.0", port: int = 8000,
+          precompressed: bool = False) -> None:
+    """Serve directory as mirror until interrupted
+
+    Args:
+        root (os.PathLike): Directory, that is served
+        hashtable (os.PathLike): Hashtable of the directory
+        bind (str, optional): Address to listen on. Defaults to "0.0.0.0".
+        port (int, optional): Port to listen on. Defaults to 8000.
+        precompressed (bool, optional): Serve precompressed variants of files. Defaults to False.
+    """
+
+    with MirrorServer((bind, port), root, hashtable, precompressed) as server:
+        host, port = server.server_address[:2]
+        console.info(f"Serving {server.root} on http://{host}:{port}/")
+
+        relative = os.path.relpath(server.hashtable_path, server.root)
+        if relative.startswith(os.pardir):
+            console.warning("Hashtable is outside of the served directory, clients can not download it")
+        else:
+            console.info(f"Hashtable: http://{host}:{port}/{relative.replace(os.sep, '/')}")
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            console.info("Server stopped")
@@ -0,0 +1,315 @@
+"""
+Staging of updates, that are applied to the destination at once
+
+Downloaded and copied files are written to ".updater/staging" inside the
+destination, so they are on the same filesystem and can be moved into place
+with os.replace. Every verified file is appended to the journal
+".updater/journal" together with its hash cache entry:
+
+    {"path": "relative/path", "entry": [size, mtime_ns, inode, "hash", "algorithm"]}
+
+When everything is staged, the staged files are synced and the moves and
+removals are written to the journal and synced, before the first file of the
+destination is touched:
+
+    {"commit": ["relative/path", ...], "remove": ["relative/path", ...]}
+
+A run interrupted while downloading leaves the verified files and partial
+downloads to the next one. A run interrupted while committing is finished by
+the next one, files, that were committed already, get their journaled hash
+into the hash cache instead of being hashed again.
+"""
+
+import json
+import logging as console
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import PathLike
+from pathlib import Path
+from typing import TextIO
+
+from core.hash_cache import STATE_DIRECTORY, HashCache
+
+STAGING_DIRECTORY = "staging"
+JOURNAL_FILE = "journal"
+
+# Number of renames or fsyncs handed to a worker at once
+BATCH_SIZE = 256
+
+
+def fsync(path: str) -> None:
+    "Flush file or directory to disk, files are opened for writing on Windows, where fsync needs it"
+
+    fd = os.open(path, os.O_RDWR if os.name == "nt" else os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Stage():
+    """
+    Staging area and journal of an update
+
+    Args:
+        root (os.PathLike): Destination directory
+        jobs (int, optional): Number of workers renaming files into place. Defaults to 1.
+    """
+
+    def __init__(self, root: str | PathLike = ".", jobs: int = 1):
+        self.root = str(root)
+        self.directory = os.path.join(self.root, STATE_DIRECTORY, STAGING_DIRECTORY)
+        self.file = os.path.join(self.root, STATE_DIRECTORY, JOURNAL_FILE)
+        self.jobs = max(1, jobs)
+
+        # Hash cache entries of verified staged files by their relative path
+        self.entries: dict[str, list] = {}
+        self.removals: list[str] = []
+
+        self.lock = threading.Lock()
+        self.journal: TextIO | None = None
+
+    @staticmethod
+    def key(path: str) -> str:
+        return Path(os.path.normpath(path)).as_posix()
+
+    def path(self, relative_path: str) -> str:
+        "Staged location of file"
+
+        return os.path.join(self.directory, relative_path)
+
+    def original(self, file: str | PathLike) -> Path | None:
+        "Location in the destination of staged file, None if file is not staged"
+
+        relative_path = os.path.relpath(file, self.directory)
+        if relative_path == os.curdir or relative_path.startswith(os.pardir):
+            return None
+
+        return Path(self.root, relative_path)
+
+    def read(self) -> tuple[dict[str, list], dict | None]:
+        "Staged entries and the commit recorded in the journal"
+
+        entries: dict[str, list] = {}
+        commit = None
+
+        try:
+            with open(self.file, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line can be cut off by a crash
+                        continue
+
+                    if "commit" in record:
+                        commit = record
+                    elif "path" in record:
+                        entries[record["path"]] = record["entry"]
+        except FileNotFoundError:
+            pass
+
+        return entries, commit
+
+    def append(self, record: dict, sync: bool = False) -> None:
+        with self.lock:
+            if self.journal is None:
+                os.makedirs(os.path.dirname(self.file), exist_ok=True)
+                self.journal = open(self.file, "a", encoding="utf-8")
+
+            self.journal.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+            self.journal.flush()
+            if sync:
+                os.fsync(self.journal.fileno())
+
+    def close(self) -> None:
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+    def recover(self, hash_cache: HashCache) -> bool:
+        """Finish commit of an interrupted update
+
+        Args:
+            hash_cache (HashCache): Cache, that receives hashes of the committed files
+
+        Returns:
+            bool: True if an interrupted commit was finished
+        """
+
+        entries, commit = self.read()
+        if commit is None:
+            return False
+
+        console.warning("Previous update was interrupted while it was applied, finishing it")
+        self.entries = entries
+        self.apply(commit["commit"], commit["remove"], hash_cache)
+        return True
+
+    def begin(self, hashtable: dict[str, dict]) -> None:
+        """Load files staged by an interrupted update, that are still valid for hashtable
+
+        Args:
+            hashtable (dict): Hashtable, that the destination is updated to
+        """
+
+        self.close()
+        self.removals = []
+        self.entries = {}
+
+        entries, _ = self.read()
+        if not entries:
+            return
+
+        wanted = {self.key(path): entry["hash"] for path, entry in hashtable.items()}
+        for path, entry in entries.items():
+            if wanted.get(path) != entry[3]:
+                continue
+
+            try:
+                stat = os.stat(self.path(path))
+            except OSError:
+                continue
+
+            if HashCache.signature(stat) == entry[:3]:
+                self.entries[path] = entry
+
+        console.debug(f"Staging - {len(self.entries)} files staged by an interrupted update")
+
+    def is_staged(self, path: str, hash: str) -> bool:
+        "Check if verified content is staged for path"
+
+        entry = self.entries.get(self.key(path))
+        return entry is not None and entry[3] == hash
+
+    def record(self, path: str, hash: str, algorithm: str, size: int) -> None:
+        """Record staged file, that was verified
+
+        Args:
+            path (str): Path relative to the destination
+            hash (str): Hash of the staged content
+            algorithm (str): Algorithm of hash
+            size (int): Size of the file, file of another size was not finished and is left out
+        """
+
+        try:
+            stat = os.stat(self.path(path))
+        except FileNotFoundError:
+            return
+
+        if stat.st_size != size:
+            return
+
+        path = self.key(path)
+        entry = HashCache.signature(stat) + [hash, algorithm]
+
+        with self.lock:
+            self.entries[path] = entry
+        self.append({"path": path, "entry": entry})
+
+    def remove(self, paths: list[str]) -> None:
+        "Remove files from the destination, when the update is committed"
+
+        self.removals.extend(self.key(path) for path in paths)
+
+    def commit(self, hash_cache: HashCache) -> None:
+        """Move staged files into the destination and remove files
+
+        Args:
+            hash_cache (HashCache): Cache, that receives hashes of the committed files
+        """
+
+        moves = sorted(self.entries)
+        if not moves and not self.removals:
+            self.clear()
+            return
+
+        # Once the commit is synced, the next run finishes it whatever happens,
+        # so the staged content has to reach the disk before it
+        self.sync(moves)
+        self.append({"commit": moves, "remove": self.removals}, sync=True)
+        self.apply(moves, self.removals, hash_cache)
+
+    def sync(self, paths: list[str]) -> None:
+        "Write staged files and the directories, that hold them and the journal, through to disk"
+
+        def flush(batch: list[str]) -> None:
+            for path in batch:
+                try:
+                    fsync(self.path(path))
+                except FileNotFoundError:
+                    pass
+
+        # Files are independent of each other, their fsyncs overlap
+        batches = [paths[i:i + BATCH_SIZE] for i in range(0, len(paths), BATCH_SIZE)]
+        with ThreadPoolExecutor(self.jobs) as pool:
+            list(pool.map(flush, batches))
+
+        # New names live in their directories, Windows can not open directories
+        if os.name != "nt":
+            directories = {os.path.dirname(self.path(path)) for path in paths}
+            directories.add(os.path.dirname(self.file))
+            for directory in sorted(directories):
+                fsync(directory)
+
+    def apply(self, moves: list[str], removals: list[str], hash_cache: HashCache) -> None:
+        start = time.perf_counter()
+
+        for path in removals:
+            try:
+                os.remove(os.path.join(self.root, path))
+            except FileNotFoundError:
+                pass
+
+        for directory in {os.path.dirname(path) for path in moves}:
+            os.makedirs(os.path.join(self.root, directory), exist_ok=True)
+
+        def replace(batch: list[str]) -> None:
+            for path in batch:
+                destination = os.path.join(self.root, path)
+                try:
+                    os.replace(self.path(path), destination)
+                except FileNotFoundError:
+                    # Moved before the commit was interrupted
+                    if not os.path.exists(destination):
+                        raise
+
+        # Renames of different files do not depend on each other
+        batches = [moves[i:i + BATCH_SIZE] for i in range(0, len(moves), BATCH_SIZE)]
+        with ThreadPoolExecutor(self.jobs) as pool:
+            list(pool.map(replace, batches))
+
+        elapsed = time.perf_counter() - start
+
+        for path in moves:
+            entry = self.entries.get(path)
+            try:
+                stat = os.stat(os.path.join(self.root, path))
+            except FileNotFoundError:
+                continue
+
+            # Renaming keeps the signature, so the file is still the verified one
+            if entry is not None and HashCache.signature(stat) == entry[:3]:
+                hash_cache.set(path, stat, entry[3], entry[4])
+
+        hash_cache.save()
+        self.clear()
+
+        console.info(f"Applied {len(moves)} files and removed {len(removals)} files in {elapsed:.2f} s")
+
+    def clear(self) -> None:
+        "Delete the staging area and the journal"
+
+        self.close()
+        self.entries = {}
+        self.removals = []
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+        try:
+            os.remove(self.file)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,150 @@
+"""
+Performance counters of a run
+
+When enabled, counters, wall time of phases and histograms of per-file
+latencies are collected and reported as a summary or written as JSON:
+
+    {"version": 1, "total": 3.2,
+     "counters": {"files_hashed": 12, "bytes_hashed": 50331648, ...},
+     "phases": {"verify": 1.5, "download": 1.6, ...},
+     "histograms": {"transfer_seconds": {"count": 3, "sum": 0.4, "max": 0.2,
+                                         "buckets": {"0.001": 0, ..., "+Inf": 0}}}}
+
+Phases can be nested, so their times do not have to add up to the total.
+Disabled stats only check a flag, so the instrumentation stays in the hot paths.
+"""
+
+import bisect
+import json
+import logging as console
+import os
+import threading
+import time
+from contextlib import contextmanager
+from os import PathLike
+from typing import Iterator
+
+VERSION = 1
+
+# Upper bounds of histogram buckets in seconds, the last bucket is unbounded
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+
+class Histogram():
+    "Counts of observed durations in fixed buckets"
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        "Upper bound of the bucket, that holds the q-th observation"
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_json(self) -> dict:
+        buckets = {str(bound): count for bound, count in zip(BUCKETS, self.counts)}
+        buckets["+Inf"] = self.counts[-1]
+        return {"count": self.count, "sum": round(self.sum, 6), "max": round(self.max, 6), "buckets": buckets}
+
+
+class Stats():
+    """
+    Counters, phase times and histograms of a run
+
+    Args:
+        enabled (bool, optional): Collect anything at all. Defaults to False.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.counters: dict[str, int] = {}
+        self.phases: dict[str, float] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def add(self, name: str, value: int = 1) -> None:
+        "Increase counter"
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        "Add duration to histogram"
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        "Add wall time of the block to phase"
+
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def to_json(self) -> dict:
+        with self.lock:
+            return {
+                "version": VERSION,
+                "total": round(time.perf_counter() - self.start, 6),
+                "counters": dict(self.counters),
+                "phases": {name: round(seconds, 6) for name, seconds in self.phases.items()},
+                "histograms": {name: histogram.to_json() for name, histogram in self.histograms.items()},
+            }
+
+    def report(self) -> None:
+        "Log summary of the run"
+
+        data = self.to_json()
+
+        console.info(f"Stats: total {data['total']:.2f} s")
+        if data["phases"]:
+            console.info("  Phases: " + ", ".join(
+                f"{name} {seconds:.2f} s" for name, seconds in data["phases"].items()))
+        for name in sorted(data["counters"]):
+            console.info(f"  {name}: {data['counters'][name]}")
+        for name, histogram in self.histograms.items():
+            console.info(f"  {name}: {histogram.count} observed, p50 {histogram.quantile(0.5) * 1000:.0f} ms, "
+                         f"p90 {histogram.quantile(0.9) * 1000:.0f} ms, p99 {histogram.quantile(0.99) * 1000:.0f} ms, "
+                         f"max {histogram.max * 1000:.0f} ms")
+
+    def dump(self, file: str | PathLike) -> None:
+        "Atomically write stats as JSON"
+
+        tmp = str(file) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.to_json(), f, indent=2)
+        os.replace(tmp, file)
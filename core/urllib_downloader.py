@@ -1,29 +1,19 @@
+import json
+import logging as console
 import os.path
 import signal
-from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from os import PathLike
 from pathlib import Path
-from threading import Event
-from urllib.request import urlopen
+from threading import current_thread, main_thread
+from typing import Iterable
+from urllib.error import URLError
+from urllib.request import Request, urlopen
 
-from rich.progress import (BarColumn, DownloadColumn, Progress, TaskID,
-                           TextColumn, TimeRemainingColumn,
-                           TransferSpeedColumn)
-
-from .downloader_template import DownloaderBase
-
-progress = Progress(
-    TextColumn("[bold blue]{task.fields[filename]}", justify="right"),
-    BarColumn(bar_width=None),
-    "[progress.percentage]{task.percentage:>3.1f}%",
-    "•",
-    DownloadColumn(),
-    "•",
-    TransferSpeedColumn(),
-    "•",
-    TimeRemainingColumn(),
-)
+from . import blocks
+from .downloader_template import DownloadCancelled, DownloaderBase, VerificationError
+from .hashing import DEFAULT_ALGORITHM, new_hash
+from .progress import ProgressPhase, ProgressReporter
+from .staging import Stage
 
 
 class UrllibDownloader(DownloaderBase):
@@ -34,40 +24,98 @@ class UrllibDownloader(DownloaderBase):
     def handle_sigint(self, signum, frame):
         self.done_event.set()
 
-    def __init__(self) -> None:
-        self.done_event = Event()
-        signal.signal(signal.SIGINT, self.handle_sigint)
+    def __init__(self, progress: ProgressReporter | None = None, connections: int = 4,
+                 block_maps_url: str | None = None, algorithm: str = DEFAULT_ALGORITHM,
+                 companions_path: str | None = None, stage: Stage | None = None) -> None:
+        super().__init__(progress, block_maps_url, algorithm, companions_path, stage)
+        self.connections = max(1, connections)
+        # Signal handlers can be installed only by the main thread, embedders cancel updates themselves
+        if current_thread() is main_thread():
+            signal.signal(signal.SIGINT, self.handle_sigint)
+
+    def fetch_range(self, url: str, start: int, end: int) -> Iterable[bytes]:
+        """Stream bytes between start and end (inclusive) of url."""
+        response = urlopen(
+            Request(url, headers={"Range": f"bytes={start}-{end}"}), timeout=self.timeout)
+        if response.status != 206:
+            response.close()
+            raise blocks.PatchError(f"{url} does not support ranges")
+        with response:
+            yield from iter(partial(response.read, 32768), b"")
+
+    def patch_file(self, phase: ProgressPhase, url: str, path: str, verification_hash: str) -> bool:
+        """Download only changed blocks of file, returns False if it has to be downloaded whole."""
+        try:
+            with urlopen(blocks.block_map_url(self.block_maps_url, verification_hash),  # type: ignore
+                         timeout=self.timeout) as response:
+                block_map = json.load(response)
+        except (URLError, ValueError):
+            return False
+
+        try:
+            return blocks.patch_file(self.patch_source(path), block_map, verification_hash,  # type: ignore
+                                     partial(self.fetch_range, url), phase, self.algorithm, Path(path))
+        except (URLError, blocks.PatchError) as e:
+            console.info(f"{path} can not be patched ({e}), downloading whole file.")
+            return False
+
+    def download_companion(self, phase: ProgressPhase, companion: tuple[str, str], path: str,
+                           verification_hash: str, size: int) -> bool:
+        """Download compressed companion of file, returns False if the file has to be downloaded as it is."""
+        url, encoding = companion
+
+        try:
+            response = urlopen(url, timeout=self.timeout)
+        except URLError as e:
+            console.debug(f"{path} has no companion ({e})")
+            return False
 
-    def copy_url(self, task_id: TaskID, url: str, path: str) -> None:
-        """Copy data from a url to a local file."""
-        response = urlopen(url)
+        def chunks():
+            while not self.done_event.is_set() and (data := response.read(32768)):
+                yield data
 
-        # This will break if the response doesn't contain content length
-        progress.update(task_id, total=int(response.info()["Content-length"]))
+        with response:
+            try:
+                return self.decompress_into(chunks(), Path(path), encoding, size, verification_hash, phase)
+            except OSError as e:
+                console.info(f"{path} companion could not be downloaded ({e}), downloading whole file.")
+                return False
 
-        with open(path, "wb") as dest_file:
-            progress.start_task(task_id)
+    def copy_url(self, phase: ProgressPhase, url: str, path: str, verification_hash: str | None = None,
+                 size: int = 0, companion: tuple[str, str] | None = None) -> None:
+        """Copy data from a url to a local file, verifying it on the way, compressed companion is preferred.
+        Raises DownloadCancelled when done_event is set, so the partial file is not staged."""
+        if self.block_maps_url and verification_hash is not None \
+                and size >= blocks.MIN_SIZE and self.patch_source(path) is not None:
+            if self.patch_file(phase, url, path, verification_hash):
+                return
+
+        if companion is not None and verification_hash is not None:
+            if self.download_companion(phase, companion, path, verification_hash, size):
+                return
+            if self.done_event.is_set():
+                raise DownloadCancelled(f"{path} was cancelled")
+
+        response = urlopen(url, timeout=self.timeout)
+        filename = Path(path).name
+        sha = new_hash(self.algorithm)
+
+        with response, open(path, "wb") as dest_file:
             for data in iter(partial(response.read, 32768), b""):
                 dest_file.write(data)
-                progress.update(task_id, advance=len(data))
+                sha.update(data)
+                phase.advance(len(data), filename)
                 if self.done_event.is_set():
-                    return
-
-    def download(self, compared: dict[str, dict[str, int]], mirror: str,  dest_dir: str | PathLike):
-        """Download multuple files to the given directory."""
-
-        urls = [(mirror+i, i) for i in compared.keys()]
-
-        for url, file in urls:
-            dest_path = os.path.join(dest_dir, file)
-            file = Path(dest_path)
-            filedir = Path(file.parents[0]).absolute()
-            Path(filedir).mkdir(parents=True, exist_ok=True)
-
-        with progress:
-            with ThreadPoolExecutor(max_workers=4) as pool:
-                for url, file in urls:
-                    dest_path = os.path.join(dest_dir, file)
-                    task_id = progress.add_task(
-                        "Downloading", filename=file, start=False)
-                    pool.submit(self.copy_url, task_id, url, dest_path)
+                    raise DownloadCancelled(f"{path} was cancelled")
+
+        phase.complete_file(filename)
+
+        if verification_hash is not None and sha.hexdigest() != verification_hash:
+            console.error(f'{path} failed verification. Deleting.')
+            os.remove(path)
+            raise VerificationError('File failed verification.')
+
+    def download_url(self, url: str, file: Path, entry: dict, phase: ProgressPhase,
+                     companion: tuple[str, str] | None = None) -> None:
+        file.parent.absolute().mkdir(parents=True, exist_ok=True)
+        self.copy_url(phase, url, str(file), entry["hash"], entry["size"], companion)
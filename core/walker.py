@@ -0,0 +1,204 @@
+"""
+Enumeration of files in the source tree
+
+Exclude patterns follow the gitignore syntax and are relative to the root:
+
+venv           - file or directory named "venv" at any depth
+*.pyc          - "*" and "?" never match "/"
+/build         - leading or inner "/" anchors the pattern to the root
+logs/          - trailing "/" matches only directories
+assets/**/tmp  - "**" matches any number of directories
+!keep.pyc      - "!" includes again what an earlier pattern excluded
+
+Patterns are normalized first, so "./venv" is the same as "/venv". Absolute
+paths are excluded exactly, if they are inside the root, other absolute paths
+are patterns anchored to the root.
+"""
+
+import os
+import re
+from os import PathLike
+from typing import Iterator
+
+from core.hash_cache import STATE_DIRECTORY
+
+
+def translate(pattern: str) -> str:
+    "Translate gitignore-style glob into regular expression"
+
+    out = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+
+        if char == "*":
+            out.append("[^/]*")
+        elif char == "?":
+            out.append("[^/]")
+        elif char == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            content = pattern[i + 1:end]
+            if content.startswith("!"):
+                content = "^" + content[1:]
+            out.append("[" + content.replace("\\", "\\\\") + "]")
+            i = end
+        else:
+            out.append(re.escape(char))
+        i += 1
+
+    return "".join(out)
+
+
+def normalize(pattern: str) -> str:
+    "Pattern without leading './', redundant separators and leading or trailing '/'"
+
+    while pattern.startswith("./"):
+        pattern = pattern[2:]
+
+    pattern = os.path.normpath(pattern.strip("/") or os.curdir).replace(os.sep, "/")
+    return "" if pattern == os.curdir else pattern
+
+
+class ExcludeMatcher():
+    """
+    Exclude patterns compiled once for the whole walk
+
+    Args:
+        patterns (list[str]): Gitignore-style patterns or absolute paths
+        root (os.PathLike, optional): Directory, that the patterns are relative to. Defaults to ".".
+    """
+
+    def __init__(self, patterns: list[str], root: str | PathLike = "."):
+        # (regex, matches full path, directories only, negated) in order of patterns
+        self.rules: list[tuple[re.Pattern, bool, bool, bool]] = []
+        root = os.path.abspath(root)
+
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+
+            if os.path.isabs(pattern):
+                relative = os.path.relpath(pattern, root)
+                if relative == os.curdir:
+                    continue
+                if not relative.startswith(os.pardir):
+                    self.rules.append((re.compile(re.escape(relative.replace(os.sep, "/"))),
+                                       True, False, False))
+                    continue
+
+            negated = pattern.startswith("!")
+            pattern = pattern.removeprefix("!").replace(os.sep, "/")
+            directory = pattern.endswith("/")
+            # "./venv" names the directory at the root, like "/venv" does
+            anchored = pattern.startswith(("/", "./"))
+            pattern = normalize(pattern)
+            if not pattern:
+                continue
+            anchored = anchored or "/" in pattern
+
+            self.rules.append((re.compile(translate(pattern)),
+                               anchored, directory, negated))
+
+        self.negations = any(rule[3] for rule in self.rules)
+
+        if not self.negations:
+            # Without negations the order does not matter, so every group is a single regex
+            def combine(full_path: bool, directories: bool) -> re.Pattern | None:
+                group = [regex.pattern for regex, anchored, directory, _ in self.rules
+                         if anchored == full_path and (directories or not directory)]
+                return re.compile("|".join(f"(?:{p})" for p in group)) if group else None
+
+            self.combined = {(full_path, directories): combine(full_path, directories)
+                             for full_path in (True, False) for directories in (True, False)}
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
+
+    def match(self, relative_path: str, name: str, is_dir: bool) -> bool:
+        """Check if entry is excluded
+
+        Args:
+            relative_path (str): Path relative to root with "/" as separator
+            name (str): Last part of the path
+            is_dir (bool): Entry is a directory
+
+        Returns:
+            bool: True if the entry is excluded
+        """
+
+        if not self.negations:
+            full = self.combined[(True, is_dir)]
+            base = self.combined[(False, is_dir)]
+            return bool((base is not None and base.fullmatch(name)) or
+                        (full is not None and full.fullmatch(relative_path)))
+
+        excluded = False
+        for regex, anchored, directory, negated in self.rules:
+            if directory and not is_dir:
+                continue
+            if regex.fullmatch(relative_path if anchored else name):
+                excluded = not negated
+
+        return excluded
+
+
+def walk(root: str | PathLike, matcher: ExcludeMatcher | None = None) -> Iterator[tuple[str, os.stat_result]]:
+    """Yield all files below root, excluded directories are never entered
+
+    Symbolic links to directories are not followed, same as os.walk does.
+
+    Args:
+        root (os.PathLike): Directory, that will be walked
+        matcher (ExcludeMatcher, optional): Excluded files and directories. Defaults to None.
+
+    Yields:
+        tuple[str, os.stat_result]: Path relative to root with "/" as separator and stat of the file
+    """
+
+    stack = [(str(root), "")]
+
+    while stack:
+        directory, prefix = stack.pop()
+
+        try:
+            entries = os.scandir(directory)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+
+        with entries:
+            for entry in entries:
+                relative_path = prefix + entry.name
+
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+
+                if is_dir:
+                    # Local state of the updater is never part of the hashtable
+                    if entry.is_symlink() or relative_path == STATE_DIRECTORY:
+                        continue
+                    if matcher and matcher.match(relative_path, entry.name, True):
+                        continue
+                    stack.append((entry.path, relative_path + "/"))
+                    continue
+
+                if not entry.is_file() or (matcher and matcher.match(relative_path, entry.name, False)):
+                    continue
+
+                try:
+                    # Size and the hash cache signature come from this stat, no file is stat'ed twice,
+                    # except on Windows, where DirEntry.stat() has no inode and would never match os.stat()
+                    yield relative_path, os.stat(entry.path) if os.name == "nt" else entry.stat()
+                except OSError:
+                    continue
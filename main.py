@@ -1,27 +1,55 @@
 import argparse
 import logging as console
+import multiprocessing
+import os
 import re
-
-import coloredlogs
-import rich.traceback
+import sys
 
 import updater
 
-# Apply rich tracebacks
-rich.traceback.install()
-
 # Set up parsing of command line arguments
 parser = argparse.ArgumentParser()
 parser.add_argument("-g", "--generate", action="store_true",
                     help="Generate hashtable of current directory (recursive)")
+parser.add_argument("--format", type=str, default="json", choices=["json", "binary"],
+                    help="Format of the generated or converted hashtable")
+parser.add_argument("--algorithm", type=str, default="sha256", choices=["sha256", "blake2b", "xxh3"],
+                    help="Hash algorithm of the generated hashtable, xxh3 is a fast checksum for change detection and needs the xxhash package")
+parser.add_argument("--compress", action="store_true",
+                    help="Compress hashtable in binary format")
+parser.add_argument("--convert", type=str, metavar="OUTPUT",
+                    help="Convert hashtable to --format, write it to OUTPUT and exit")
+parser.add_argument("--versioned", action="store_true",
+                    help="Publish delta against the previous hashtable, so that clients download only changes")
+parser.add_argument("--keep-deltas", type=int, default=100,
+                    help="Number of hashtable deltas, that are kept for clients")
+parser.add_argument("--base", type=str,
+                    help="Previous hashtable, entries of files, that kept the stat signatures written next to it (BASE.stat), are reused instead of hashing them")
+parser.add_argument("--incremental", action="store_true",
+                    help="Use the existing output hashtable as --base")
+parser.add_argument("--blocks", action="store_true",
+                    help="Publish block maps, so that clients download only changed parts of large files")
+parser.add_argument("--companions", type=str, choices=["gzip", "zstd"],
+                    help="Publish compressed copies of files next to the hashtable, that clients download instead, zstd needs the zstandard package")
+parser.add_argument("--block-size", type=int, default=1024 * 1024,
+                    help="Size of blocks in block maps in bytes")
 parser.add_argument("-e", "--exclude", type=str,
-                    help="Exclude directories or files separated by comma (',') (buidl,dist,venv,__pycache__)")
+                    help="Exclude directories or files separated by comma (',') (buidl,dist,venv,__pycache__), gitignore-style patterns like '*.pyc' or '/logs/' are supported")
+parser.add_argument("--serve", action="store_true",
+                    help="Serve the destination directory and its hashtable as mirror over HTTP")
+parser.add_argument("--bind", type=str, default="0.0.0.0",
+                    help="Address, that the mirror listens on")
+parser.add_argument("--port", type=int, default=8000,
+                    help="Port, that the mirror listens on")
+parser.add_argument("--precompressed", action="store_true",
+                    help="Serve precompressed variants (file.zst, file.br, file.gz) to clients, that accept them")
 parser.add_argument("--verify", action="store_true",
                     help="Don't download the files, just verify integrity")
 parser.add_argument("-y", "--yes", action="store_true",
                     help="Say yes to any prompt")
 parser.add_argument("-m", "--mirror", type=str,
-                    help="URL, that will be used as root for downloading")
+                    help="URL, that will be used as root for downloading, "
+                         "several comma separated mirrors share the download and take over failed files")
 parser.add_argument("-c", "--no-changed", action="store_true",
                     help="Suppress outputting list of differences")
 parser.add_argument("-a", "--hash_all", action="store_true",
@@ -32,63 +60,143 @@ parser.add_argument("-v", "--verbose", action="store_true",
                     help="Verbose output", default=False)
 parser.add_argument("-r", "--reset", action="store_true", default=False,
                     help="Overwrite any changes made to the files, reset everything to the remote state")
+parser.add_argument("--rehash", action="store_true", default=False,
+                    help="Ignore the local hash cache and hash all files again")
+parser.add_argument("--trust-mtime", action="store_true", default=False,
+                    help="Do not hash files, whose size and modification time did not change since the last successful update")
+parser.add_argument("-j", "--jobs", type=int, default=1,
+                    help="Number of workers used for hashing files")
+parser.add_argument("-q", "--quiet", action="store_true", default=False,
+                    help="Do not show any progress bars")
 parser.add_argument("--downloader", type=str,
-                    default="requests", choices=["requests", "urllib"], help="Specific downloader that will be used")
+                    default="requests", choices=["requests", "urllib", "asyncio"], help="Specific downloader that will be used")
+parser.add_argument("--connections", type=int, default=4,
+                    help="Number of files downloaded in parallel")
+parser.add_argument("--link", type=str, default="reflink", choices=["reflink", "copy", "hardlink"],
+                    help="How files with the same content are created from each other, hardlinked files share all future changes")
+parser.add_argument("--pipeline", action="store_true", default=False,
+                    help="Start downloading while local files are still being verified")
+parser.add_argument("--stats", action="store_true", default=False,
+                    help="Report counters and timings of the run at the end")
+parser.add_argument("--stats-json", type=str, metavar="FILE",
+                    help="Write counters, timings and latency histograms of the run to FILE as JSON")
 parser.add_argument("hashtable", type=str, help="URL or path to hashtable")
-args = parser.parse_args()
 
-# Change logging level to DEBUG if verbose is set
 
+def ask(message: str) -> bool:
+    "Ask on the terminal to start the update, passed to Updater.run() unless --yes is given"
 
-if args.verbose:
-    # Apply colored logs
-    coloredlogs.install(
-        level='DEBUG', fmt='%(levelname)s | %(asctime)s | %(message)s', datefmt=r"%H:%M:%S"
-    )
-else:
-    # Apply colored logs
-    coloredlogs.install(
-        level='INFO', fmt='%(levelname)s | %(asctime)s | %(message)s', datefmt=r"%H:%M:%S"
-    )
+    return input(f"{message}\nDo you want to start download ? (y/n): ").strip().lower() == "y"
 
-# Correct exclude list if it is set
-args.exclude = args.exclude.split(",") if args.exclude != None else []
-console.debug(f"Parsed exclude: {args.exclude}")
 
-args.yes = not args.yes
+def excepthook(*exc_info):
+    "Render uncaught exception with rich, it is imported only when there is something to render"
 
-main_updater = updater.Updater(args.destination)
+    import rich.traceback
 
-if args.generate:
-    # Generate hashtable and exit
+    rich.traceback.install()
+    sys.excepthook(*exc_info)
 
-    console.debug("Generating hashtable")
-    main_updater.dump_hashtable(args.hashtable, args.exclude)
-    console.info("Hashtable generated")
-elif args.verify:
-    # Verify local files based on remote, output difference and exit
 
-    console.debug("Verifying...")
-    changed, size = main_updater.compare(args.hashtable)
-    changed = list(changed)  # type: ignore
-    changed.sort()  # type: ignore
+def setup_logging(verbose: bool) -> None:
+    # Change logging level to DEBUG if verbose is set
+    level = "DEBUG" if verbose else "INFO"
+    fmt = "%(levelname)s | %(asctime)s | %(message)s"
 
-    print("---Changed or missing files---")
-    for item in changed:
-        print(item)
+    if sys.stderr.isatty():
+        # Apply colored logs
+        import coloredlogs
 
-    print("Total size: " + main_updater.human_readable(size))
-else:
-    if not args.mirror:
-        # strip the last part of url
-        pattern = re.compile(r"(.*/)")
-        args.mirror = pattern.search(args.hashtable).group(1)  # type: ignore
+        coloredlogs.install(level=level, fmt=fmt, datefmt=r"%H:%M:%S")
+    else:
+        # Colors are not rendered into pipes anyway, plain logging starts faster
+        console.basicConfig(level=level, format=fmt, datefmt=r"%H:%M:%S")
 
-        console.info(f"Using mirror: {args.mirror}")
 
-        # We need slash at the end of mirror for correct URIs
-        if not args.mirror[-1] == "/":
-            args.mirror += "/"
+def main():
+    # Apply rich tracebacks
+    sys.excepthook = excepthook
+
+    args = parser.parse_args()
+
+    setup_logging(args.verbose)
+
+    # Correct exclude list if it is set
+    args.exclude = args.exclude.split(",") if args.exclude != None else []
+    console.debug(f"Parsed exclude: {args.exclude}")
+
+    main_updater = updater.Updater(
+        args.destination, rehash=args.rehash, jobs=args.jobs, quiet=args.quiet, trust_mtime=args.trust_mtime,
+        stats=args.stats or args.stats_json is not None)
+
+    try:
+        run(main_updater, args)
+    finally:
+        # Stats of failed runs are the interesting ones
+        if args.stats:
+            main_updater.stats.report()
+        if args.stats_json:
+            main_updater.stats.dump(args.stats_json)
+
+
+def run(main_updater: updater.Updater, args: argparse.Namespace):
+    if args.generate:
+        # Generate hashtable and exit
 
-    console.debug("Downloading hashtable...")
-    main_updater.run(args.mirror, args.hashtable, args.yes, args.reset, args.downloader)
+        console.debug("Generating hashtable")
+
+        if args.incremental and not args.base and os.path.isfile(args.hashtable):
+            args.base = args.hashtable
+
+        main_updater.dump_hashtable(
+            args.hashtable, args.exclude, args.format, args.compress, args.versioned, args.keep_deltas, args.base,
+            args.block_size if args.blocks else None, args.algorithm, args.companions)
+        console.info("Hashtable generated")
+    elif args.convert:
+        # Convert hashtable to another format and exit
+
+        main_updater.convert_hashtable(
+            args.hashtable, args.convert, args.format, args.compress)
+        console.info(f"Hashtable converted to {args.convert}")
+    elif args.serve:
+        # Serve the tree as mirror until interrupted
+
+        main_updater.serve(args.hashtable, args.bind, args.port, args.precompressed)
+    elif args.verify:
+        # Verify local files based on remote, output difference and exit
+
+        console.debug("Verifying...")
+        changed, size = main_updater.compare(args.hashtable)
+        changed = list(changed)  # type: ignore
+        changed.sort()  # type: ignore
+
+        print("---Changed or missing files---")
+        for item in changed:
+            print(item)
+
+        print("Total size: " + main_updater.human_readable(size))
+    else:
+        if not args.mirror:
+            # strip the last part of url
+            pattern = re.compile(r"(.*/)")
+            args.mirror = pattern.search(args.hashtable).group(1)  # type: ignore
+
+            console.info(f"Using mirror: {args.mirror}")
+
+        # We need slash at the end of mirror for correct URIs
+        mirrors = [mirror if mirror.endswith("/") else mirror + "/"
+                   for mirror in (mirror.strip() for mirror in args.mirror.split(",")) if mirror]
+
+        console.debug("Downloading hashtable...")
+        try:
+            if not main_updater.run(mirrors, args.hashtable, None if args.yes else ask,
+                                    args.reset, args.downloader, args.connections, args.link, args.pipeline):
+                console.warning("Cancelled by user, quitting")
+        except KeyboardInterrupt:
+            console.warning("\nCancelled by user, quitting")
+
+
+if __name__ == "__main__":
+    # Needed by the process pool in frozen (pyinstaller) builds
+    multiprocessing.freeze_support()
+    main()
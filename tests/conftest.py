@@ -0,0 +1,120 @@
+import os
+import signal
+import threading
+
+import pytest
+
+from core.server import MirrorHandler, MirrorServer
+from updater import Updater
+
+DOWNLOADERS = ["requests", "urllib", "asyncio"]
+
+# Mirror, that refuses every connection
+DEAD_MIRROR = "http://127.0.0.1:1/"
+
+
+class RecordingHandler(MirrorHandler):
+    "Handler, that keeps path and headers of every request in server.requests"
+
+    def serve(self, body: bool) -> None:
+        self.server.requests.append((self.path, dict(self.headers)))  # type: ignore
+        super().serve(body)
+
+    def log_message(self, format, *args):
+        pass
+
+    def log_error(self, format, *args):
+        # Clients probe for optional files like hashtable deltas
+        pass
+
+
+def write_tree(root: str, files: dict[str, bytes]) -> None:
+    for path, content in files.items():
+        file = os.path.join(root, path)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, "wb") as f:
+            f.write(content)
+
+
+def read_tree(root: str) -> dict[str, bytes]:
+    "Content of every file under root except the updater state"
+
+    files = {}
+    for directory, dirs, names in os.walk(root):
+        dirs[:] = [name for name in dirs if name != ".updater"]
+        for name in names:
+            path = os.path.join(directory, name)
+            with open(path, "rb") as f:
+                files[os.path.relpath(path, root).replace(os.sep, "/")] = f.read()
+    return files
+
+
+def publish(source: str, **options) -> str:
+    "Generate hashtable.json of source, returns its path"
+
+    hashtable = os.path.join(source, "hashtable.json")
+    Updater(source, quiet=True).dump_hashtable(hashtable, **options)
+    return hashtable
+
+
+def update(destination: str, mirror, hashtable: str, downloader: str = "requests", **options) -> Updater:
+    "Update destination without asking, returns the updater for inspection"
+
+    updater = Updater(destination, quiet=True)
+    updater.run(mirror, hashtable, False, downloader_type=downloader, **options)
+    return updater
+
+
+@pytest.fixture(autouse=True)
+def sigint_handler():
+    "Urllib downloader takes over SIGINT of the main thread, it is given back after every test"
+
+    handler = signal.getsignal(signal.SIGINT)
+    yield
+    signal.signal(signal.SIGINT, handler)
+
+
+@pytest.fixture
+def files() -> dict[str, bytes]:
+    return {
+        "readme.txt": b"updater test tree\n",
+        "data/large.bin": bytes(range(256)) * 1024,
+        "data/text.txt": b"line of text, that compresses well\n" * 2000,
+        "empty.txt": b"",
+    }
+
+
+@pytest.fixture
+def source(tmp_path, files) -> str:
+    root = str(tmp_path / "source")
+    write_tree(root, files)
+    return root
+
+
+@pytest.fixture
+def destination(tmp_path) -> str:
+    root = str(tmp_path / "destination")
+    os.makedirs(root)
+    return root
+
+
+@pytest.fixture
+def serve():
+    "Start MirrorServer of a tree on an ephemeral port, server.url is its root URL"
+
+    servers: list[MirrorServer] = []
+
+    def start(root: str, hashtable: str, precompressed: bool = False) -> MirrorServer:
+        server = MirrorServer(("127.0.0.1", 0), root, hashtable, precompressed)
+        server.RequestHandlerClass = RecordingHandler
+        server.requests = []  # type: ignore
+        server.url = f"http://127.0.0.1:{server.server_address[1]}/"  # type: ignore
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+import requests
+from conftest import RecordingHandler, publish, read_tree, update, write_tree
+
+from core import blocks, manifest
+from core.progress import ProgressReporter
+from core.requests_downloader import RequestsDownloader
+
+
+class RangeIgnoringHandler(RecordingHandler):
+    "Handler of a mirror, that answers every request with the whole file"
+
+    def serve(self, body: bool) -> None:
+        del self.headers["Range"]
+        super().serve(body)
+
+
+def test_block_maps_do_not_leak_into_hashtable_without_blocks(source, files, monkeypatch):
+    monkeypatch.setattr(blocks, "MIN_SIZE", 1)
+    publish(source, block_size=4096)
+    assert os.listdir(source + "/hashtable.json" + blocks.BLOCKS_SUFFIX)
+
+    hashtable = publish(source)
+
+    with open(hashtable, "rb") as f:
+        assert sorted(manifest.load(f)) == sorted(files)
+
+
+def test_changed_blocks_are_patched(source, destination, serve, files, monkeypatch):
+    monkeypatch.setattr(blocks, "MIN_SIZE", 1)
+    mirror = serve(source, publish(source, block_size=4096))
+    update(destination, mirror.url, mirror.url + "hashtable.json")
+
+    content = bytearray(files["data/large.bin"])
+    content[10000:10010] = b"x" * 10
+    write_tree(source, {"data/large.bin": bytes(content)})
+    publish(source, block_size=4096)
+    mirror.requests.clear()
+
+    update(destination, mirror.url, mirror.url + "hashtable.json")
+
+    assert read_tree(destination) == {**files, "data/large.bin": bytes(content)}
+    ranges = [headers.get("Range") for path, headers in mirror.requests if path == "/data/large.bin"]
+    assert ranges == ["bytes=8192-12287"]
+
+
+@pytest.mark.parametrize("path, error", [("data/large.bin", blocks.PatchError), ("missing.bin", requests.HTTPError)])
+def test_refused_range_response_is_closed(source, serve, monkeypatch, path, error):
+    mirror = serve(source, publish(source))
+    mirror.RequestHandlerClass = RangeIgnoringHandler
+    downloader = RequestsDownloader(ProgressReporter(True), connections=1)
+    responses = []
+    get = downloader.session.get
+    monkeypatch.setattr(downloader.session, "get", lambda *args, **kwargs: responses.append(get(*args, **kwargs)) or responses[-1])
+
+    with pytest.raises(error):
+        list(downloader.fetch_range(mirror.url + path, 0, 99))
+
+    assert len(responses) == 1 and responses[0].raw.closed
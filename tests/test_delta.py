@@ -0,0 +1,66 @@
+import json
+import os
+import shutil
+
+import pytest
+from conftest import publish, read_tree, update, write_tree
+
+from core import delta, manifest
+
+
+def load(hashtable: str) -> dict[str, dict]:
+    with open(hashtable, "rb") as f:
+        return manifest.load(f)
+
+
+@pytest.fixture
+def mirror(source, serve):
+    return serve(source, publish(source, versioned=True))
+
+
+def test_new_version_is_applied_from_delta(source, destination, mirror, files):
+    update(destination, mirror.url, mirror.url + "hashtable.json")
+    write_tree(source, {"readme.txt": b"second version\n"})
+    publish(source, versioned=True)
+    mirror.requests.clear()
+
+    update(destination, mirror.url, mirror.url + "hashtable.json")
+
+    assert read_tree(destination) == {**files, "readme.txt": b"second version\n"}
+    assert "/hashtable.json" not in [path for path, _ in mirror.requests]
+
+
+def test_restarted_history_is_not_taken_for_known_version(source, destination, mirror, files):
+    update(destination, mirror.url, mirror.url + "hashtable.json")
+
+    # Publisher lost the deltas, new history starts at version 1 again
+    shutil.rmtree(source + "/hashtable.json" + delta.DELTA_SUFFIX)
+    write_tree(source, {"readme.txt": b"new history\n"})
+    publish(source, versioned=True)
+    with open(delta.index_url(source + "/hashtable.json"), "r", encoding="utf-8") as f:
+        assert json.load(f)["version"] == 1
+
+    update(destination, mirror.url, mirror.url + "hashtable.json")
+
+    assert read_tree(destination) == {**files, "readme.txt": b"new history\n"}
+
+
+@pytest.mark.parametrize("index", ["{}", "[]", '{"version": 1}'])
+def test_malformed_index_falls_back_to_whole_hashtable(source, destination, mirror, files, index):
+    with open(delta.index_url(source + "/hashtable.json"), "w", encoding="utf-8") as f:
+        f.write(index)
+
+    update(destination, mirror.url, mirror.url + "hashtable.json")
+
+    assert read_tree(destination) == files
+
+
+def test_deltas_do_not_leak_into_unversioned_hashtable(source, files):
+    publish(source, versioned=True)
+    write_tree(source, {"readme.txt": b"second version\n"})
+    publish(source, versioned=True)
+    assert os.listdir(source + "/hashtable.json" + delta.DELTA_SUFFIX)
+
+    hashtable = publish(source)
+
+    assert sorted(load(hashtable)) == sorted(files)
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+from conftest import DOWNLOADERS, publish, read_tree
+
+from core import mirrors
+from core.downloader_template import DownloadCancelled
+from core.events import FileDownloaded, FileFailed
+from core.progress import ProgressReporter
+from core.urllib_downloader import UrllibDownloader
+from updater import Updater
+
+
+class CancellingPhase():
+    "Progress, that stops the downloader as soon as the first bytes arrive"
+
+    def __init__(self, downloader):
+        self.downloader = downloader
+
+    def advance(self, size, filename=None):
+        self.downloader.done_event.set()
+
+    def complete_file(self, filename=None):
+        pass
+
+
+def test_cancelled_urllib_download_is_not_reported_as_downloaded(source, destination, serve):
+    mirror = serve(source, publish(source))
+    downloader = UrllibDownloader(ProgressReporter(True), connections=1)
+    events = []
+    downloader.listener = events.append
+    entry = {"hash": "0" * 64, "size": os.path.getsize(os.path.join(source, "data/large.bin"))}
+
+    with pytest.raises(KeyboardInterrupt):
+        downloader.download_stream([("data/large.bin", entry)], mirror.url, destination, CancellingPhase(downloader))
+
+    assert [type(event) for event in events] == [FileFailed]
+    assert isinstance(events[0].error, DownloadCancelled)
+
+
+@pytest.mark.parametrize("downloader", DOWNLOADERS)
+def test_failed_download_is_reported(source, destination, serve, files, monkeypatch, downloader):
+    monkeypatch.setattr(mirrors, "BACKOFF_BASE", 0.01)
+    mirror = serve(source, publish(source))
+    os.remove(os.path.join(source, "data/text.txt"))
+    events = []
+
+    with pytest.raises(Exception):
+        for event in Updater(destination, quiet=True).events(mirror.url, mirror.url + "hashtable.json",
+                                                            downloader_type=downloader, connections=1):
+            events.append(event)
+
+    failed = [event.path for event in events if isinstance(event, FileFailed)]
+    downloaded = [event.path for event in events if isinstance(event, FileDownloaded)]
+    assert failed == ["data/text.txt"]
+    assert "data/text.txt" not in downloaded
+    assert read_tree(destination) == {}
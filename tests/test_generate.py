@@ -0,0 +1,60 @@
+import json
+import os
+import shutil
+
+import pytest
+from conftest import publish, write_tree
+
+from core import hash_cache
+from core.hash_cache import SIGNATURES_SUFFIX
+from updater import Updater
+
+
+@pytest.fixture(autouse=True)
+def settled(monkeypatch):
+    "Files of the tests were just written, their signatures are recorded anyway"
+
+    monkeypatch.setattr(hash_cache, "RACY_WINDOW_NS", 0)
+
+
+def generate(source: str, hashtable: str, base: str) -> tuple[Updater, dict]:
+    updater = Updater(source, rehash=True, quiet=True)
+    # Hashtable published into the tree by publish() is not part of it
+    updater.dump_hashtable(hashtable, ["hashtable.json", "hashtable.json" + SIGNATURES_SUFFIX], base=base)
+    with open(hashtable, "rb") as f:
+        return updater, json.load(f)
+
+
+def test_unchanged_files_are_reused(source, tmp_path):
+    base = publish(source)
+    assert os.path.isfile(base + SIGNATURES_SUFFIX)
+
+    updater, generated = generate(source, str(tmp_path / "next.json"), base)
+
+    assert updater.hash_counts["reused"] == len(generated) and updater.hash_counts["hashed"] == 0
+
+
+def test_base_copied_after_same_size_edit_is_not_trusted(source, tmp_path):
+    base = publish(source)
+    write_tree(source, {"readme.txt": b"UPDATER TEST TREE\n"})
+
+    # Previous build artifact restored after the tree changed
+    copied = str(tmp_path / "previous.json")
+    shutil.copy(base, copied)
+    shutil.copy(base + SIGNATURES_SUFFIX, copied + SIGNATURES_SUFFIX)
+
+    updater, generated = generate(source, str(tmp_path / "next.json"), copied)
+    _, fresh = generate(source, str(tmp_path / "fresh.json"), None)
+
+    assert generated == fresh
+    assert updater.hash_counts["hashed"] == 1
+
+
+def test_base_without_signatures_is_not_reused(source, tmp_path):
+    base = publish(source)
+    copied = str(tmp_path / "previous.json")
+    shutil.copy(base, copied)
+
+    updater, _ = generate(source, str(tmp_path / "next.json"), copied)
+
+    assert updater.hash_counts["reused"] == 0
@@ -0,0 +1,77 @@
+import hashlib
+from pathlib import Path
+
+import pytest
+
+from core import hashing
+from core.hashing import HashEngine
+
+
+class RecordingPhase():
+    "Stands in for ProgressPhase, keeps every advance"
+
+    def __init__(self):
+        self.advances: list[int] = []
+        self.files = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+    def advance(self, size, filename=None):
+        self.advances.append(size)
+
+    def complete_file(self, filename=None):
+        self.files += 1
+
+
+class RecordingReporter():
+    def __init__(self):
+        self.phases: list[RecordingPhase] = []
+
+    def phase(self, label, total, files):
+        self.phases.append(RecordingPhase())
+        return self.phases[-1]
+
+
+@pytest.fixture
+def large_files(tmp_path) -> list[str]:
+    files = []
+    for i in range(2):
+        path = tmp_path / f"large{i}.bin"
+        path.write_bytes(bytes([i]) * (1024 * 1024))
+        files.append(str(path))
+    return files
+
+
+@pytest.mark.parametrize("jobs, pool", [(1, "auto"), (2, "thread"), (2, "process")])
+def test_hashes_match_hashlib(large_files, jobs, pool):
+    engine = HashEngine(jobs, pool, RecordingReporter())  # type: ignore
+    sizes = [1024 * 1024] * len(large_files)
+
+    hashes = engine.hash_files(large_files + ["missing.bin"], sizes + [0])
+
+    expected = [hashlib.sha256(Path(file).read_bytes()).hexdigest() for file in large_files]
+    assert hashes == expected + [None]
+
+
+@pytest.mark.parametrize("jobs, pool", [(1, "auto"), (2, "thread")])
+def test_progress_advances_within_files(large_files, monkeypatch, jobs, pool):
+    monkeypatch.setattr(hashing, "MAX_BUFFER_SIZE", hashing.MIN_BUFFER_SIZE)
+    reporter = RecordingReporter()
+
+    HashEngine(jobs, pool, reporter).hash_files(large_files, [1024 * 1024] * len(large_files))  # type: ignore
+
+    phase = reporter.phases[0]
+    assert sum(phase.advances) == 2 * 1024 * 1024 and phase.files == 2
+    assert max(phase.advances) == hashing.MIN_BUFFER_SIZE
+
+
+def test_process_pool_advances_per_file(large_files):
+    reporter = RecordingReporter()
+
+    HashEngine(2, "process", reporter).hash_files(large_files, [1024 * 1024] * len(large_files))  # type: ignore
+
+    assert reporter.phases[0].advances == [1024 * 1024] * len(large_files)
@@ -0,0 +1,76 @@
+import shutil
+import socket
+
+import pytest
+from conftest import DEAD_MIRROR, DOWNLOADERS, publish, read_tree, update
+
+from core import compression, downloader_template
+from core.mirrors import MirrorPool
+
+
+def requested(server) -> list[str]:
+    return [path for path, _ in server.requests]
+
+
+@pytest.mark.parametrize("downloader", DOWNLOADERS)
+def test_dead_mirror_is_taken_over(source, destination, serve, files, downloader):
+    mirror = serve(source, publish(source))
+    mirrors = MirrorPool([DEAD_MIRROR, mirror.url])
+
+    update(destination, mirrors, mirror.url + "hashtable.json", downloader)
+
+    assert read_tree(destination) == files
+    dead, alive = mirrors.mirrors
+    assert dead.transfers == 0 and dead.errors > 0
+    assert alive.transfers == len(files)
+
+
+@pytest.mark.parametrize("downloader", DOWNLOADERS)
+def test_companions_come_from_selected_mirror(source, destination, serve, files, tmp_path, downloader):
+    origin = serve(source, publish(source, companions="gzip"))
+    replica = str(tmp_path / "replica")
+    shutil.copytree(source, replica)
+    mirror = serve(replica, replica + "/hashtable.json")
+
+    update(destination, mirror.url, origin.url + "hashtable.json", downloader)
+
+    assert read_tree(destination) == files
+    assert all(path.startswith("/hashtable.json") for path in requested(origin))
+    companions = [path for path in requested(mirror) if path.startswith("/hashtable.json" + compression.COMPANIONS_SUFFIX)]
+    assert companions and "/data/text.txt" not in requested(mirror)
+
+
+@pytest.mark.parametrize("downloader", DOWNLOADERS)
+def test_dead_mirror_with_companions_is_not_credited(source, destination, serve, files, downloader):
+    mirror = serve(source, publish(source, companions="gzip"))
+    mirrors = MirrorPool([DEAD_MIRROR, mirror.url])
+
+    update(destination, mirrors, mirror.url + "hashtable.json", downloader)
+
+    assert read_tree(destination) == files
+    dead, alive = mirrors.mirrors
+    assert dead.transfers == 0 and dead.bytes == 0 and dead.errors > 0
+    assert alive.transfers == len(files)
+    assert any(path.startswith("/hashtable.json" + compression.COMPANIONS_SUFFIX) for path in requested(mirror))
+
+
+@pytest.fixture
+def silent_mirror():
+    "Mirror, that accepts connections and never answers"
+
+    with socket.create_server(("127.0.0.1", 0), backlog=64) as server:
+        yield f"http://127.0.0.1:{server.getsockname()[1]}/"
+
+
+@pytest.mark.parametrize("downloader", DOWNLOADERS)
+def test_silent_mirror_times_out(source, destination, serve, files, silent_mirror, monkeypatch, downloader):
+    monkeypatch.setattr(downloader_template, "TIMEOUT", 0.5)
+    mirror = serve(source, publish(source))
+    mirrors = MirrorPool([silent_mirror, mirror.url])
+
+    update(destination, mirrors, mirror.url + "hashtable.json", downloader)
+
+    assert read_tree(destination) == files
+    silent, alive = mirrors.mirrors
+    assert silent.transfers == 0 and silent.errors > 0
+    assert alive.transfers == len(files)
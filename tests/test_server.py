@@ -0,0 +1,130 @@
+import json
+import os
+import time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+from conftest import publish
+
+
+def get(url: str, **headers: str) -> tuple[int, dict, bytes]:
+    try:
+        with urlopen(Request(url, headers=headers)) as r:
+            return r.status, dict(r.headers), r.read()
+    except HTTPError as e:
+        return e.code, dict(e.headers), e.read()
+
+
+@pytest.fixture
+def mirror(source, serve):
+    return serve(source, publish(source))
+
+
+def test_etag_is_hash_of_file(mirror, source, files):
+    with open(os.path.join(source, "hashtable.json"), "rb") as f:
+        entry = json.load(f)["data/large.bin"]
+
+    status, headers, body = get(mirror.url + "data/large.bin")
+
+    assert status == 200
+    assert headers["ETag"] == f'"{entry["hash"]}"'
+    assert headers["Accept-Ranges"] == "bytes"
+    assert body == files["data/large.bin"]
+
+
+def test_modified_file_has_weak_etag(mirror, source):
+    time.sleep(0.01)
+    with open(os.path.join(source, "readme.txt"), "ab") as f:
+        f.write(b"changed after the hashtable\n")
+
+    status, headers, _ = get(mirror.url + "readme.txt")
+
+    assert status == 200
+    assert headers["ETag"].startswith('W/"')
+
+
+def test_range(mirror, files):
+    status, headers, body = get(mirror.url + "data/large.bin", Range="bytes=100-199")
+
+    assert status == 206
+    assert headers["Content-Range"] == f"bytes 100-199/{len(files['data/large.bin'])}"
+    assert body == files["data/large.bin"][100:200]
+
+
+def test_open_and_suffix_ranges(mirror, files):
+    content = files["data/large.bin"]
+
+    assert get(mirror.url + "data/large.bin", Range="bytes=1000-")[2] == content[1000:]
+    assert get(mirror.url + "data/large.bin", Range="bytes=-10")[2] == content[-10:]
+
+
+def test_range_after_end_is_not_satisfiable(mirror, files):
+    status, headers, _ = get(mirror.url + "data/large.bin", Range=f"bytes={len(files['data/large.bin'])}-")
+
+    assert status == 416
+    assert headers["Content-Range"] == f"bytes */{len(files['data/large.bin'])}"
+
+
+def test_if_range_with_current_etag(mirror, files):
+    etag = get(mirror.url + "data/large.bin")[1]["ETag"]
+
+    status, _, body = get(mirror.url + "data/large.bin", Range="bytes=10-", **{"If-Range": etag})
+
+    assert status == 206
+    assert body == files["data/large.bin"][10:]
+
+
+def test_if_range_with_old_etag_sends_whole_file(mirror, files):
+    status, _, body = get(mirror.url + "data/large.bin", Range="bytes=10-", **{"If-Range": '"outdated"'})
+
+    assert status == 200
+    assert body == files["data/large.bin"]
+
+
+def test_if_range_with_weak_etag_sends_whole_file(mirror, source):
+    time.sleep(0.01)
+    with open(os.path.join(source, "readme.txt"), "ab") as f:
+        f.write(b"changed after the hashtable\n")
+    etag = get(mirror.url + "readme.txt")[1]["ETag"]
+
+    status, _, body = get(mirror.url + "readme.txt", Range="bytes=5-", **{"If-Range": etag})
+
+    assert status == 200
+    assert len(body) == os.path.getsize(os.path.join(source, "readme.txt"))
+
+
+def test_if_none_match(mirror):
+    etag = get(mirror.url + "readme.txt")[1]["ETag"]
+
+    assert get(mirror.url + "readme.txt", **{"If-None-Match": etag})[0] == 304
+
+
+def test_state_and_outside_paths_are_not_served(mirror, source):
+    os.makedirs(os.path.join(source, ".updater"), exist_ok=True)
+    with open(os.path.join(source, ".updater", "journal"), "w") as f:
+        f.write("{}\n")
+
+    assert get(mirror.url + ".updater/journal")[0] == 404
+    assert get(mirror.url + "../source/readme.txt")[0] == 404
+    assert get(mirror.url + "missing.txt")[0] == 404
+
+
+@pytest.mark.parametrize("path", ["C:/Windows/win.ini", "d/../C:/x", "C%3A/x", "c:readme.txt"])
+def test_drive_paths_are_not_served(mirror, source, path):
+    if os.name != "nt":
+        # Elsewhere "C:" is an ordinary name, that must not be served either
+        os.makedirs(os.path.join(source, "C:"), exist_ok=True)
+        with open(os.path.join(source, "C:", "x"), "w") as f:
+            f.write("drive\n")
+
+    assert get(mirror.url + path)[0] == 404
+
+
+@pytest.mark.skipif(not hasattr(os, "symlink") or os.name == "nt", reason="needs symlinks")
+def test_links_outside_root_are_not_served(mirror, source, tmp_path):
+    with open(tmp_path / "secret.txt", "w") as f:
+        f.write("secret\n")
+    os.symlink(tmp_path / "secret.txt", os.path.join(source, "link.txt"))
+
+    assert get(mirror.url + "link.txt")[0] == 404
@@ -0,0 +1,26 @@
+import os
+
+import pytest
+
+from core.hash_cache import HashCache
+from core.staging import Stage
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc to name synced descriptors")
+def test_staged_files_are_synced_before_commit_record(tmp_path, monkeypatch):
+    stage = Stage(tmp_path)
+    staged = stage.path("data/file.txt")
+    os.makedirs(os.path.dirname(staged))
+    with open(staged, "wb") as f:
+        f.write(b"content")
+    stage.record("data/file.txt", "hash", "sha256", 7)
+
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(os.readlink(f"/proc/self/fd/{fd}")) or fsync(fd))
+    stage.commit(HashCache(tmp_path))
+
+    before_commit = synced[:synced.index(os.path.realpath(stage.file))]
+    assert os.path.realpath(staged) in before_commit
+    assert os.path.realpath(os.path.dirname(staged)) in before_commit
+    assert (tmp_path / "data" / "file.txt").read_bytes() == b"content"
@@ -0,0 +1,118 @@
+import os
+
+import pytest
+from conftest import DOWNLOADERS, publish, read_tree, update, write_tree
+
+import updater as updater_module
+from core.staging import Stage
+from updater import Updater
+
+
+@pytest.mark.parametrize("downloader", DOWNLOADERS)
+def test_update_of_empty_destination(source, destination, serve, files, downloader):
+    mirror = serve(source, publish(source))
+
+    update(destination, mirror.url, mirror.url + "hashtable.json", downloader)
+
+    assert read_tree(destination) == files
+
+
+@pytest.mark.parametrize("downloader", DOWNLOADERS)
+def test_only_stale_files_are_downloaded(source, destination, serve, files, downloader):
+    mirror = serve(source, publish(source))
+    write_tree(destination, {**files, "data/text.txt": b"modified locally\n"})
+
+    update(destination, mirror.url, mirror.url + "hashtable.json", downloader)
+
+    assert read_tree(destination) == files
+    downloaded = [path for path, _ in mirror.requests if not path.startswith("/hashtable.json")]
+    assert downloaded == ["/data/text.txt"]
+
+
+@pytest.mark.parametrize("downloader", ["requests", "asyncio"])
+def test_partial_download_is_resumed(source, destination, serve, files, downloader):
+    mirror = serve(source, publish(source))
+    content = files["data/large.bin"]
+    write_tree(Stage(destination).directory, {"data/large.bin": content[:1000]})
+
+    update(destination, mirror.url, mirror.url + "hashtable.json", downloader)
+
+    assert read_tree(destination) == files
+    assert not os.path.exists(Stage(destination).directory)
+    ranges = [headers.get("Range") for path, headers in mirror.requests if path == "/data/large.bin"]
+    assert ranges == ["bytes=1000-"]
+
+
+def test_corrupted_partial_download_is_downloaded_again(source, destination, serve, files):
+    mirror = serve(source, publish(source))
+    write_tree(Stage(destination).directory, {"data/large.bin": b"\0" * 1000})
+
+    update(destination, mirror.url, mirror.url + "hashtable.json", connections=1)
+
+    assert read_tree(destination) == files
+
+
+def test_deprecated_prompt_user_asks_on_terminal(source, destination, serve, monkeypatch):
+    mirror = serve(source, publish(source))
+    questions = []
+    monkeypatch.setattr("builtins.input", lambda question: questions.append(question) or "n")
+
+    with pytest.warns(DeprecationWarning):
+        assert not Updater(destination, quiet=True).run(mirror.url, mirror.url + "hashtable.json", True)
+
+    assert len(questions) == 1 and questions[0].startswith("Total size:")
+    assert read_tree(destination) == {}
+
+
+def test_library_does_not_ask_by_default(source, destination, serve, files, monkeypatch):
+    mirror = serve(source, publish(source))
+    monkeypatch.setattr("builtins.input", lambda question: pytest.fail("asked on the terminal"))
+
+    assert Updater(destination, quiet=True).run(mirror.url, mirror.url + "hashtable.json")
+
+    assert read_tree(destination) == files
+
+
+def test_prompt_user_callable_gets_size(source, destination, serve, files):
+    mirror = serve(source, publish(source))
+    messages = []
+    updater = Updater(destination, quiet=True)
+
+    assert updater.run(mirror.url, mirror.url + "hashtable.json", lambda message: messages.append(message) or True)
+
+    assert messages == [f"Total size: {updater.human_readable(sum(map(len, files.values())))}"]
+    assert read_tree(destination) == files
+
+
+@pytest.mark.parametrize("downloader", DOWNLOADERS)
+def test_update_over_single_connection(source, destination, serve, files, downloader):
+    mirror = serve(source, publish(source))
+
+    update(destination, mirror.url, mirror.url + "hashtable.json", downloader, connections=1)
+
+    assert read_tree(destination) == files
+
+
+def test_create_hash_matches_hashtable(source, files):
+    updater = Updater(source, quiet=True)
+    hashtable = updater.load_hashtable(publish(source))
+    filename = os.path.join(source, "data", "text.txt")
+
+    assert updater.create_hash(filename) == hashtable["data/text.txt"]["hash"]
+    assert updater.create_hash(os.path.join(source, "missing.txt")) == updater.create_hash(os.path.join(source, "empty.txt"))
+
+
+def test_local_files_are_hashed_in_batches(source, files, monkeypatch):
+    monkeypatch.setattr(updater_module, "HASH_BATCH_SIZE", 2)
+    hashtable = Updater(source, quiet=True).load_hashtable(publish(source))
+    updater = Updater(source, rehash=True, quiet=True)
+    batches = []
+    iter_hashes = updater.hash_engine.iter_hashes
+    monkeypatch.setattr(updater.hash_engine, "iter_hashes",
+                        lambda files, *args: batches.append(len(files)) or iter_hashes(files, *args))
+
+    checks = list(updater.iter_checks(hashtable))
+
+    assert sorted(file for file, _, _ in checks) == sorted(files)
+    assert all(reason is None for _, _, reason in checks)
+    assert max(batches) == 2 and sum(batches) == len(files)
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+from conftest import write_tree
+
+from core.walker import ExcludeMatcher, walk
+
+TREE = ["venv/lib/x.py", "a/venv/y.py", "build/b.txt", "a/build/c.txt", "logs", "x/logs/m.txt",
+        "keep.pyc", "d.pyc", "src/d.pyc", "assets/one/two/tmp/t.bin", "readme.txt", ".updater/hashcache.json"]
+
+
+@pytest.fixture
+def tree(tmp_path) -> str:
+    root = str(tmp_path / "tree")
+    write_tree(root, {path: b"" for path in TREE})
+    return root
+
+
+def walked(root: str, patterns: list[str]) -> list[str]:
+    return sorted(path for path, _ in walk(root, ExcludeMatcher(patterns, root)))
+
+
+def test_state_directory_is_not_walked(tree):
+    assert walked(tree, []) == sorted(path for path in TREE if not path.startswith(".updater/"))
+
+
+@pytest.mark.parametrize("patterns, excluded", [
+    (["venv"], ["venv/lib/x.py", "a/venv/y.py"]),
+    (["./venv"], ["venv/lib/x.py"]),
+    (["./venv/"], ["venv/lib/x.py"]),
+    (["/build"], ["build/b.txt"]),
+    ([".//a/./build"], ["a/build/c.txt"]),
+    (["logs/"], ["x/logs/m.txt"]),
+    (["*.pyc", "!keep.pyc"], ["d.pyc", "src/d.pyc"]),
+    (["/*.pyc"], ["keep.pyc", "d.pyc"]),
+    (["assets/**/tmp"], ["assets/one/two/tmp/t.bin"]),
+    (["", "# comment", "./"], []),
+])
+def test_patterns(tree, patterns, excluded):
+    assert walked(tree, patterns) == sorted(set(walked(tree, [])) - set(excluded))
+
+
+def test_absolute_paths(tree):
+    assert "readme.txt" not in walked(tree, [os.path.join(tree, "readme.txt")])
+    assert "build/b.txt" not in walked(tree, [os.path.join(tree, "build")])
+    assert walked(tree, [tree]) == walked(tree, [])
+
+
+def test_stats_match_os_stat(tree):
+    for path, stat in walk(tree):
+        expected = os.stat(os.path.join(tree, path))
+        assert (stat.st_size, stat.st_mtime_ns, stat.st_ino) == (expected.st_size, expected.st_mtime_ns, expected.st_ino)
@@ -1,17 +1,36 @@
-import hashlib
 import json
 import logging as console
 import os
 import pathlib
+import posixpath
+import queue
+import time
+import warnings
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Union
-
-import requests
-from rich.progress import (BarColumn, DownloadColumn, Progress, TextColumn,
-                           TimeRemainingColumn, TransferSpeedColumn)
-
-from core.requests_downloader import RequestsDownloader
-from core.urllib_downloader import UrllibDownloader
+from threading import Event, Thread
+from typing import AsyncIterator, BinaryIO, Callable, Iterator
+from urllib.parse import urlsplit
+
+from core import blocks, compression, delta, manifest, planner
+from core.downloader_template import DownloaderBase
+from core.events import FileChecked, FileCopied, FileDownloaded, FileRemoved, UpdateApplied, UpdateEvent
+from core.hash_cache import SIGNATURES_SUFFIX, HashCache, UpdateRecord, base_signature, dump_signatures, load_signatures
+from core.hashing import DEFAULT_ALGORITHM, HashEngine, hash_file, new_hash
+from core.mirrors import MirrorPool
+from core.progress import ProgressReporter
+from core.staging import Stage
+from core.stats import Stats
+from core.walker import ExcludeMatcher, walk
+
+# Checked files waiting for a download, per connection
+QUEUE_DEPTH = 4
+# Files waiting for hashing, while the rest of the hashtable is checked
+HASH_BATCH_SIZE = 4096
+# Events waiting for the caller of Updater.events()
+EVENT_QUEUE_SIZE = 1024
+# Seconds between checks for a stop of the update by threads waiting on a queue
+POLL_INTERVAL = 0.1
 
 
 class Updater():
@@ -20,12 +39,34 @@ class Updater():
 
     Args:
         path (os.PathLike): Directory, from which is the hashtable generated
+        rehash (bool, optional): Ignore the local hash cache and hash every file. Defaults to False.
+        jobs (int, optional): Number of workers used for hashing. Defaults to 1.
+        quiet (bool, optional): Do not render any progress. Defaults to False.
+        trust_mtime (bool, optional): Skip hashing of files, that kept size and mtime since the last update. Defaults to False.
+        stats (bool, optional): Collect counters and timings of the run in self.stats. Defaults to False.
     """
 
-    def __init__(self, path: str | os.PathLike = "."):  # type: ignore
+    def __init__(self, path: str | os.PathLike = ".", rehash: bool = False, jobs: int = 1, quiet: bool = False,
+                 trust_mtime: bool = False, stats: bool = False):  # type: ignore
         self.path = path
+        self.stats = Stats(stats)
+        self.progress = ProgressReporter(quiet)
+        self.hash_cache = HashCache(path, rehash=rehash)
+        self.trust_mtime = trust_mtime
+        self.update_record = UpdateRecord(path)
+        self.compare_counts = {"missing": 0, "size": 0,
+                               "mtime": 0, "cached": 0, "hashed": 0}
+        self.manifest_state = delta.ManifestState(path)
+        self.hash_counts = {"hashed": 0, "cached": 0, "reused": 0}
+        self.local_index: dict[str, list[str]] | None = None
+        self.hash_engine = HashEngine(jobs, progress=self.progress)
+        self.stage = Stage(path, jobs)
+        # Algorithm of the hashtable, that is being generated or updated to
+        self.algorithm = DEFAULT_ALGORITHM
         self.loaded_hashtable = dict[str, dict[str, int]]()
         self.generated_hashtable = dict[str, dict[str, int]]()
+        # Stats of the files of the last hashed table, taken before hashing
+        self.generated_stats = dict[str, os.stat_result]()
 
     def human_readable(self, num, suffix='B'):
         for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
@@ -34,51 +75,40 @@ class Updater():
             num /= 1024.0
         return "%.1f%s%s" % (num, 'Yi', suffix)
 
-    def create_hash(self, filename: Union[str, os.PathLike]) -> str:
-        """Create MD5 hash of file
+    def create_hash(self, filename: str | os.PathLike) -> str:
+        """Create hash of file with the algorithm of the hashtable, unchanged files are taken from the hash cache
 
         Args:
             filename (os.PathLike): File, that will be hashed
 
         Returns:
-            str: MD5 hash
+            str: Hex digest, digest of no data if the file does not exist
         """
 
-        console.debug(f"Hashing: {filename}")
-
-        sha = hashlib.sha256()
-
         try:
-            with open(filename, 'rb') as f:
-                with Progress(TextColumn("[bold purple]H: [bold blue]{task.fields[filename]}", justify="right"),
-                              BarColumn(bar_width=None),
-                              "[progress.percentage]{task.percentage:>3.1f}%",
-                              "•",
-                              DownloadColumn(),
-                              "•",
-                              TransferSpeedColumn(),
-                              "•",
-                              TimeRemainingColumn(),) as progress:
-                    task = progress.add_task(filename.__str__(), filename=Path(
-                        filename).name, total=os.stat(filename).st_size)
-                    while True:
-                        # 1MB so that memory is not exhausted
-                        chunk = f.read(1000 * 1000)
-                        if not chunk:
-                            break
-                        sha.update(chunk)
-                        progress.update(task, advance=len(chunk))
-
+            stat = os.stat(filename)
         except FileNotFoundError:
             console.error(f"File not found: {filename}")
+            return new_hash(self.algorithm).hexdigest()
 
-        return sha.hexdigest()
+        relative_path = Path(os.path.relpath(filename, self.path)).as_posix()
+        cached = self.hash_cache.get(relative_path, stat, self.algorithm)
+        if cached is not None:
+            return cached
+
+        console.debug(f"Hashing: {filename}")
+        with self.progress.phase("[bold purple]H", stat.st_size, 1) as phase:
+            hash = hash_file(filename, lambda size: phase.advance(size, Path(filename).name), self.algorithm)
+            phase.complete_file()
+
+        self.hash_cache.set(relative_path, stat, hash, self.algorithm)
+        return hash
 
     def load_hashtable(self, url: str) -> dict[str, dict]:
-        """Load URL as dictionary
+        """Load URL as dictionary, format of the hashtable is detected automatically
 
         Args:
-            url (str): Path to hashtable
+            url (str): URL or path to hashtable
 
         Returns:
             dict: loaded hashtable
@@ -86,34 +116,113 @@ class Updater():
 
         console.debug(f"Loading hashtable from {url}")
 
-        table = json.loads(requests.get(
-            url, allow_redirects=True).content)
+        with self.open_url(url) as stream:
+            return manifest.load(stream)
+
+    @contextmanager
+    def open_url(self, url: str) -> Iterator[BinaryIO]:
+        "Open local file or stream remote file from URL"
+
+        if os.path.isfile(url) or not url.startswith(("http://", "https://")):
+            with open(url, "rb") as f:
+                yield f
+            return
+
+        # HTTP stack is loaded only for remote hashtables
+        import requests
+
+        with requests.get(url, allow_redirects=True, stream=True) as r:
+            r.raise_for_status()
+            # Parse the content while it is being downloaded
+            r.raw.decode_content = True
+            yield r.raw
 
-        return dict(table)
+    def fetch_hashtable(self, url: str) -> dict[str, dict]:
+        """Load hashtable, downloading only deltas against the last known version if possible
 
-    def exclude(self, exclude: list[str]) -> tuple:
-        excluded_directories, excluded_files = [], []
+        Args:
+            url (str): URL or path to hashtable
+
+        Returns:
+            dict: loaded hashtable
+        """
+
+        try:
+            with self.open_url(delta.index_url(url)) as stream:
+                index = json.load(stream)
+            latest, oldest, latest_digest = index["version"], index["oldest"], index["digest"]
+        # requests.RequestException is an OSError as well
+        except (OSError, ValueError, KeyError, TypeError):
+            console.debug("Hashtable is not versioned")
+            return self.load_hashtable(url)
+
+        known = self.manifest_state.load(url)
+        if known is not None:
+            version, known_digest, table = known
+
+            # History restarts at version 1 when the publisher loses the index, versions are not enough
+            if version == latest and known_digest == latest_digest:
+                console.debug(f"Hashtable version {version} is up to date")
+                return table
+
+            if oldest <= version + 1 <= latest:
+                try:
+                    for i in range(version + 1, latest + 1):
+                        console.debug(f"Applying hashtable delta {i}")
+                        with self.open_url(delta.delta_url(url, i)) as stream:
+                            delta.apply(table, json.load(stream))
+
+                    if delta.digest(table) == latest_digest:
+                        self.manifest_state.save(url, latest, table)
+                        return table
+
+                    console.warning("Hashtable deltas do not match, downloading whole hashtable")
+                except (OSError, ValueError, KeyError):
+                    console.warning("Hashtable deltas are not available, downloading whole hashtable")
+
+        table = self.load_hashtable(url)
+
+        # Hashtable could be regenerated after the index was downloaded
+        if delta.digest(table) == latest_digest:
+            self.manifest_state.save(url, latest, table)
+
+        return table
+
+    def contains(self, path: str | os.PathLike) -> bool:
+        "Whether path is inside the main class path"
+
+        root = os.path.abspath(self.path)
+        try:
+            return os.path.commonpath([root, os.path.abspath(path)]) == root
+        except ValueError:
+            # Paths on different drives
+            return False
 
-        for item in exclude:
-            console.debug(f"Exclude - processing: {item}")
-            if os.path.isdir(item):
-                console.debug(f"Exclude - processing: {item} is directory")
-                excluded_directories.append(item)
-            elif os.path.isfile(item):
-                console.debug(f"Exclude - processing: {item} is file")
-                excluded_files.append(Path(item).as_posix())
+    def exclude(self, exclude: list[str]) -> ExcludeMatcher:
+        "Compile exclude patterns relative to the main class path"
 
-        console.debug(f"Excluded directories: {excluded_directories}")
-        console.debug(f"Excluded files: {excluded_files}")
+        console.debug(f"Exclude patterns: {exclude}")
 
-        return excluded_directories, excluded_files
+        return ExcludeMatcher(exclude, self.path)
 
-    def dump_hashtable(self, hashtable: os.PathLike, exclude: list[str] | None = None) -> os.PathLike:
+    def dump_hashtable(self, hashtable: os.PathLike, exclude: list[str] | None = None,
+                       format: str = "json", compress: bool = False,
+                       versioned: bool = False, keep_deltas: int = 100,
+                       base: os.PathLike | None = None, block_size: int | None = None,
+                       algorithm: str = DEFAULT_ALGORITHM, companions: str | None = None) -> os.PathLike:
         """Create new hashtable and dump it into file
 
         Args:
             hashtable (os.PathLike, optional): Where should the result be dumped. Defaults to "./hashtable.tmp".
-            exclude (list, optional): files or folders, that will be excluded. Defaults to None.
+            exclude (list, optional): Gitignore-style patterns of files or folders, that will be excluded. Defaults to None.
+            format (str, optional): "json" or "binary". Defaults to "json".
+            compress (bool, optional): Compress binary hashtable. Defaults to False.
+            versioned (bool, optional): Publish delta against the previous hashtable. Defaults to False.
+            keep_deltas (int, optional): Number of deltas, that are kept. Defaults to 100.
+            base (os.PathLike, optional): Previous hashtable, unchanged files are taken from it instead of hashing. Defaults to None.
+            block_size (int, optional): Publish block maps of large files with this block size. Defaults to None.
+            algorithm (str, optional): Hash algorithm of the hashtable. Defaults to DEFAULT_ALGORITHM.
+            companions (str, optional): Publish compressed companions of files with this encoding. Defaults to None.
 
         Returns:
             os.PathLike: Absolute path to the generated hashtable
@@ -125,60 +234,128 @@ class Updater():
         else:
             _exclude = exclude  # type: ignore
 
-        _new = []
-        for item in _exclude:
-            _new.append(os.path.normpath(item))
-        _exclude = _new
+        # The hashtable can not contain itself, neither can it contain files published
+        # next to it, that are left over from earlier runs with other options as well
+        published = [hashtable, str(hashtable) + SIGNATURES_SUFFIX]
+        if versioned or os.path.isdir(str(hashtable) + delta.DELTA_SUFFIX):
+            published.append(str(hashtable) + delta.DELTA_SUFFIX)
+        if block_size or os.path.isdir(str(hashtable) + blocks.BLOCKS_SUFFIX):
+            published.append(str(hashtable) + blocks.BLOCKS_SUFFIX)
+        if companions or os.path.isdir(str(hashtable) + compression.COMPANIONS_SUFFIX):
+            published.append(str(hashtable) + compression.COMPANIONS_SUFFIX)
+        # Absolute paths outside the tree would be taken for patterns anchored to its root
+        _exclude = _exclude + [os.path.abspath(path) for path in published if self.contains(path)]
+
+        base_hashtable, base_signatures = None, None
+        if base is not None:
+            console.debug(f"Reusing unchanged entries of {base}")
+            base_hashtable = self.load_hashtable(base)  # type: ignore
+            # Times of the base file itself say nothing about the tree, it could have been copied
+            base_signatures = load_signatures(base)
+
+            if manifest.algorithm_of(base_hashtable) != algorithm:
+                console.info(
+                    f"Base hashtable uses {manifest.algorithm_of(base_hashtable)}, hashing all files with {algorithm}")
+                base_signatures = None
+
+        self.algorithm = algorithm
+
+        start = time.time_ns()
+        generated = self.generate_hashtable(
+            _exclude, base_hashtable, base_signatures)
+        self.hash_cache.save()
 
-        generated = self.generate_hashtable(_exclude)
+        console.info(
+            f"Hashed {self.hash_counts['hashed']} files, reused {self.hash_counts['reused']} from base hashtable and {self.hash_counts['cached']} from cache")
+
+        previous = None
+        if versioned and os.path.isfile(hashtable):
+            previous = base_hashtable if base is not None and os.path.samefile(base, hashtable) \
+                else self.load_hashtable(hashtable)  # type: ignore
+
+        if companions:
+            with self.stats.timer("compress"):
+                created = compression.publish(
+                    hashtable, self.path, generated, companions, self.hash_engine.jobs, self.progress)
+            compressed = [entry for entry in generated.values() if "compressed" in entry]
+            console.info(
+                f"Compressed {created} files, {len(compressed)} files have companions "
+                f"({self.human_readable(sum(entry['compressed'] for entry in compressed))} instead of "
+                f"{self.human_readable(sum(entry['size'] for entry in compressed))})")
 
         console.debug(f"Dumping hashtable to {hashtable}")
-        with open(hashtable, "w", encoding="utf-8") as ht:
-            json.dump(generated, ht, ensure_ascii=False, indent=4)
+        with self.stats.timer("dump"):
+            manifest.dump(generated, hashtable, format, compress)
+
+        # Next generation reuses only entries of files, that kept these signatures
+        dump_signatures(hashtable, self.generated_stats, start)
+
+        if versioned:
+            delta.publish(hashtable, previous, generated, keep_deltas)
+
+        if block_size:
+            with self.stats.timer("blocks"):
+                created = blocks.publish(
+                    hashtable, self.path, generated, block_size)
+            console.info(f"Created {created} block maps")
 
         return os.path.abspath(hashtable)
 
-    def generate_hashtable(self, exclude: list) -> dict:  # ! DEBUG THIS
-        """Generate hashtable of directory parsed to main class
+    def convert_hashtable(self, url: str, hashtable: os.PathLike,
+                          format: str = "json", compress: bool = False) -> os.PathLike:
+        """Convert existing hashtable to another format
 
         Args:
-            exclude (list): files or folders, that will be excluded
+            url (str): URL or path to the source hashtable
+            hashtable (os.PathLike): Where should the result be dumped
+            format (str, optional): "json" or "binary". Defaults to "json".
+            compress (bool, optional): Compress binary hashtable. Defaults to False.
 
         Returns:
-            >>> "filename": {
-            >>>     'hash': 'MD5 hash'
-            >>>     'size': 'size of file'
-            >>> }
+            os.PathLike: Absolute path to the converted hashtable
         """
 
-        generated = {}
+        console.debug(f"Converting hashtable {url} to {format}")
+        manifest.dump(self.load_hashtable(url), hashtable, format, compress)
 
-        excluded_directories, excluded_files = self.exclude(exclude)
+        return os.path.abspath(hashtable)
 
-        for dirpath, _, files in os.walk(self.path):
-            console.debug(
-                f"Formated: {os.path.normpath(dirpath).split(os.path.sep)[0]}; Excluded directories: {excluded_directories}; Skipping: {os.path.normpath(dirpath).split(os.path.sep)[0] in excluded_directories}")
-            if os.path.normpath(dirpath).split(os.path.sep)[0] in excluded_directories:
-                continue
+    def serve(self, hashtable: os.PathLike, bind: str = "0.0.0.0", port: int = 8000,
+              precompressed: bool = False) -> None:
+        """Serve the directory and its hashtable as mirror until interrupted
 
-            if files != []:
+        Args:
+            hashtable (os.PathLike): Hashtable of the directory
+            bind (str, optional): Address to listen on. Defaults to "0.0.0.0".
+            port (int, optional): Port to listen on. Defaults to 8000.
+            precompressed (bool, optional): Serve precompressed variants of files. Defaults to False.
+        """
+
+        from core import server
 
-                relative_dirpath = os.path.relpath(dirpath, self.path)
+        server.serve(self.path, hashtable, bind, port, precompressed)
 
-                for file in files:
-                    relative_path = Path(os.path.normpath(
-                        os.path.join(relative_dirpath, file))).as_posix()
-                    path = Path(os.path.normpath(
-                        os.path.join(dirpath, file))).as_posix()
-                    console.debug(
-                        f"Path: {path}, Relative path: {relative_dirpath}, Dirpath: {relative_dirpath}, File: {file}")
-                    if not path in excluded_files:
-                        generated[relative_path] = {
-                            "hash": self.create_hash(path),
-                            "size": os.path.getsize(path)
-                        }
+    def generate_hashtable(self, exclude: list, base: dict | None = None,
+                           base_signatures: dict[str, list[int]] | None = None) -> dict:  # ! DEBUG THIS
+        """Generate hashtable of directory parsed to main class
 
-        return dict(generated)
+        Args:
+            exclude (list): Gitignore-style patterns of files or folders, that will be excluded
+            base (dict, optional): Previous hashtable, that entries can be reused from. Defaults to None.
+            base_signatures (dict, optional): Stat signatures of files, when base was generated. Defaults to None.
+
+        Returns:
+            >>> "filename": {
+            >>>     'hash': 'MD5 hash'
+            >>>     'size': 'size of file'
+            >>> }
+        """
+
+        with self.stats.timer("walk"):
+            stats = dict(walk(self.path, self.exclude(exclude)))
+        self.stats.add("files_walked", len(stats))
+
+        return self.hash_files(list(stats), base, base_signatures, stats)
 
     def generate_hashtable_from_remote(self, remote_hashtable: dict) -> dict:
         """Generate hashtable of directory parsed to main class
@@ -193,28 +370,86 @@ class Updater():
             >>> }
         """
 
-        generated = {}
+        files = [Path(os.path.normpath(os.path.join(".", file))).as_posix()
+                 for file in remote_hashtable]
 
-        for file in [i for i in remote_hashtable]:
-            try:
-                path = Path(os.path.normpath(
-                    os.path.join(".", file))).as_posix()
-                generated[path] = {
-                    "hash": self.create_hash(Path(os.path.join(self.path, path)).as_posix()),
-                    "size": os.path.getsize(Path(os.path.join(self.path, path)).as_posix())
-                }
-            except FileNotFoundError:
-                pass
+        return self.hash_files(files)
+
+    def hash_files(self, files: list[str], base: dict | None = None, base_signatures: dict[str, list[int]] | None = None,
+                   known_stats: dict[str, os.stat_result] | None = None) -> dict[str, dict]:
+        """Hash files relative to the main class path, missing files are skipped
+
+        Args:
+            files (list[str]): Relative paths of files, that will be hashed
+            base (dict, optional): Previous hashtable, entries of files, that kept their
+                signature from base_signatures, are reused. Defaults to None.
+            base_signatures (dict, optional): Stat signatures of files, when base was generated. Defaults to None.
+            known_stats (dict, optional): Stats of files collected while walking the tree, they are not stat'ed again. Defaults to None.
+
+        Returns:
+            >>> "filename": {
+            >>>     'hash': 'SHA-256 hash'
+            >>>     'size': 'size of file'
+            >>> }
+        """
 
-        return dict(generated)
+        stats: dict[str, os.stat_result] = {}
+        hashes: dict[str, str] = {}
+        pending: list[str] = []
+        reused = 0
+
+        if base is None or base_signatures is None:
+            base, base_signatures = {}, {}
+
+        for file in files:
+            if known_stats is not None and file in known_stats:
+                stats[file] = known_stats[file]
+            else:
+                try:
+                    stats[file] = os.stat(os.path.join(self.path, file))
+                except FileNotFoundError:
+                    continue
+
+            entry = base.get(file)
+            if entry is not None and entry["size"] == stats[file].st_size \
+                    and base_signatures.get(file) == base_signature(stats[file]):
+                hashes[file] = entry["hash"]
+                reused += 1
+                continue
 
-    def generate_extended_hashtable(self) -> dict[str, dict[str, int]]:
-        extended_hashtable = {}
-        for i in self.loaded_hashtable:
-            extended_hashtable[Path(os.path.join(
-                self.path, i)).as_posix()] = self.loaded_hashtable[i]
+            cached = self.hash_cache.get(file, stats[file], self.algorithm)
+            if cached is None:
+                pending.append(file)
+            else:
+                hashes[file] = cached
+
+        self.hash_counts = {"hashed": len(pending),
+                            "cached": len(hashes) - reused, "reused": reused}
+        console.debug(
+            f"Hashing {len(pending)} files, {len(hashes) - reused} taken from cache, {reused} reused from base")
+
+        self.stats.add("files_hashed", len(pending))
+        self.stats.add("files_cached", len(hashes) - reused)
+        self.stats.add("files_reused", reused)
+        self.stats.add("bytes_hashed", sum(stats[file].st_size for file in pending))
+
+        with self.stats.timer("hash"):
+            computed = self.hash_engine.hash_files(
+                [Path(os.path.join(self.path, file)).as_posix()
+                 for file in pending],
+                [stats[file].st_size for file in pending], self.algorithm)
+
+        for file, hash in zip(pending, computed):
+            if hash is None:
+                del stats[file]
+                continue
 
-        return extended_hashtable
+            hashes[file] = hash
+            self.hash_cache.set(file, stats[file], hash, self.algorithm)
+
+        self.generated_stats = stats
+        return manifest.Hashtable({file: {"hash": hashes[file], "size": stats[file].st_size} for file in stats},
+                                  algorithm=self.algorithm)
 
     def compare(self, url: str, reset_to_remote: bool = False) -> tuple[dict[str, dict[str, int]], int]:
         """Generate hashtable and compare it to local file or mirror\n
@@ -228,89 +463,618 @@ class Updater():
             int: Size of files that needs to be downloaded
         """
 
-        self.loaded_hashtable = self.load_hashtable(url)
-        self.extended_hashtable = self.generate_extended_hashtable()
-        self.generated_hashtable = self.generate_hashtable(
-            exclude=list()) if reset_to_remote else self.generate_hashtable_from_remote(self.loaded_hashtable)
+        with self.stats.timer("verify"):
+            with self.stats.timer("fetch_hashtable"):
+                self.loaded_hashtable = self.fetch_hashtable(url)
+            self.algorithm = manifest.algorithm_of(self.loaded_hashtable)
+            self.local_index = None
+
+            if reset_to_remote:
+                # Files outside of the remote hashtable are needed as well, so everything is hashed
+                self.generated_hashtable = self.generate_hashtable(exclude=list())
+                self.compare_counts = {"missing": 0, "size": 0, "mtime": 0,
+                                       "cached": self.hash_counts["cached"], "hashed": self.hash_counts["hashed"]}
+                # Entries can carry more than hash and size, like the encoding of their companion
+                diff = {pathlib.Path(k).as_posix(): v for k, v in self.loaded_hashtable.items()
+                        if self.generated_hashtable.get(k, {}).get("hash") != v["hash"]}
+            else:
+                diff = dict(self.iter_stale(self.loaded_hashtable))
+
+            self.hash_cache.save()
 
-        console.debug(f"Generated hashtable: {self.generated_hashtable}")
-        console.debug(f"Loaded hashtable: {self.loaded_hashtable}")
-        console.debug(f"Extended hashtable: {self.extended_hashtable}")
+            counts = self.compare_counts
+            console.info(
+                f"Checked {len(self.loaded_hashtable)} files: {counts['missing']} missing, {counts['size']} with different size, "
+                f"{counts['mtime']} with unchanged mtime, {counts['cached']} from cache, {counts['hashed']} hashed")
 
-        diff: dict[str, dict[str, int]] = {}
-        size = 0
-        for k in self.loaded_hashtable:
-            if k in self.generated_hashtable and self.loaded_hashtable[k] != self.generated_hashtable[k]:
-                diff[pathlib.Path(k).as_posix()] = self.loaded_hashtable[k]
-                size += self.loaded_hashtable[k]["size"]
-            if not k in self.generated_hashtable:
-                diff[pathlib.Path(k).as_posix()] = self.loaded_hashtable[k]
-                size += self.loaded_hashtable[k]["size"]
+            size = sum(entry["size"] for entry in diff.values())
 
-        console.debug(f"Compared: {(diff, size)}")
+            console.debug(f"Compared: {len(diff)} files differ, {size} bytes")
 
         return (diff, size)
 
+    def record_update(self) -> None:
+        "Remember state of files after successful update, so the next one can trust their mtime"
+
+        if self.trust_mtime:
+            self.update_record.save(self.loaded_hashtable, self.algorithm)
+
     def reset_head(self) -> None:
-        "Removes all files that are not present in the remote hashtable"
+        "Removes all files that are not present in the remote hashtable, when the update is committed"
+
+        with self.stats.timer("reset"):
+            remote = {Path(os.path.normpath(path)).as_posix()
+                      for path in self.loaded_hashtable}
+            removed = [path for path, _ in walk(self.path) if path not in remote]
+
+        self.stage.remove(removed)
+        self.stats.add("files_removed", len(removed))
+
+        console.info(
+            f"{len(removed)} files will be removed to reset to state of remote repository")
+
+    def stage_copies(self, root: str | os.PathLike, pairs: list[tuple[str, str]],
+                     entries: dict[str, dict], link: str = "reflink") -> None:
+        """Copy files into the staging area and record them in its journal
+
+        Args:
+            root (os.PathLike): Directory, that the sources are relative to
+            pairs (list[tuple[str, str]]): (source, destination) pairs
+            entries (dict): Hashtable entries of the destinations
+            link (str, optional): "reflink", "hardlink" or "copy". Defaults to "reflink".
+        """
+
+        with self.stats.timer("copy"):
+            planner.copy_files(root, pairs, link, self.stage.directory)
+        self.stats.add("files_copied", len(pairs))
+
+        for _, destination in pairs:
+            entry = entries[destination]
+            self.stage.record(destination, entry["hash"], self.algorithm, entry["size"])
+
+    def find_local_file(self, hash: str) -> str | None:
+        """Find local file with the given content
+
+        Args:
+            hash (str): Hash of the content
+
+        Returns:
+            str | None: Path relative to the main class path
+        """
+
+        if self.local_index is None:
+            self.local_index = {}
+            self.index_moved_files()
+
+            # Files hashed in this run are preferred
+            for path, entry in self.generated_hashtable.items():
+                self.local_index.setdefault(entry["hash"], []).append(path)
+
+            # Cached hashes of files outside of the hashtable
+            for path, entry in self.hash_cache.entries.items():
+                if path not in self.generated_hashtable and entry[4] == self.algorithm:
+                    self.local_index.setdefault(entry[3], []).append(path)
+
+        for path in self.local_index.get(hash, []):
+            if path in self.generated_hashtable:
+                return path
+
+            # Cached entry is used only if the file did not change since
+            try:
+                if self.hash_cache.get(path, os.stat(os.path.join(self.path, path)), self.algorithm) == hash:
+                    return path
+            except FileNotFoundError:
+                pass
+
+        return None
+
+    def index_moved_files(self) -> None:
+        "Move cache entries of files, that were renamed since they were cached, by their stat signature"
+
+        moved = {}
+        for path, entry in list(self.hash_cache.entries.items()):
+            if not os.path.exists(os.path.join(self.path, path)):
+                moved[tuple(entry[:3])] = entry[3:]
+                del self.hash_cache.entries[path]
+
+        if not moved:
+            return
+
+        for relative_path, stat in walk(self.path):
+            if relative_path in self.hash_cache.entries:
+                continue
+
+            cached = moved.get(tuple(HashCache.signature(stat)))
+            if cached is not None:
+                console.debug(f"Found moved file: {relative_path}")
+                self.hash_cache.set(relative_path, stat, *cached)
+
+        self.hash_cache.dirty = True
+        self.hash_cache.save()
+
+    def companions_path(self, hashtable: str, mirrors: MirrorPool) -> str | None:
+        """Path of compressed companions relative to the mirror root, they are published next to the hashtable
+
+        Mirrors replicate the tree together with its hashtable, so companions are
+        downloaded from the same mirror as the file, not from the hashtable host.
+
+        Args:
+            hashtable (str): URL or path to hashtable
+            mirrors (MirrorPool): Mirrors of the update
+
+        Returns:
+            str | None: Path ending with "/", None for local hashtables
+        """
+
+        if os.path.isfile(hashtable):
+            return None
+
+        # Hashtable under one of the mirrors keeps its place in the tree, others are at the root
+        relative = next((hashtable[len(mirror.url):] for mirror in mirrors.mirrors if hashtable.startswith(mirror.url)),
+                        posixpath.basename(urlsplit(hashtable).path))
+        return relative + compression.COMPANIONS_SUFFIX + "/"
+
+    def create_downloader(self, downloader_type: str, connections: int, hashtable: str,
+                          mirrors: MirrorPool) -> DownloaderBase:
+        "Create downloader of the given type for files listed in hashtable"
+
+        # Block maps are published next to the hashtable
+        block_maps_url = None if os.path.isfile(hashtable) \
+            else hashtable + blocks.BLOCKS_SUFFIX + "/"
+        companions_path = self.companions_path(hashtable, mirrors)
+
+        # Only the selected downloader and its HTTP stack are imported
+        match downloader_type:
+            case "requests":
+                from core.requests_downloader import RequestsDownloader
+                return RequestsDownloader(self.progress, connections, block_maps_url, self.algorithm, companions_path,
+                                          self.stage)
+            case "urllib":
+                from core.urllib_downloader import UrllibDownloader
+                return UrllibDownloader(self.progress, connections, block_maps_url, self.algorithm, companions_path,
+                                        self.stage)
+            case "asyncio":
+                from core.asyncio_downloader import AsyncioDownloader
+                return AsyncioDownloader(self.progress, connections, block_maps_url, algorithm=self.algorithm,
+                                         companions_path=companions_path, stage=self.stage)
+            case _:
+                raise ValueError("No downloader selected")
+
+    def iter_checks(self, hashtable: dict[str, dict], stop: Event | None = None,
+                    collect: bool = True) -> Iterator[tuple[str, dict, str | None]]:
+        """Compare entries of hashtable to local files, yielding every file as soon as it is checked
+
+        Missing files and files of different size are yielded without hashing,
+        the rest is checked against the update record (with trust_mtime) and
+        the hash cache and only the remaining files are hashed, in batches of
+        HASH_BATCH_SIZE files.
+
+        Args:
+            hashtable (dict): Remote hashtable
+            stop (Event, optional): Stops the verification when set. Defaults to None.
+            collect (bool, optional): Keep hashes of the local files in generated_hashtable. Defaults to True.
 
-        # extend loaded_hashtable with selected path
-        extended_hashtable = {}
-        for i in self.loaded_hashtable:
-            extended_hashtable[Path(os.path.join(
-                self.path, i)).as_posix()] = self.loaded_hashtable[i]
+        Yields:
+            tuple[str, dict, str | None]: Relative path, remote entry and why the file is stale,
+                "missing", "size" or "modified", None if it is up to date
+        """
+
+        self.algorithm = manifest.algorithm_of(hashtable)
+        self.generated_hashtable = manifest.Hashtable(algorithm=self.algorithm)
+        pending: list[tuple[str, os.stat_result, dict]] = []
+        counts = self.compare_counts = {"missing": 0, "size": 0,
+                                        "mtime": 0, "cached": 0, "hashed": 0}
+
+        def hashed() -> Iterator[tuple[str, dict, str | None]]:
+            "Hash pending files and yield their results"
+
+            counts["hashed"] += len(pending)
+            self.stats.add("files_hashed", len(pending))
+            self.stats.add("bytes_hashed", sum(stat.st_size for _, stat, _ in pending))
+
+            hashes = self.hash_engine.iter_hashes(
+                [Path(os.path.join(self.path, file)).as_posix()
+                 for file, _, _ in pending],
+                [stat.st_size for _, stat, _ in pending], self.algorithm)
+
+            try:
+                for (file, stat, entry), hash in zip(pending, hashes):
+                    if stop is not None and stop.is_set():
+                        return
+
+                    if hash is None:
+                        # Removed while it was waiting for hashing
+                        yield file, entry, "missing"
+                        continue
+
+                    self.hash_cache.set(file, stat, hash, self.algorithm)
+                    if collect:
+                        self.generated_hashtable[file] = {
+                            "hash": hash, "size": stat.st_size}
+                    yield file, entry, None if hash == entry["hash"] else "modified"
+            finally:
+                hashes.close()
+                pending.clear()
+
+        for k, entry in hashtable.items():
+            if stop is not None and stop.is_set():
+                return
+
+            file = Path(os.path.normpath(k)).as_posix()
+            try:
+                stat = os.stat(os.path.join(self.path, file))
+            except FileNotFoundError:
+                counts["missing"] += 1
+                yield file, entry, "missing"
+                continue
+
+            # Different size means different content, there is no need to read the file
+            if stat.st_size != entry["size"]:
+                counts["size"] += 1
+                yield file, entry, "size"
+                continue
+
+            hash = self.update_record.get(
+                file, stat, self.algorithm) if self.trust_mtime else None
+            if hash is not None:
+                counts["mtime"] += 1
+            else:
+                hash = self.hash_cache.get(file, stat, self.algorithm)
+                if hash is None:
+                    pending.append((file, stat, entry))
+                    # Files are hashed in batches, so the waiting ones do not grow with the hashtable
+                    if len(pending) >= HASH_BATCH_SIZE:
+                        yield from hashed()
+                    continue
+                counts["cached"] += 1
+
+            if collect:
+                self.generated_hashtable[file] = {
+                    "hash": hash, "size": stat.st_size}
+            yield file, entry, None if hash == entry["hash"] else "modified"
+
+        yield from hashed()
+
+        self.hash_counts = {"hashed": counts["hashed"],
+                            "cached": counts["cached"], "reused": 0}
+
+        self.stats.add("files_missing", counts["missing"])
+        self.stats.add("files_size_changed", counts["size"])
+        self.stats.add("files_mtime_trusted", counts["mtime"])
+        self.stats.add("files_cached", counts["cached"])
+
+    def iter_stale(self, hashtable: dict[str, dict], stop: Event | None = None) -> Iterator[tuple[str, dict]]:
+        """Yield entries of hashtable, that are absent or modified locally, as soon as they are found
 
-        # get list of all files that are in generated_hashtable but not in loaded_hashtable
-        filtered_list = [
-            i for i in self.extended_hashtable if i not in extended_hashtable]
+        Args:
+            hashtable (dict): Remote hashtable
+            stop (Event, optional): Stops the verification when set. Defaults to None.
 
-        console.debug(f"Removing {filtered_list} files")
+        Yields:
+            tuple[str, dict]: Relative path and remote entry of every stale file
+        """
 
-        # remove all files that are in filtered_list
-        for file in filtered_list:
-            os.remove(file)
+        checks = self.iter_checks(hashtable, stop)
+        try:
+            for file, entry, reason in checks:
+                if reason is not None:
+                    yield file, entry
+        finally:
+            checks.close()
+
+    def events(self, mirror: str | list[str], hashtable: str, reset_to_remote: bool = False,
+               downloader_type: str = "requests", connections: int = 4, link: str = "reflink",
+               cancel: Event | None = None) -> Iterator[UpdateEvent]:
+        """Update the destination, yielding events as files are checked and downloaded
+
+        Local files are verified and stale ones are downloaded at the same time.
+        Stale files and events are handed over through bounded queues, so they
+        do not pile up, when the downloads or the caller fall behind. The loaded
+        hashtable is still kept in memory as a whole and the contents, that were
+        handed to the downloader, are remembered until the update ends.
+
+        Closing the generator or setting cancel stops the update: no more files
+        are started, running downloads are finished and staged and nothing is
+        applied, so the next update continues where this one stopped. Stopped
+        update ends without UpdateApplied.
+
+        Args:
+            mirror (str | list[str]): Root URL of the mirror or of several mirrors, that share the downloads
+            hashtable (str): URL or path to hashtable
+            reset_to_remote (bool, optional): Remove files, that are not in the hashtable. Defaults to False.
+            downloader_type (str, optional): "requests", "urllib" or "asyncio". Defaults to "requests".
+            connections (int, optional): Number of files downloaded in parallel. Defaults to 4.
+            link (str, optional): How duplicates are created, "reflink", "hardlink" or "copy". Defaults to "reflink".
+            cancel (Event, optional): Stops the update when set, for callers in other threads. Defaults to None.
+
+        Yields:
+            UpdateEvent: FileChecked for every file of the hashtable, FileDownloaded, FileCopied
+                and FileRemoved as the update proceeds and UpdateApplied at the end, FileFailed
+                before the error of a failed download is raised
+        """
+
+        # Finish update, that was interrupted while it was applied
+        self.stage.recover(self.hash_cache)
+
+        with self.stats.timer("fetch_hashtable"):
+            self.loaded_hashtable = self.fetch_hashtable(hashtable)
+        self.algorithm = manifest.algorithm_of(self.loaded_hashtable)
+        self.local_index = None
+        self.stage.begin(self.loaded_hashtable)
+
+        mirrors = MirrorPool.of(mirror, self.stats)
+        downloader = self.create_downloader(
+            downloader_type, connections, hashtable, mirrors)
+        found: queue.Queue[tuple[str, dict] | None] = queue.Queue(QUEUE_DEPTH * max(1, connections))
+        events: queue.Queue[UpdateEvent] = queue.Queue(EVENT_QUEUE_SIZE)
+        stop = Event()
+        errors: list[BaseException] = []
+
+        # Every unique content is downloaded only once
+        downloaded: dict[str, str] = {}
+        duplicates: list[tuple[str, str]] = []
+
+        def emit(event: UpdateEvent) -> None:
+            # Nobody reads the events of a stopped update
+            while not stop.is_set():
+                try:
+                    events.put(event, timeout=POLL_INTERVAL)
+                    return
+                except queue.Full:
+                    pass
+
+        def hand_over(item: tuple[str, dict] | None) -> None:
+            # Downloader waits for the end of the files even after a stop, unless it failed
+            while downloading.is_alive():
+                try:
+                    found.put(item, timeout=POLL_INTERVAL)
+                    return
+                except queue.Full:
+                    pass
+
+        def stale() -> Iterator[tuple[str, dict]]:
+            while not stop.is_set() and (item := found.get()) is not None:
+                yield item
+
+        def download():
+            try:
+                downloader.download_stream(stale(), mirrors, self.stage.directory, phase)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+        def verify():
+            try:
+                for file, entry, reason in self.iter_checks(self.loaded_hashtable, stop, collect=False):
+                    emit(FileChecked(file, entry, reason))
+                    if reason is None:
+                        continue
+
+                    if entry["hash"] in downloaded:
+                        duplicates.append(
+                            (downloaded[entry["hash"]], file))
+                        continue
+
+                    downloaded[entry["hash"]] = file
+                    # Verified by an interrupted update already
+                    if self.stage.is_staged(file, entry["hash"]):
+                        emit(FileDownloaded(file, entry, resumed=True))
+                        continue
+
+                    phase.add_total(downloader.wire_size(entry))
+                    hand_over((file, entry))
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                hand_over(None)
+
+        downloader.listener = emit
+
+        with self.progress.phase("[bold green]D", 0, 0) as phase, self.stats.timer("pipeline"):
+            # Downloader has to run before the verifier hands over the first file
+            downloading = Thread(target=download, daemon=True)
+            downloading.start()
+            verifier = Thread(target=verify, daemon=True)
+            verifier.start()
+
+            try:
+                while downloading.is_alive() or not events.empty():
+                    if cancel is not None and cancel.is_set():
+                        return
+                    try:
+                        event = events.get(timeout=POLL_INTERVAL)
+                    except queue.Empty:
+                        continue
+                    yield event
+            finally:
+                stop.set()
+                downloading.join()
+                verifier.join()
+                self.hash_cache.save()
+
+        if errors:
+            raise errors[0]
+
+        if duplicates:
+            console.info(
+                f"{len(duplicates)} duplicate files are copied from downloaded files")
+            self.stage_copies(self.stage.directory, duplicates, self.loaded_hashtable, link)
+            for source, path in duplicates:
+                yield FileCopied(path, source)
+
+        if cancel is not None and cancel.is_set():
+            return
+
+        if reset_to_remote:
+            self.reset_head()
+
+        files, removals = len(self.stage.entries), list(self.stage.removals)
+        start = time.perf_counter()
+        with self.stats.timer("apply"):
+            self.stage.commit(self.hash_cache)
+        self.record_update()
+
+        for path in removals:
+            yield FileRemoved(path)
+        yield UpdateApplied(files, len(removals), time.perf_counter() - start)
+
+    async def aevents(self, mirror: str | list[str], hashtable: str, reset_to_remote: bool = False,
+                      downloader_type: str = "requests", connections: int = 4,
+                      link: str = "reflink") -> AsyncIterator[UpdateEvent]:
+        """Asynchronous variant of events(), the update runs in worker threads
+
+        Cancelling the task, that iterates the events, or closing the iterator
+        stops the update the same way as closing events() does.
+
+        Args:
+            Same as events()
+
+        Yields:
+            UpdateEvent: Same as events()
+        """
+
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        cancel = Event()
+        events = self.events(mirror, hashtable, reset_to_remote, downloader_type, connections, link, cancel)
+        end = object()
+
+        try:
+            while True:
+                step = loop.run_in_executor(None, next, events, end)
+                try:
+                    event = await asyncio.shield(step)
+                except asyncio.CancelledError:
+                    # Running generator can not be closed, it notices the cancel within POLL_INTERVAL
+                    cancel.set()
+                    await asyncio.wait([step])
+                    raise
+
+                if event is end:
+                    return
+                yield event
+        finally:
+            cancel.set()
+            await loop.run_in_executor(None, events.close)
+
+    def run_pipeline(self, mirror: str | list[str], hashtable: str, reset_to_remote: bool = False,
+                     downloader_type: str = "requests", connections: int = 4, link: str = "reflink") -> None:
+        """Verify local files and download stale ones at the same time
+
+        Files are handed to the downloader as soon as they are found to be
+        absent or modified, so the network does not wait for the hashing.
+        """
+
+        downloaded, size = 0, 0
+        for event in self.events(mirror, hashtable, reset_to_remote, downloader_type, connections, link):
+            if isinstance(event, FileDownloaded) and not event.resumed:
+                downloaded += 1
+                size += event.entry["size"]
 
         console.info(
-            f"{len(filtered_list)} files were reset to state of remote repository")
+            f"{downloaded} files downloaded, total size: {self.human_readable(size)}")
+
+    def run(self, mirror: str | list[str], hashtable: str, prompt_user: Callable[[str], bool] | bool | None = None,
+            reset_to_remote: bool = False, downloader_type: str = "requests", connections: int = 4,
+            link: str = "reflink", pipeline: bool = False) -> bool:
+        """Update the destination to hashtable
+
+        Args:
+            mirror (str | list[str]): Root URL of the mirror or of several mirrors, that share the downloads
+            hashtable (str): URL or path to hashtable
+            prompt_user (Callable[[str], bool], optional): Confirmation of the update before anything is downloaded,
+                it gets the size of the update and cancels it by returning False. None or False starts the update
+                right away, True is deprecated and asks on the terminal with main.ask. Defaults to None.
+            reset_to_remote (bool, optional): Remove files, that are not in the hashtable. Defaults to False.
+            downloader_type (str, optional): "requests", "urllib" or "asyncio". Defaults to "requests".
+            connections (int, optional): Number of files downloaded in parallel. Defaults to 4.
+            link (str, optional): How duplicates are created, "reflink", "hardlink" or "copy". Defaults to "reflink".
+            pipeline (bool, optional): Download while local files are verified, see run_pipeline(). Defaults to False.
+
+        Returns:
+            bool: False if the update was not confirmed
+        """
+
+        if prompt_user is True:
+            warnings.warn("prompt_user=True is deprecated, pass a callable like main.ask", DeprecationWarning, stacklevel=2)
+            # Terminal belongs to the command line, the library itself never reads from it
+            from main import ask
+            prompt_user = ask
+        confirm = prompt_user or None
 
-    def run(self, mirror: str, hashtable: str, prompt_user: bool = True, reset_to_remote: bool = False, downloader_type: str = "requests"):
         def download_all():
             """Download all missing files"""
 
-            # for item in compared.keys():
-            #     download_file(mirror, item, self.path,
-            #                   compared[item]["hash"])  # type: ignore
+            if plan.local:
+                console.info(
+                    f"{len(plan.local)} files are copied from local files with the same content")
+                self.stage_copies(self.path, plan.local, compared, link)
+
+            if reset_to_remote:
+                self.reset_head()
+
+            downloader = self.create_downloader(
+                downloader_type, connections, hashtable, mirrors)
+
+            if plan.downloads:
+                with self.stats.timer("download"):
+                    downloader.download(plan.downloads, mirrors, self.stage.directory)
+
+            if plan.duplicates:
+                console.info(
+                    f"{len(plan.duplicates)} duplicate files are copied from downloaded files")
+                self.stage_copies(self.stage.directory, plan.duplicates, compared, link)
+
+            # Nothing in the destination changes until the staged update is committed
+            with self.stats.timer("apply"):
+                self.stage.commit(self.hash_cache)
+            self.record_update()
 
-            match downloader_type:
-                case "requests":
-                    downloader = RequestsDownloader()
-                case "urllib":
-                    downloader = UrllibDownloader()
-                case _:
-                    raise ValueError("No downloader selected")
+        if pipeline:
+            # Size is not known before the verification ends, so the update is confirmed upfront
+            if confirm is not None and not confirm("Files will be downloaded while they are verified"):
+                return False
+            self.run_pipeline(mirror, hashtable, reset_to_remote, downloader_type, connections, link)
+            return True
 
-            downloader.download(compared, mirror, self.path)
+        # Finish update, that was interrupted while it was applied
+        self.stage.recover(self.hash_cache)
 
         compared, size = self.compare(
             hashtable, reset_to_remote=reset_to_remote)
+        self.stage.begin(self.loaded_hashtable)
 
-        if reset_to_remote:
-            self.reset_head()
+        if size == 0 and not compared:
+            if reset_to_remote:
+                self.reset_head()
 
-        if size == 0:
+            self.stage.commit(self.hash_cache)
+            self.record_update()
             console.info("All files validated, nothing to download")
-            return
+            return True
 
-        if prompt_user:
-            try:
-                response = input(
-                    f"Total size: {self.human_readable(size)}\nDo you want to start download ? (y/n): ").strip().lower()
-
-                if response == "y":
-                    download_all()
-                else:
-                    raise KeyboardInterrupt
-            except KeyboardInterrupt:
-                console.warning("\nCancelled by user, quitting")
-        else:
-            download_all()
+        # Every unique content is downloaded only once
+        plan = planner.create_plan(compared, self.find_local_file)
+
+        # Files verified by an interrupted update are not downloaded again
+        staged = [path for path, entry in plan.downloads.items()
+                  if self.stage.is_staged(path, entry["hash"])]
+        for path in staged:
+            del plan.downloads[path]
+        if staged:
+            console.info(f"{len(staged)} files were downloaded by an interrupted update")
+
+        size = plan.size
+        mirrors = MirrorPool.of(mirror, self.stats)
+
+        total = f"Total size: {self.human_readable(size)}"
+        if self.companions_path(hashtable, mirrors) is not None and plan.wire_size != size:
+            total += f" ({self.human_readable(plan.wire_size)} compressed)"
+
+        if confirm is not None and not confirm(total):
+            return False
+
+        download_all()
+        return True